@@ -1,12 +1,21 @@
 import logging
+import os
 import platform
 
 
 # Setup config file name
 if platform.system() == 'Windows':
     CONFIG_FILE = 'gupload.ini'
+    CACHE_DIR = os.path.join(
+        os.environ.get('LOCALAPPDATA', os.path.expanduser('~')),
+        'garmin-uploader',
+    )
 else:
     CONFIG_FILE = '.guploadrc'
+    CACHE_DIR = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'garmin-uploader',
+    )
 
 # Garmin file extensions
 VALID_GARMIN_FILE_EXTENSIONS = ('.tcx', '.fit', '.gpx')
@@ -0,0 +1,45 @@
+import os.path
+import threading
+from garmin_uploader.metadata import MetadataQueue
+from garmin_uploader.retry import RetryPolicy
+
+
+class Account(object):
+    """
+    Garmin Connect account activities are routed to, with its own
+    session, rate limiter bucket, retry policy & metadata queue
+    """
+    def __init__(self, name, user, directories=None):
+        self.name = name
+        self.user = user
+        self.directories = [
+            os.path.realpath(os.path.expanduser(d))
+            for d in directories or []
+        ]
+        self.retry = RetryPolicy(user)
+        self.metadata = MetadataQueue(user.api)
+        self.lock = threading.Lock()
+        self.authenticated = None  # login outcome, once tried
+
+    def __repr__(self):
+        return self.name or self.user.username
+
+    def login(self):
+        """
+        Authenticate once, for all workers uploading to this account
+        """
+        with self.lock:
+            if self.authenticated is None:
+                self.authenticated = self.user.authenticate()
+            return self.authenticated
+
+    def match(self, path):
+        """
+        Length of the longest account directory containing a path,
+        or -1 when none does
+        """
+        path = os.path.realpath(path)
+        return max([
+            len(d) for d in self.directories
+            if path == d or path.startswith(d.rstrip(os.sep) + os.sep)
+        ] or [-1])
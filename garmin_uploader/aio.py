@@ -0,0 +1,389 @@
+"""
+Asyncio variant of the Garmin Connect api connector & upload workflow
+Requires the optional aiohttp module, and Python 3.5+
+"""
+import asyncio
+import collections
+import itertools
+import time
+try:
+    from http.cookies import SimpleCookie
+except ImportError:
+    from Cookie import SimpleCookie
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+from garmin_uploader import api, logger
+from garmin_uploader.api import (
+    GarminAPI, GarminAPIException, TransientError, DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+)
+from garmin_uploader.multipart import MultipartFile, CHUNK_SIZE
+from garmin_uploader.ratelimit import (
+    RateLimiter, parse_retry_after, DEFAULT_RATE, DEFAULT_BURST
+)
+from garmin_uploader.workflow import Workflow
+
+# Maximum number of simultaneous connections
+DEFAULT_CONNECTIONS = 10
+
+
+class FileChunks(object):
+    """
+    Async iterator over a file chunks, from its start,
+    reading them outside of the event loop
+    (Async generators need Python 3.6)
+    """
+    def __init__(self, body):
+        self.body = body
+        self.body.seek(0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.body.read, CHUNK_SIZE)
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+
+class AsyncGarminAPI(object):
+    """
+    Low level Garmin Connect api connector, as coroutines
+    All requests share the connection pool of an aiohttp session
+    """
+    common_headers = GarminAPI.common_headers
+    max_retries = GarminAPI.max_retries
+
+    def __init__(self, limiter=None, connections=DEFAULT_CONNECTIONS,
+                 types_cache=None,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 stats=None, endpoints=None):
+        if aiohttp is None:
+            raise Exception('The aiohttp module is required for async uploads')  # noqa
+
+        # Rate limiter may be shared with synchronous apis
+        self.limiter = limiter or RateLimiter()
+        self.connections = connections
+
+        # Login relies on the synchronous api, helped by cloudscraper
+        self.api = GarminAPI(self.limiter, types_cache=types_cache,
+                             timeout=timeout, stats=stats,
+                             endpoints=endpoints)
+        self.timeout = timeout
+
+    async def request(self, session, method, url, **kwargs):
+        """
+        Send a rate limited HTTP request, without blocking the event loop
+        Retries with backoff on throttled or server error responses
+        Outputs a response, with its body already read, flagged as
+        resent when a failed attempt may still have been processed
+        A callable data is called before each attempt, to build
+        a payload that can only be sent once
+        """
+        stats = self.api.stats
+        endpoint = url.split('?')[0]
+        attempt = 0
+        resent = False
+        while True:
+            wait_time = self.limiter.reserve()
+            if wait_time > 0:
+                logger.info("Rate limited for %f" % wait_time)
+                await asyncio.sleep(wait_time)
+            stats.record('rate-limit', max(0, wait_time))
+
+            options = dict(kwargs)
+            if callable(options.get('data')):
+                options['data'] = options['data']()
+            start = time.time()
+            try:
+                async with session.request(method, url, **options) as res:
+                    await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                stats.record('http', time.time() - start,
+                             status=e.__class__.__name__, method=method,
+                             url=endpoint)
+
+                # Network failures are retried like server errors
+                resent = True
+                if attempt >= self.max_retries:
+                    raise TransientError('{} {} failed: {}'.format(method, url, e))  # noqa
+                self.limiter.throttle()
+                delay = self.limiter.backoff(attempt)
+                logger.warning('{} {} failed with {}, retry in {:.1f}s'.format(method, url, e.__class__.__name__, delay))  # noqa
+            else:
+                stats.record('http', time.time() - start, status=res.status,
+                             method=method, url=endpoint)
+                res.resent = resent
+                if res.status != 429 and res.status < 500:
+                    self.limiter.success()
+                    return res
+
+                retry_after = parse_retry_after(res.headers.get('Retry-After'))  # noqa
+                self.limiter.throttle(retry_after)
+                if attempt >= self.max_retries:
+                    return res
+                resent = resent or res.status >= 500
+
+                if retry_after is None:
+                    delay = self.limiter.backoff(attempt)
+                else:
+                    delay = retry_after
+                logger.warning('{} {} failed with status {}, retry in {:.1f}s'.format(method, url, res.status, delay))  # noqa
+            await asyncio.sleep(delay)
+            stats.record('rate-limit', delay, reason='backoff')
+            attempt += 1
+
+    def create_session(self, source=None):
+        """
+        Build an aiohttp session, optionally loaded
+        with the cookies of an authenticated requests session
+        """
+        cookies = aiohttp.CookieJar(unsafe=True)
+        headers = {}
+        if source is not None:
+            headers['User-Agent'] = source.headers.get('User-Agent', '')
+            for cookie in source.cookies:
+                morsel = SimpleCookie()
+                morsel[cookie.name] = cookie.value
+                morsel[cookie.name]['domain'] = cookie.domain
+                morsel[cookie.name]['path'] = cookie.path
+                host = cookie.domain.lstrip('.')
+                cookies.update_cookies(
+                    morsel,
+                    response_url=URL('https://{}/'.format(host)),
+                )
+
+        connect, read = self.timeout
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            cookie_jar=cookies,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(sock_connect=connect,
+                                          sock_read=read),
+        )
+
+    async def authenticate(self, username, password):
+        """
+        Login on Garmin Connect
+        The SSO flow runs once in a thread, then its cookies
+        are loaded in an aiohttp session
+        """
+        loop = asyncio.get_event_loop()
+        session = await loop.run_in_executor(
+            None, self.api.authenticate, username, password
+        )
+        return self.create_session(session)
+
+    async def upload_activity(self, session, activity, progress=None):
+        """
+        Upload an activity on Garmin
+        Support multiple formats
+        The file is streamed as a multipart form, progress
+        is called with the bytes sent and total bytes to send
+        """
+        assert activity.id is None
+
+        url = '{}/{}'.format(self.api.endpoints.upload, activity.extension)
+        with MultipartFile(activity.path, activity.filename,
+                           progress=progress) as body:
+            def stream():
+                # Send file from its start on each attempt
+                return FileChunks(body)
+
+            headers = dict(self.common_headers)  # clone
+            headers.update(body.headers)
+            res = await self.request(session, 'POST', url, data=stream,
+                                     headers=headers)
+            activity.sent_size = body.length
+
+        self.api.check_upload_status(activity, res.status)
+        return self.api.parse_upload(await res.json(content_type=None),
+                                     res.resent)
+
+    async def set_activity_info(self, session, activity):
+        """
+        Update activity fields
+        """
+        types = None
+        if activity.type:
+            types = await self.load_activity_types(session)
+        data = self.api.build_activity_info(activity, types)
+        if data is None:
+            return False
+
+        url = '{}/{}'.format(self.api.endpoints.activity, activity.id)
+        headers = dict(self.common_headers)  # clone
+        headers['X-HTTP-Method-Override'] = 'PUT'  # weird. again.
+        res = await self.request(session, 'POST', url, json=data,
+                                 headers=headers)
+        if res.status >= 400:
+            raise api.classify_status(res.status, 'Activity info not set: {}'.format(await res.text()))  # noqa
+
+    async def load_activity_types(self, session):
+        """
+        Load valid activity types, from the local cache while fresh,
+        otherwise from Garmin Connect
+        """
+        # Only load once, shared with synchronous api
+        if GarminAPI.activity_types:
+            return GarminAPI.activity_types
+
+        cache = self.api.types_cache
+        cached = cache.load() if cache else None
+        if cached is not None and (cached['fresh'] or self.api.offline):
+            return self.api.use_activity_types(cached['types'])
+        if self.api.offline:
+            raise GarminAPIException('No cached activity types while offline')  # noqa
+
+        logger.debug('Fetching activity types')
+        resp = await self.request(
+            session, 'GET', self.api.endpoints.activity_types,
+            headers=self.api.activity_types_headers(cached),
+        )
+        types = None
+        if resp.status == 200:
+            types = await resp.json(content_type=None)
+        return self.api.update_activity_types(resp.status, resp.headers,
+                                              types, cached)
+
+
+class AsyncWorkflow(Workflow):
+    """
+    Upload workflow, running uploads as concurrent coroutines
+    Listing, ledger and reporting are shared with Workflow
+    """
+    def __init__(self, paths, jobs=DEFAULT_CONNECTIONS, rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST, **kwargs):
+        for option in ('compression', 'convert'):
+            if kwargs.get(option):
+                raise Exception('Async uploads do not support {}'.format(option))  # noqa
+        super(AsyncWorkflow, self).__init__(
+            paths, jobs=jobs, rate=rate, burst=burst, **kwargs
+        )
+        if len(self.accounts) > 1:
+            raise Exception('Async uploads only support a single account')
+        self.async_api = AsyncGarminAPI(self.api.limiter, self.jobs,
+                                        self.api.types_cache,
+                                        self.api.timeout, self.stats,
+                                        self.api.endpoints)
+
+    async def upload(self, session, activity):
+        """
+        Upload an activity, then set its info
+        """
+        with self.stats.timer('upload', size=activity.size) as timing:
+            try:
+                activity.id, uploaded = await self.async_api.upload_activity(
+                    session, activity
+                )
+            except GarminAPIException as e:
+                logger.warning('Upload failure: {}'.format(e))
+                activity.status = timing['status'] = 'failed'
+                activity.failure = e
+                return activity
+            activity.status = timing['status'] = \
+                uploaded and 'uploaded' or 'exists'
+            timing['size'] = activity.sent_size
+
+        if not uploaded:
+            logger.info('Activity already uploaded {}'.format(activity))
+            return activity
+
+        logger.info('Uploaded activity {}'.format(activity))
+        if activity.name or activity.type or activity.notes:
+            with self.stats.timer('info-set') as timing:
+                try:
+                    await self.async_api.set_activity_info(session, activity)
+                    activity.info_status = 'set'
+                except GarminAPIException as e:
+                    logger.warning('Activity info update failed: {}'.format(e))  # noqa
+                    activity.info_status = 'failed'
+                timing['status'] = activity.info_status
+
+        return activity
+
+    async def run(self):
+        """
+        Authenticated part of the workflow
+        Login (or reuse a cached session) & upload every activity,
+        with up to jobs concurrent uploads
+        Cancelling this coroutine cancels pending uploads
+        """
+        loop = asyncio.get_event_loop()
+        activities = self.load_activities(self.paths)
+        first = await self.next_activity(activities)
+        if first is None and not self.pending_metadata():
+            if self.skipped:
+                logger.info('Nothing to upload.')
+                return
+            raise Exception('No valid files.')
+        if first is not None:
+            activities = itertools.chain([first], activities)
+
+        await loop.run_in_executor(None, self.login)
+
+        try:
+            async with self.async_api.create_session(self.user.session) as session:  # noqa
+                total = await self.upload_all(session, activities)
+
+            # Info of activities uploaded by a resumed run
+            await loop.run_in_executor(None, self.apply_metadata)
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            self.write_dead_letter()
+            self.report_stats()
+
+        logger.info('All done: {} activities processed, {} skipped, {} invalid, {} duplicates.'.format(total, self.skipped, self.invalid, self.duplicates))  # noqa
+
+    def report(self, activities):
+        """
+        Report uploaded activities, journaling the info set
+        right after their upload
+        """
+        total = super(AsyncWorkflow, self).report(activities)
+        if self.journal is not None:
+            for activity in activities:
+                if activity.info_status in ('set', 'failed'):
+                    self.journal.write(activity,
+                                       'info-' + activity.info_status)
+        return total
+
+    async def next_activity(self, activities):
+        """
+        List the next activity, or None once all are listed
+        Listing hashes, validates & looks files up in the ledger,
+        so it runs in an executor, off the event loop
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, next, activities, None)
+
+    async def upload_all(self, session, activities):
+        """
+        Upload activities as they are listed, only a few
+        ahead of the oldest pending upload
+        Reports activities in input order
+        """
+        pending = collections.deque()
+        total = 0
+        try:
+            while True:
+                activity = await self.next_activity(activities)
+                if activity is None:
+                    break
+                pending.append(
+                    asyncio.ensure_future(self.upload(session, activity))
+                )
+                if len(pending) >= self.jobs:
+                    total += self.report([await pending.popleft()])
+            while pending:
+                total += self.report([await pending.popleft()])
+        finally:
+            for task in pending:
+                task.cancel()
+        return total
@@ -1,18 +1,22 @@
-import cloudscraper
-
+import os
 import re
+import time
 from garmin_uploader import logger
+from garmin_uploader.compression import (
+    gzip_body, zip_file, COMPRESSIBLE_FORMATS, REJECTED_COMPRESSION_STATUSES
+)
+from garmin_uploader.convert import CONVERTIBLE_FORMATS, smallest_encoding
+from garmin_uploader.endpoints import load_endpoints
+from garmin_uploader.multipart import MultipartFile
+from garmin_uploader.ratelimit import RateLimiter, parse_retry_after
+from garmin_uploader.stats import Stats
+
+# Seconds to wait for a connection, then for data from Garmin Connect
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
 
-URL_HOSTNAME = 'https://connect.garmin.com/modern/auth/hostname'
-URL_LOGIN = 'https://sso.garmin.com/sso/login'
-URL_POST_LOGIN = 'https://connect.garmin.com/modern/'
-URL_PROFILE = 'https://connect.garmin.com/modern/currentuser-service/user/info'  # noqa
-URL_HOST_SSO = 'sso.garmin.com'
-URL_HOST_CONNECT = 'connect.garmin.com'
-URL_SSO_SIGNIN = 'https://sso.garmin.com/sso/signin'
-URL_UPLOAD = 'https://connect.garmin.com/modern/proxy/upload-service/upload'
-URL_ACTIVITY_BASE = 'https://connect.garmin.com/modern/proxy/activity-service/activity'  # noqa
-URL_ACTIVITY_TYPES = 'https://connect.garmin.com/modern/proxy/activity-service/activity/activityTypes' # noqa
+# Connections kept alive per host, at least
+DEFAULT_POOL_SIZE = 10
 
 
 class GarminAPIException(Exception):
@@ -21,6 +25,59 @@ class GarminAPIException(Exception):
     """
 
 
+class TransientError(GarminAPIException):
+    """
+    A temporary failure: network error, server error or challenge
+    """
+
+
+class ThrottledError(TransientError):
+    """
+    Garmin Connect kept throttling requests
+    """
+
+
+class AuthExpiredError(GarminAPIException):
+    """
+    The session is not logged in anymore
+    """
+
+
+class PermanentError(GarminAPIException):
+    """
+    A request that will never succeed, like an invalid file
+    """
+
+
+def network_errors():
+    """
+    Network failures worth retrying
+    The HTTP stack is only imported once a session is created,
+    so runs with nothing to upload start faster
+    """
+    import requests
+    from cloudscraper.exceptions import CloudflareException
+    return (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        CloudflareException,
+    )
+
+
+def classify_status(status_code, message):
+    """
+    Build the exception matching a failed response status
+    """
+    if status_code in (401, 403):
+        return AuthExpiredError(message)
+    if status_code == 429:
+        return ThrottledError(message)
+    if status_code >= 500:
+        return TransientError(message)
+    return PermanentError(message)
+
+
 class GarminAPI:
     """
     Low level Garmin Connect api connector
@@ -32,6 +89,142 @@ class GarminAPI:
         'NK': 'NT',
     }
 
+    # Retries on throttled (429) or server error (5xx) responses
+    max_retries = 5
+
+    def __init__(self, limiter=None, compression=None, types_cache=None,
+                 offline=False, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 stats=None, convert=False, endpoints=None):
+        # Every request goes through a rate limiter,
+        # that should be shared between all api instances
+        self.limiter = limiter or RateLimiter()
+
+        # Text files (TCX, GPX) can be sent compressed:
+        # gzip encoded body, or zip archive
+        # Disabled once the server rejects it
+        self.compression = compression
+
+        # Activity types catalog can be cached on disk,
+        # and only loaded from there when offline
+        self.types_cache = types_cache
+        self.offline = offline
+
+        # Sessions keep up to pool_size connections alive per host,
+        # and every request times out when Garmin Connect stalls
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.anonymous_session = None
+
+        # Timing of all requests & rate limiter waits
+        self.stats = stats or Stats()
+
+        # TCX & GPX files may be sent as smaller FIT files
+        self.convert = convert
+
+        # Urls of Garmin Connect, or of a proxy, mirror or stand-in
+        self.endpoints = endpoints or load_endpoints()
+
+    def request(self, session, method, url, **kwargs):
+        """
+        Send a rate limited HTTP request
+        Retries with backoff on throttled or server error responses
+        The response resent flag is set when a failed attempt may
+        still have been processed: network or server errors
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = url.split('?')[0]
+        attempt = 0
+        resent = False
+        while True:
+            self.stats.record('rate-limit', self.limiter.wait())
+            start = time.time()
+            try:
+                res = session.request(method, url, **kwargs)
+            except network_errors() as e:
+                self.stats.record('http', time.time() - start,
+                                  status=e.__class__.__name__,
+                                  method=method, url=endpoint)
+
+                # Network failures are retried like server errors
+                resent = True
+                if attempt >= self.max_retries:
+                    raise TransientError('{} {} failed: {}'.format(method, url, e))  # noqa
+                self.limiter.throttle()
+                delay = self.limiter.backoff(attempt)
+                logger.warning('{} {} failed with {}, retry in {:.1f}s'.format(method, url, e.__class__.__name__, delay))  # noqa
+            else:
+                self.stats.record('http', time.time() - start,
+                                  status=res.status_code, method=method,
+                                  url=endpoint)
+                res.resent = resent
+                if res.status_code != 429 and res.status_code < 500:
+                    self.limiter.success()
+                    return res
+
+                retry_after = parse_retry_after(res.headers.get('Retry-After'))  # noqa
+                self.limiter.throttle(retry_after)
+                if attempt >= self.max_retries:
+                    return res
+                resent = resent or res.status_code >= 500
+
+                if retry_after is None:
+                    delay = self.limiter.backoff(attempt)
+                else:
+                    delay = retry_after
+                logger.warning('{} {} failed with status {}, retry in {:.1f}s'.format(method, url, res.status_code, delay))  # noqa
+            time.sleep(delay)
+            self.stats.record('rate-limit', delay, reason='backoff')
+            attempt += 1
+
+            # Uploaded files must be sent again from their start
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)
+
+    def create_session(self):
+        """
+        Build a new HTTP session
+        """
+        # Use Cloudscraper to avoid cloudflare spam detection
+        import cloudscraper
+        logger.info('Using cloud scraper lib')
+        session = cloudscraper.create_scraper()
+
+        # Keep the cloudscraper adapters, only sizing their pools
+        self.set_pool_size(session, self.pool_size)
+        return session
+
+    def shared_session(self):
+        """
+        Anonymous session, shared by calls made without login
+        """
+        if self.anonymous_session is None:
+            self.anonymous_session = self.create_session()
+        return self.anonymous_session
+
+    def set_pool_size(self, session, size):
+        """
+        Allow up to size concurrent connections per host
+        on a session, for parallel uploads
+        """
+        for adapter in session.adapters.values():
+            adapter.init_poolmanager(size, size)
+
+    def check_session(self, session):
+        """
+        Check a session is still logged in on Garmin Connect
+        Outputs the Garmin username, or None when rejected
+        """
+        res = self.request(session, 'GET', self.endpoints.profile,
+                           allow_redirects=False)
+        if res.status_code != 200:
+            return None
+        try:
+            return res.json().get('username')
+        except ValueError:
+            # Not a JSON payload: probably the login page
+            return None
+
     def authenticate(self, username, password):
         """
         That's where the magic happens !
@@ -39,15 +232,11 @@ class GarminAPI:
         on Garmin Connect as closely as possible
         Outputs a Requests session, loaded with precious cookies
         """
-
-        # Use Cloudscraper to avoid cloudflare spam detection
-        # session = cloudscraper.create_scraper( browser={ 'browser': 'firefox', 'platform': 'windows', 'mobile': False } )
-        session = cloudscraper.create_scraper()
-        logger.info('Using cloud scraper lib')
+        session = self.create_session()
 
         # Request sso hostname
         sso_hostname = None
-        resp = session.get(URL_HOSTNAME)
+        resp = self.request(session, 'GET', self.endpoints.hostname)
         if not resp.ok:
             raise Exception('Invalid SSO first request status code {}'.format(resp.status_code))  # noqa
         sso_hostname = resp.json().get('host')
@@ -94,7 +283,7 @@ class GarminAPI:
             ('rememberMyBrowserShown', 'false'),
             ('rememberMyBrowserChecked', 'false'),
         ]
-        res = session.get(URL_LOGIN, params=params)
+        res = self.request(session, 'GET', self.endpoints.login, params=params)
         if res.status_code != 200:
             raise Exception('No login form')
 
@@ -116,7 +305,7 @@ class GarminAPI:
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',  # noqa
             'Accept-Language': 'fr,en-US;q=0.7,en;q=0.3',
             'Accept-Encoding': 'gzip, deflate, br',
-            'Origin': 'https://sso.garmin.com',
+            'Origin': self.endpoints.sso,
             'DNT': '1',
             'Connection': 'keep-alive',
             'Referer': res.url,
@@ -127,8 +316,8 @@ class GarminAPI:
             'Sec-Fetch-User': '?1',
             'TE': 'Trailers',
         }
-        res = session.post(URL_LOGIN, params=params, data=data,
-                           headers=headers)
+        res = self.request(session, 'POST', self.endpoints.login,
+                           params=params, data=data, headers=headers)
 
         if not res.ok:
             if res.status_code == 429:
@@ -142,14 +331,15 @@ class GarminAPI:
         # Second auth step
         # Needs a service ticket from previous response
         headers = {
-            'Host': URL_HOST_CONNECT,
+            'Host': self.endpoints.connect_host,
         }
-        res = session.get(URL_POST_LOGIN, params=params, headers=headers)
+        res = self.request(session, 'GET', self.endpoints.post_login,
+                           params=params, headers=headers)
         if res.status_code != 200 and not res.history:
             raise Exception('Second auth step failed.')
 
         # Check login
-        res = session.get(URL_PROFILE)
+        res = self.request(session, 'GET', self.endpoints.profile)
         if not res.ok:
             raise Exception("Login check failed.")
         garmin_user = res.json()
@@ -157,36 +347,128 @@ class GarminAPI:
 
         return session
 
-    def upload_activity(self, session, activity):
+    def upload_activity(self, session, activity, progress=None):
         """
         Upload an activity on Garmin
         Support multiple formats
+        The file is streamed as a multipart form, progress
+        is called with the bytes sent and total bytes to send
+        Text files are converted to FIT when enabled and smaller,
+        or compressed when enabled, falling back to raw files
+        when the server rejects compressed uploads
         """
         assert activity.id is None
 
-        # Upload file as multipart form
-        files = {
-            "file": (activity.filename, activity.open()),
-        }
-        url = '{}/{}'.format(URL_UPLOAD, activity.extension)
-        res = session.post(url, files=files, headers=self.common_headers)
+        if self.convert and activity.extension in CONVERTIBLE_FORMATS:
+            with smallest_encoding(activity.path) as path:
+                if path != activity.path:
+                    filename = '{}.fit'.format(
+                        os.path.splitext(activity.filename)[0]
+                    )
+                    url = '{}/.fit'.format(self.endpoints.upload)
+                    with MultipartFile(path, filename,
+                                       progress=progress) as body:
+                        res = self.send_upload(session, url, body)
+                    self.check_upload_status(activity, res.status_code)
+                    activity.sent_size = self.sent_size(res)
+                    return self.parse_upload(res.json(), res.resent)
+
+        res = None
+        compression = self.compression
+        if compression and activity.extension in COMPRESSIBLE_FORMATS:
+            res = self.upload_compressed(session, activity, compression,
+                                         progress)
+            if res.status_code in REJECTED_COMPRESSION_STATUSES:
+                logger.warning('Compressed upload ({}) rejected with status {}, sending raw files'.format(compression, res.status_code))  # noqa
+                self.compression = None
+                res = None
+
+        if res is None:
+            url = '{}/{}'.format(self.endpoints.upload, activity.extension)
+            with MultipartFile(activity.path, activity.filename,
+                               progress=progress) as body:
+                res = self.send_upload(session, url, body)
+
+        self.check_upload_status(activity, res.status_code)
+        activity.sent_size = self.sent_size(res)
+        return self.parse_upload(res.json(), res.resent)
+
+    def upload_compressed(self, session, activity, compression,
+                          progress=None):
+        """
+        Upload an activity file compressed, either
+         * as a zip archive, on the zip upload endpoint
+         * as a gzip encoded multipart body
+        """
+        if compression == 'zip':
+            with zip_file(activity.path, activity.filename) as archive:
+                url = '{}/.zip'.format(self.endpoints.upload)
+                with MultipartFile(archive, activity.filename + '.zip',
+                                   progress=progress) as body:
+                    return self.send_upload(session, url, body)
+
+        if compression == 'gzip':
+            url = '{}/{}'.format(self.endpoints.upload, activity.extension)
+            with MultipartFile(activity.path, activity.filename) as body:
+                with gzip_body(body) as compressed:
+                    headers = {
+                        'Content-Type': body.content_type,
+                        'Content-Encoding': 'gzip',
+                    }
+                    return self.send_upload(session, url, compressed,
+                                            headers)
+
+        raise GarminAPIException('Unsupported compression {}'.format(compression))  # noqa
+
+    def send_upload(self, session, url, body, headers=None):
+        """
+        Send an upload body, rewound on retries
+        """
+        headers = dict(self.common_headers, **(headers or body.headers))
+        return self.request(session, 'POST', url, data=body, headers=headers)
+
+    def sent_size(self, res):
+        """
+        Length of the body sent, as compressed or converted
+        """
+        return int(res.request.headers.get('Content-Length') or 0)
 
+    def check_upload_status(self, activity, status_code):
+        """
+        Check the HTTP status of an upload response
+        """
         # HTTP Status can either be OK or Conflict
-        if res.status_code not in (200, 201, 409):
-            if res.status_code == 412:
+        if status_code not in (200, 201, 409):
+            if status_code == 412:
                 logger.error('You may have to give explicit consent for uploading files to Garmin')  # noqa
-            raise GarminAPIException('Failed to upload {}'.format(activity))
+            message = 'Failed to upload {} (status {})'
+            raise classify_status(
+                status_code, message.format(activity, status_code)
+            )
 
-        response = res.json()['detailedImportResult']
+    def parse_upload(self, payload, resent=False):
+        """
+        Read an upload response payload
+        Outputs the activity id, and whether it was uploaded
+        or already existed
+        A file resent after a failed attempt is reported as uploaded
+        even if it already exists, as the failed attempt may have
+        uploaded it
+        """
+        response = payload['detailedImportResult']
         if len(response["successes"]) == 0:
             if len(response["failures"]) > 0:
                 if response["failures"][0]["messages"][0]['code'] == 202:
                     # Activity already exists
-                    return response["failures"][0]["internalId"], False
+                    activity_id = response["failures"][0]["internalId"]
+                    if resent:
+                        logger.info('Activity {} already exists after a resent upload, assuming a previous attempt uploaded it'.format(activity_id))  # noqa
+                    return activity_id, resent
                 else:
-                    raise GarminAPIException(response["failures"][0]["messages"])  # noqa
+                    # Garmin rejected the file itself
+                    raise PermanentError(response["failures"][0]["messages"])  # noqa
             else:
-                raise GarminAPIException('Unknown error: {}'.format(response))
+                raise TransientError('Unknown error: {}'.format(response))
         else:
             # Upload was successsful
             return response["successes"][0]["internalId"], True
@@ -198,37 +480,92 @@ class GarminAPI:
         assert activity.id is not None
         assert activity.name is not None
 
-        url = '{}/{}'.format(URL_ACTIVITY_BASE, activity.id)
+        url = '{}/{}'.format(self.endpoints.activity, activity.id)
         data = {
             'activityId': activity.id,
             'activityName': activity.name,
         }
         headers = dict(self.common_headers)  # clone
         headers['X-HTTP-Method-Override'] = 'PUT'  # weird. again.
-        res = session.post(url, json=data, headers=headers)
+        res = self.request(session, 'POST', url, json=data, headers=headers)
         if not res.ok:
-            raise GarminAPIException('Activity name not set: {}'.format(res.content))  # noqa
+            raise classify_status(res.status_code, 'Activity name not set: {}'.format(res.content))  # noqa
 
-    def load_activity_types(self):
+    def load_activity_types(self, session=None):
         """
-        Fetch valid activity types from Garmin Connect
+        Load valid activity types, from the local cache while fresh,
+        otherwise from Garmin Connect, revalidating the cached catalog
+        Uses the given session, or the shared anonymous one
         """
-        # Only fetch once
+        # Only load once
         if GarminAPI.activity_types:
             return GarminAPI.activity_types
 
-        logger.debug('Fetching activity types')
-        # Use Cloudscraper to avoid cloudflare spam detection
-        session = cloudscraper.create_scraper()
-        resp = session.get(URL_ACTIVITY_TYPES, headers=self.common_headers)
-        if not resp.ok:
-            raise GarminAPIException('Failed to retrieve activity types')
+        cached = self.types_cache.load() if self.types_cache else None
+        if cached is not None and (cached['fresh'] or self.offline):
+            logger.debug('Using cached activity types')
+            return self.use_activity_types(cached['types'])
+        if self.offline:
+            raise GarminAPIException('No cached activity types while offline')  # noqa
 
-        # Store as a clean dict, mapping keys and lower case common name
-        types = resp.json()
+        logger.debug('Fetching activity types')
+        if session is None:
+            session = self.shared_session()
+        import requests
+        try:
+            resp = self.request(session, 'GET', self.endpoints.activity_types,
+                                headers=self.activity_types_headers(cached))
+        except (requests.RequestException, TransientError) as e:
+            if cached is None:
+                raise GarminAPIException('Failed to retrieve activity types: {}'.format(e))  # noqa
+            logger.warning('Failed to retrieve activity types, using cached ones')  # noqa
+            return self.use_activity_types(cached['types'])
+        types = resp.json() if resp.status_code == 200 else None
+        return self.update_activity_types(resp.status_code, resp.headers,
+                                          types, cached)
+
+    def activity_types_headers(self, cached=None):
+        """
+        Build headers revalidating a cached activity types catalog
+        """
+        headers = dict(self.common_headers)  # clone
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def update_activity_types(self, status_code, headers, types,
+                              cached=None):
+        """
+        Use activity types fetched from Garmin Connect, or the cached
+        ones when still valid or when Garmin Connect fails
+        """
+        if status_code == 304 and cached is not None:
+            logger.debug('Cached activity types are still valid')
+            types = cached['types']
+        elif status_code != 200:
+            if cached is None:
+                raise GarminAPIException('Failed to retrieve activity types')
+            logger.warning('Failed to retrieve activity types, using cached ones')  # noqa
+            return self.use_activity_types(cached['types'])
+
+        if self.types_cache is not None:
+            cached = cached or {}
+            self.types_cache.save(
+                types,
+                headers.get('ETag') or cached.get('etag'),
+                headers.get('Last-Modified') or cached.get('last_modified'),
+            )
+        return self.use_activity_types(types)
+
+    def use_activity_types(self, types):
+        """
+        Store types as a clean dict, mapping keys
+        """
         GarminAPI.activity_types = {t['typeKey']: t for t in types}
-
-        logger.debug('Fetched {} activity types'.format(len(GarminAPI.activity_types)))  # noqa
+        logger.debug('Loaded {} activity types'.format(len(GarminAPI.activity_types)))  # noqa
         return GarminAPI.activity_types
 
     def set_activity_type(self, session, activity):
@@ -239,27 +576,44 @@ class GarminAPI:
         assert activity.type is not None
 
         # Load the corresponding type key on Garmin Connect
-        types = self.load_activity_types()
+        types = self.load_activity_types(session)
         type_key = types.get(activity.type)
         if type_key is None:
             logger.error("Activity type '{}' not valid".format(activity.type))
             return False
 
-        url = '{}/{}'.format(URL_ACTIVITY_BASE, activity.id)
+        url = '{}/{}'.format(self.endpoints.activity, activity.id)
         data = {
             'activityId': activity.id,
             'activityTypeDTO': type_key
         }
         headers = dict(self.common_headers)  # clone
         headers['X-HTTP-Method-Override'] = 'PUT'  # weird. again.
-        res = session.post(url, json=data, headers=headers)
+        res = self.request(session, 'POST', url, json=data, headers=headers)
         if not res.ok:
-            raise GarminAPIException('Activity type not set: {}'.format(res.content))  # noqa
+            raise classify_status(res.status_code, 'Activity type not set: {}'.format(res.content))  # noqa
 
     def set_activity_info(self, session, activity):
         """
         Update activity fields
         """
+        types = activity.type and self.load_activity_types(session) or None
+        data = self.build_activity_info(activity, types)
+        if data is None:
+            return False
+
+        url = '{}/{}'.format(self.endpoints.activity, activity.id)
+        headers = dict(self.common_headers)  # clone
+        headers['X-HTTP-Method-Override'] = 'PUT'  # weird. again.
+        res = self.request(session, 'POST', url, json=data, headers=headers)
+        if not res.ok:
+            raise classify_status(res.status_code, 'Activity info not set: {}'.format(res.content))  # noqa
+
+    def build_activity_info(self, activity, types=None):
+        """
+        Build the payload updating activity fields
+        Outputs None when the activity type is not valid
+        """
         assert activity.id is not None
 
         data = {
@@ -268,24 +622,17 @@ class GarminAPI:
 
         if activity.type:
             # Load the corresponding type key on Garmin Connect
-            types = self.load_activity_types()
             type_key = types.get(activity.type)
             if type_key is None:
-                logger.error("Activity type '{}' not valid".format(activity.type))
-                return False
+                logger.error("Activity type '{}' not valid".format(activity.type))  # noqa
+                return None
             else:
                 data['activityTypeDTO'] = type_key
 
         if activity.name:
-                data['activityName'] = activity.name
+            data['activityName'] = activity.name
         if activity.notes:
-                data['description'] = activity.notes
+            data['description'] = activity.notes
 
         assert len(data) > 1
-
-        url = '{}/{}'.format(URL_ACTIVITY_BASE, activity.id)
-        headers = dict(self.common_headers)  # clone
-        headers['X-HTTP-Method-Override'] = 'PUT'  # weird. again.
-        res = session.post(url, json=data, headers=headers)
-        if not res.ok:
-            raise GarminAPIException('Activity info not set: {}'.format(res.content))  # noqa
+        return data
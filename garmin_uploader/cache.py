@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import time
+from garmin_uploader import logger, CACHE_DIR
+
+# Cached sessions are trusted for one day by default
+DEFAULT_SESSION_TTL = 24 * 3600
+
+# Cached activity types are revalidated every week by default
+DEFAULT_TYPES_TTL = 7 * 24 * 3600
+TYPES_FILE = 'activity-types.json'
+
+
+def get_cache_dir(path=None):
+    """
+    Build the local cache directory
+    Defaults to a per-user platform directory
+    """
+    path = os.path.expanduser(path or CACHE_DIR)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def write_json(path, payload, mode=0o600):
+    """
+    Write a JSON file atomically, with restricted permissions
+    """
+    get_cache_dir(os.path.dirname(path))
+    tmp = '{}.tmp'.format(path)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(payload, f)
+    getattr(os, 'replace', os.rename)(tmp, path)
+
+
+class SessionCache(object):
+    """
+    Persist an authenticated session cookie jar on disk
+    so the SSO login is only needed once per TTL
+    """
+    def __init__(self, username, directory=None, ttl=DEFAULT_SESSION_TTL):
+        self.username = username
+        self.ttl = ttl
+
+        # Never store the username in clear in the file name
+        key = hashlib.sha1(username.encode('utf-8')).hexdigest()
+        self.directory = directory
+        self.path = os.path.join(
+            os.path.expanduser(directory or CACHE_DIR),
+            'session-{}.json'.format(key),
+        )
+
+    def load(self, session):
+        """
+        Load cached cookies in a session
+        Returns False when no valid cache is available
+        """
+        if not os.path.isfile(self.path):
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                payload = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Invalid session cache {}: {}'.format(self.path, e))  # noqa
+            return False
+
+        if payload.get('username') != self.username:
+            logger.debug('Session cache belongs to another user')
+            return False
+        if payload.get('expires', 0) < time.time():
+            logger.debug('Session cache expired')
+            return False
+
+        from requests.cookies import create_cookie
+        for cookie in payload.get('cookies', []):
+            session.cookies.set_cookie(create_cookie(**cookie))
+        if payload.get('user_agent'):
+            session.headers['User-Agent'] = payload['user_agent']
+
+        logger.debug('Loaded session cache {}'.format(self.path))
+        return True
+
+    def save(self, session):
+        """
+        Store the session cookies and their expiry on disk
+        """
+        now = time.time()
+        payload = {
+            'username': self.username,
+            'created': now,
+            'expires': now + self.ttl,
+            'user_agent': session.headers.get('User-Agent'),
+            'cookies': [
+                {
+                    'name': c.name,
+                    'value': c.value,
+                    'domain': c.domain,
+                    'path': c.path,
+                    'secure': c.secure,
+                    'expires': c.expires,
+                }
+                for c in session.cookies
+            ],
+        }
+
+        # Readable only by current user
+        write_json(self.path, payload)
+        logger.debug('Saved session cache {}'.format(self.path))
+
+    def clear(self):
+        """
+        Remove a rejected session from disk
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class TypesCache(object):
+    """
+    Persist the activity types catalog of Garmin Connect on disk,
+    revalidated once its TTL is over
+    """
+    def __init__(self, directory=None, ttl=DEFAULT_TYPES_TTL):
+        self.ttl = ttl
+        self.path = os.path.join(
+            os.path.expanduser(directory or CACHE_DIR), TYPES_FILE,
+        )
+
+    def load(self):
+        """
+        Load the cached catalog, flagged as fresh while in its TTL
+        Returns None when no valid cache is available
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        try:
+            with open(self.path, 'r') as f:
+                payload = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Invalid activity types cache {}: {}'.format(self.path, e))  # noqa
+            return None
+        if not isinstance(payload.get('types'), list):
+            return None
+
+        payload['fresh'] = payload.get('fetched', 0) + self.ttl > time.time()
+        return payload
+
+    def save(self, types, etag=None, last_modified=None):
+        """
+        Store the catalog, with its validators for revalidation
+        """
+        write_json(self.path, {
+            'fetched': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'types': types,
+        }, 0o644)
+        logger.debug('Saved activity types cache {}'.format(self.path))
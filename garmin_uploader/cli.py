@@ -1,19 +1,434 @@
 import argparse
+import datetime
 import os.path
 import sys
-from garmin_uploader.workflow import Workflow
+from garmin_uploader.api import (
+    GarminAPI, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+)
+from garmin_uploader.cache import TypesCache
+from garmin_uploader.compression import COMPRESSIONS
+from garmin_uploader.endpoints import load_endpoints, ENV_CONNECT, ENV_SSO
+from garmin_uploader.workflow import Workflow, find_activities
+from garmin_uploader.ledger import Ledger
+from garmin_uploader.ratelimit import DEFAULT_RATE, DEFAULT_BURST
+from garmin_uploader.user import load_config
+from garmin_uploader.watch import (
+    Watcher, create_watcher, DEFAULT_SETTLE, DEFAULT_INTERVAL
+)
 
 
-def main():
+def add_scan_arguments(parser):
     """
-    CLI Entry point
+    Directory scanning options
+    """
+    parser.add_argument(
+        '-r',
+        '--recursive',
+        dest='recursive',
+        action='store_true',
+        help='Search fitness files recursively in sub directories of the'
+             ' given directories. CSV list files found in these directories'
+             ' are processed too, with file names relative to the list file.')
+    parser.add_argument(
+        '--include',
+        dest='include',
+        type=str,
+        action='append',
+        metavar='PATTERN',
+        help='Only upload files matching this glob pattern'
+             ' (on file name or path relative to the given directory).'
+             ' Can be used several times.')
+    parser.add_argument(
+        '--exclude',
+        dest='exclude',
+        type=str,
+        action='append',
+        metavar='PATTERN',
+        help='Skip files and directories matching this glob pattern'
+             ' (on name or path relative to the given directory).'
+             ' Can be used several times.')
+
+
+def add_common_arguments(parser):
+    """
+    Options shared by all upload commands
+    """
+    parser.add_argument(
+        '-u',
+        '--username',
+        dest='username',
+        type=str,
+        help='Garmin Connect user login')
+    parser.add_argument(
+        '-p',
+        '--password',
+        dest='password',
+        type=str,
+        help='Garmin Connect user password')
+    parser.add_argument(
+        '--rate',
+        dest='rate',
+        type=float,
+        default=DEFAULT_RATE,
+        help='Maximum sustained rate of requests per second sent to Garmin'
+             ' Connect. The rate is lowered automatically when Garmin'
+             ' throttles requests. [default=%(default)s]')
+    parser.add_argument(
+        '--burst',
+        dest='burst',
+        type=int,
+        default=DEFAULT_BURST,
+        help='Maximum number of requests sent in a burst, above the'
+             ' sustained rate. [default=%(default)s]')
+    parser.add_argument(
+        '--connect-timeout',
+        dest='connect_timeout',
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help='Seconds to wait for a connection to Garmin Connect before'
+             ' retrying. [default=%(default)s]')
+    parser.add_argument(
+        '--read-timeout',
+        dest='read_timeout',
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help='Seconds to wait for data from a stalled connection before'
+             ' retrying. [default=%(default)s]')
+    parser.add_argument(
+        '--compress',
+        dest='compression',
+        choices=COMPRESSIONS,
+        help='Send TCX & GPX files compressed, as a gzip encoded body or a'
+             ' zip archive. Falls back to raw files when Garmin Connect'
+             ' rejects compressed uploads.')
+    parser.add_argument(
+        '--convert',
+        dest='convert',
+        action='store_true',
+        help='Convert TCX & GPX files to the compact FIT format before'
+             ' uploading them, when the FIT file is smaller.')
+    parser.add_argument(
+        '--no-validate',
+        dest='validate',
+        action='store_false',
+        help='Upload files without checking locally that they are not'
+             ' empty, truncated or corrupted.')
+    parser.add_argument(
+        '--check-crc',
+        dest='check_crc',
+        action='store_true',
+        help='Check the CRC of whole FIT files before uploading them,'
+             ' always done with several --prep-workers.')
+    parser.add_argument(
+        '--ledger',
+        dest='ledger',
+        type=str,
+        help='Path of the local ledger of uploaded files, used to skip'
+             ' files already uploaded.')
+    parser.add_argument(
+        '--no-ledger',
+        dest='ledger',
+        action='store_const',
+        const=False,
+        help='Do not use the local ledger of uploaded files.')
+    parser.add_argument(
+        '--no-session-cache',
+        dest='session_cache',
+        action='store_false',
+        help='Always login on Garmin Connect, without reusing or storing'
+             ' the authenticated session on disk.')
+    parser.add_argument(
+        '--stats',
+        dest='show_stats',
+        action='store_true',
+        help='Print timing percentiles of each stage (discovery,'
+             ' validation, login, rate limiter waits, requests, uploads'
+             ' and info updates) and the upload throughput at the end of'
+             ' the run.')
+    parser.add_argument(
+        '--stats-export',
+        dest='stats_export',
+        type=str,
+        metavar='FILE',
+        help='Append a JSON line with the duration, bytes and status of'
+             ' every stage and request to this file.')
+    parser.add_argument(
+        '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        metavar='PORT',
+        help='Serve live metrics in the Prometheus text format on'
+             ' http://127.0.0.1:PORT/metrics while running.')
+    parser.add_argument(
+        '--metrics-file',
+        dest='metrics_file',
+        type=str,
+        metavar='FILE',
+        help='Write live metrics in the Prometheus text format to this'
+             ' file, for a node exporter textfile collector.')
+    parser.add_argument(
+        '--connect-url',
+        dest='connect_url',
+        type=str,
+        metavar='URL',
+        help='Base url of Garmin Connect, to go through a proxy or a'
+             ' mirror. Overrides the {} environment variable and the'
+             ' [Endpoints] config section.'.format(ENV_CONNECT))
+    parser.add_argument(
+        '--sso-url',
+        dest='sso_url',
+        type=str,
+        metavar='URL',
+        help='Base url of the Garmin SSO login service. Overrides the {}'
+             ' environment variable and the [Endpoints] config'
+             ' section.'.format(ENV_SSO))
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest='verbose',
+        type=int,
+        default=2,
+        choices=[1, 2, 3, 4, 5],
+        help='Verbose - select level of verbosity. 1=DEBUG(most verbose),'
+             ' 2=INFO, 3=WARNING, 4=ERROR, 5= CRITICAL(least verbose).'
+             ' [default=2]')
+
+
+def ledger(args):
+    """
+    Ledger management commands
+    """
+    parser = argparse.ArgumentParser(
+      prog='gupload ledger',
+      description='Manage the local ledger of uploaded files.',
+    )
+    parser.add_argument(
+        '--ledger',
+        dest='path',
+        type=str,
+        help='Path of the ledger database.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser(
+        'list',
+        help='List uploaded files.')
+    forget = commands.add_parser(
+        'forget',
+        help='Remove files from the ledger, so they are uploaded again.')
+    forget.add_argument(
+        'keys',
+        type=str,
+        nargs='+',
+        help='Path, content hash or activity id of files to forget.')
+    import_ = commands.add_parser(
+        'import',
+        help='Mark files as already uploaded, without uploading them.')
+    import_.add_argument(
+        'paths',
+        type=str,
+        nargs='+',
+        help='Path and name of file(s), list file name, or directory'
+             ' name containing fitness files.')
+
+    options = parser.parse_args(args)
+    try:
+        db = Ledger(options.path)
+        if options.command == 'list':
+            for entry in db.list():
+                uploaded_at = datetime.datetime.fromtimestamp(entry['uploaded_at'])  # noqa
+                print('\t'.join([
+                    str(entry['activity_id'] or '-'),
+                    uploaded_at.strftime('%Y-%m-%d %H:%M:%S'),
+                    entry['info_status'] or '-',
+                    entry['path'],
+                ]))
+
+        elif options.command == 'forget':
+            total = sum(db.forget(key) for key in options.keys)
+            print('Removed {} files from ledger.'.format(total))
+
+        elif options.command == 'import':
+            total = 0
+            for activity in find_activities(options.paths):
+                if db.find(activity.path) or db.find_hash(activity.hash):
+                    continue
+                db.record(activity.path, activity.hash)
+                total += 1
+            print('Imported {} files in ledger.'.format(total))
+
+    except Exception as e:
+        print('Error: {}'.format(e))
+        return 1
+
+    return 0
+
+
+def watch(args):
+    """
+    Upload new activity files from a directory, until interrupted
+    """
+    parser = argparse.ArgumentParser(
+      prog='gupload watch',
+      description='Watch a directory and upload new or modified .TCX, .GPX'
+                  ' and .FIT files as they appear.',
+    )
+    parser.add_argument(
+        'directory',
+        type=str,
+        help='Directory to watch.')
+    parser.add_argument(
+        '-t',
+        '--type',
+        dest='activity_type',
+        type=str,
+        help='Sets activity type for ALL uploaded files.')
+    add_scan_arguments(parser)
+    parser.add_argument(
+        '--settle',
+        dest='settle',
+        type=float,
+        default=DEFAULT_SETTLE,
+        help='Seconds a file must stay unchanged before being uploaded, to'
+             ' skip partially written files. [default=%(default)s]')
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help='Seconds between two directory scans, when inotify is not'
+             ' available. [default=%(default)s]')
+    parser.add_argument(
+        '--polling',
+        dest='polling',
+        action='store_true',
+        help='Always scan the directory for changes, even if inotify is'
+             ' available.')
+    add_common_arguments(parser)
+
+    options = vars(parser.parse_args(args))
+    directory = options.pop('directory')
+    watcher_class = options.pop('polling') and Watcher or create_watcher
+    watcher = watcher_class(
+        directory,
+        recursive=options['recursive'],
+        include=options['include'],
+        exclude=options['exclude'],
+        settle=options.pop('settle'),
+        interval=options.pop('interval'),
+    )
+    try:
+        workflow = Workflow([directory], **options)
+        workflow.watch(watcher)
+    except KeyboardInterrupt:
+        return 0
+    except Exception as e:
+        print('Error: {}'.format(e))
+        return 1
+
+    return 0
+
+
+def set_info(args):
+    """
+    Set name, type & notes of activities already uploaded
     """
-    base_dir = os.path.realpath(os.path.dirname(__file__))
     parser = argparse.ArgumentParser(
+      prog='gupload set-info',
+      description='Set name, type and notes from CSV list files on'
+                  ' activities already uploaded, found in the ledger,'
+                  ' without uploading files again.',
+    )
+    parser.add_argument(
+        'paths',
+        type=str,
+        nargs='+',
+        help='CSV list file(s) with filename, name, type and notes'
+             ' columns.')
+    parser.add_argument(
+        '--accounts',
+        dest='accounts',
+        action='store_true',
+        help='Route activities to the named accounts of the config file,'
+             ' by the account column of CSV list files or by account'
+             ' directories. Other activities use the default account.')
+    add_common_arguments(parser)
+
+    options = parser.parse_args(args)
+    try:
+        workflow = Workflow(**vars(options))
+        if workflow.set_info():
+            return 1
+    except Exception as e:
+        print('Error: {}'.format(e))
+        return 1
+
+    return 0
+
+
+def types(args):
+    """
+    List valid activity types
+    """
+    parser = argparse.ArgumentParser(
+      prog='gupload types',
+      description='List activity types available on Garmin Connect, used'
+                  ' by the -t option and CSV list files.',
+    )
+    parser.add_argument(
+        '--offline',
+        dest='offline',
+        action='store_true',
+        help='Only use the locally cached activity types, even when'
+             ' outdated.')
+
+    options = parser.parse_args(args)
+    try:
+        api = GarminAPI(types_cache=TypesCache(), offline=options.offline,
+                        endpoints=load_endpoints(load_config()[0]))
+        for key in sorted(api.load_activity_types()):
+            print(key)
+    except Exception as e:
+        print('Error: {}'.format(e))
+        return 1
+
+    return 0
+
+
+# Sub commands, dispatched on first argument
+COMMANDS = {
+    'ledger': ledger,
+    'set-info': set_info,
+    'types': types,
+    'watch': watch,
+}
+
+
+class HelpFileParser(argparse.ArgumentParser):
+    """
+    Argument parser using help.txt as epilog,
+    only read when the help is printed
+    """
+    def format_help(self):
+        if self.epilog is None:
+            base_dir = os.path.realpath(os.path.dirname(__file__))
+            with open(os.path.join(base_dir, 'help.txt')) as f:
+                self.epilog = f.read()
+        return super(HelpFileParser, self).format_help()
+
+
+def main(args=None):
+    """
+    CLI Entry point
+    """
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+
+    parser = HelpFileParser(
       formatter_class=argparse.RawDescriptionHelpFormatter,
       description='A script to upload .TCX, .GPX, and .FIT'
                   'files to the Garmin Connect web site.',
-      epilog=open(os.path.join(base_dir, 'help.txt')).read(),
     )
 
     parser.add_argument(
@@ -36,31 +451,52 @@ def main():
         type=str,
         help='Sets activity type for ALL files in filename list, except files'
              'described inside a csv list file.')
+    add_scan_arguments(parser)
     parser.add_argument(
-        '-u',
-        '--username',
-        dest='username',
+        '--max-depth',
+        dest='max_depth',
+        type=int,
+        help='Maximum depth of sub directories searched in recursive mode.')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='Number of activities uploaded in parallel. Requests still'
+             ' respect the global rate limit. [default=1]')
+    parser.add_argument(
+        '--prep-workers',
+        dest='prep_workers',
+        type=int,
+        default=1,
+        help='Number of processes hashing and validating files ahead of'
+             ' the uploads. [default=1]')
+    parser.add_argument(
+        '--resume',
+        dest='journal',
         type=str,
-        help='Garmin Connect user login')
+        metavar='JOURNAL',
+        help='Record the run in a journal file, and resume it where it'
+             ' stopped when the journal already exists.')
     parser.add_argument(
-        '-p',
-        '--password',
-        dest='password',
+        '--dead-letter',
+        dest='dead_letter',
         type=str,
-        help='Garmin Connect user password')
+        metavar='CSV',
+        help='Write files that failed to upload in a CSV list file, that'
+             ' can be uploaded again once fixed.')
     parser.add_argument(
-        '-v',
-        '--verbose',
-        dest='verbose',
-        type=int,
-        default=2,
-        choices=[1, 2, 3, 4, 5],
-        help='Verbose - select level of verbosity. 1=DEBUG(most verbose),'
-             ' 2=INFO, 3=WARNING, 4=ERROR, 5= CRITICAL(least verbose).'
-             ' [default=2]')
+        '--accounts',
+        dest='accounts',
+        action='store_true',
+        help='Route activities to the named accounts of the config file,'
+             ' by the account column of CSV list files or by account'
+             ' directories. Other activities use the default account.')
+    add_common_arguments(parser)
 
     # Run workflow with these options
-    options = parser.parse_args()
+    options = parser.parse_args(args)
     try:
         workflow = Workflow(**vars(options))
         workflow.run()
@@ -0,0 +1,44 @@
+import contextlib
+import gzip
+import os
+import shutil
+import tempfile
+import zipfile
+from garmin_uploader.multipart import CHUNK_SIZE
+
+# Compression modes for text activity files
+COMPRESSIONS = ('gzip', 'zip')
+COMPRESSIBLE_FORMATS = ('.tcx', '.gpx')
+
+# Statuses sent back when a server does not support compressed uploads
+REJECTED_COMPRESSION_STATUSES = (400, 406, 411, 415, 501)
+
+
+@contextlib.contextmanager
+def gzip_body(body):
+    """
+    Compress a whole request body in a temporary file,
+    by chunks, so the compressed length is known before sending
+    Yields the temporary file, rewound
+    """
+    with tempfile.TemporaryFile() as compressed:
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as writer:
+            shutil.copyfileobj(body, writer, CHUNK_SIZE)
+        compressed.seek(0)
+        yield compressed
+
+
+@contextlib.contextmanager
+def zip_file(path, filename):
+    """
+    Build a temporary zip archive, holding a single file
+    Yields the archive path, removed afterwards
+    """
+    fd, archive = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as writer:
+            writer.write(path, filename)
+        yield archive
+    finally:
+        os.remove(archive)
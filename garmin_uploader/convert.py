@@ -0,0 +1,557 @@
+"""
+Conversion of TCX & GPX activity files to the compact FIT format
+Files are parsed incrementally, and FIT messages written as track
+points are read, so memory usage does not depend on the file size
+"""
+import calendar
+import contextlib
+import os
+import re
+import struct
+import tempfile
+try:
+    from xml.etree.cElementTree import iterparse, ParseError
+except ImportError:
+    from xml.etree.ElementTree import iterparse, ParseError
+from garmin_uploader import logger
+from garmin_uploader.multipart import CHUNK_SIZE
+from garmin_uploader.validate import fit_crc, FIT_SIGNATURE
+
+CONVERTIBLE_FORMATS = ('.tcx', '.gpx')
+
+# FIT timestamps count seconds since 1989-12-31T00:00:00Z
+FIT_EPOCH = 631065600
+
+# FIT positions are stored in semicircles
+SEMICIRCLES = 2 ** 31 / 180.0
+
+PROTOCOL_VERSION = 0x10
+PROFILE_VERSION = 2093
+HEADER_SIZE = 14
+
+# Base types: number, struct format, invalid value, valid range
+BASE_TYPES = {
+    'enum': (0x00, 'B', 0xFF, (0, 0xFE)),
+    'uint8': (0x02, 'B', 0xFF, (0, 0xFE)),
+    'uint16': (0x84, 'H', 0xFFFF, (0, 0xFFFE)),
+    'sint32': (0x85, 'i', 0x7FFFFFFF, (-0x7FFFFFFF, 0x7FFFFFFE)),
+    'uint32': (0x86, 'I', 0xFFFFFFFF, (0, 0xFFFFFFFE)),
+    'uint32z': (0x8C, 'I', 0, (1, 0xFFFFFFFF)),
+}
+
+TIMESTAMP = (253, 'uint32', 1, -FIT_EPOCH)
+POSITION = ('sint32', SEMICIRCLES, 0)
+DURATION = ('uint32', 1000, 0)
+DISTANCE = ('uint32', 100, 0)
+SPEED = ('uint16', 1000, 0)
+
+# Encoded messages: global number, then fields by name, as
+# (number, base type, scale, offset); values are stored
+# as (value + offset) * scale
+MESSAGES = {
+    'file_id': (0, {
+        'type': (0, 'enum', 1, 0),
+        'manufacturer': (1, 'uint16', 1, 0),
+        'product': (2, 'uint16', 1, 0),
+        'serial_number': (3, 'uint32z', 1, 0),
+        'time_created': (4, 'uint32', 1, -FIT_EPOCH),
+    }),
+    'record': (20, {
+        'timestamp': TIMESTAMP,
+        'position_lat': (0, ) + POSITION,
+        'position_long': (1, ) + POSITION,
+        'altitude': (2, 'uint16', 5, 500),
+        'heart_rate': (3, 'uint8', 1, 0),
+        'cadence': (4, 'uint8', 1, 0),
+        'distance': (5, ) + DISTANCE,
+        'speed': (6, ) + SPEED,
+        'power': (7, 'uint16', 1, 0),
+    }),
+    'event': (21, {
+        'timestamp': TIMESTAMP,
+        'event': (0, 'enum', 1, 0),
+        'event_type': (1, 'enum', 1, 0),
+    }),
+    'lap': (19, {
+        'message_index': (254, 'uint16', 1, 0),
+        'timestamp': TIMESTAMP,
+        'event': (0, 'enum', 1, 0),
+        'event_type': (1, 'enum', 1, 0),
+        'start_time': (2, 'uint32', 1, -FIT_EPOCH),
+        'start_position_lat': (3, ) + POSITION,
+        'start_position_long': (4, ) + POSITION,
+        'total_elapsed_time': (7, ) + DURATION,
+        'total_timer_time': (8, ) + DURATION,
+        'total_distance': (9, ) + DISTANCE,
+        'total_calories': (11, 'uint16', 1, 0),
+        'avg_speed': (13, ) + SPEED,
+        'max_speed': (14, ) + SPEED,
+        'avg_heart_rate': (15, 'uint8', 1, 0),
+        'max_heart_rate': (16, 'uint8', 1, 0),
+        'avg_cadence': (17, 'uint8', 1, 0),
+        'max_cadence': (18, 'uint8', 1, 0),
+        'avg_power': (19, 'uint16', 1, 0),
+        'max_power': (20, 'uint16', 1, 0),
+        'total_ascent': (21, 'uint16', 1, 0),
+        'total_descent': (22, 'uint16', 1, 0),
+        'sport': (25, 'enum', 1, 0),
+    }),
+    'session': (18, {
+        'message_index': (254, 'uint16', 1, 0),
+        'timestamp': TIMESTAMP,
+        'event': (0, 'enum', 1, 0),
+        'event_type': (1, 'enum', 1, 0),
+        'start_time': (2, 'uint32', 1, -FIT_EPOCH),
+        'start_position_lat': (3, ) + POSITION,
+        'start_position_long': (4, ) + POSITION,
+        'sport': (5, 'enum', 1, 0),
+        'total_elapsed_time': (7, ) + DURATION,
+        'total_timer_time': (8, ) + DURATION,
+        'total_distance': (9, ) + DISTANCE,
+        'total_calories': (11, 'uint16', 1, 0),
+        'avg_speed': (14, ) + SPEED,
+        'max_speed': (15, ) + SPEED,
+        'avg_heart_rate': (16, 'uint8', 1, 0),
+        'max_heart_rate': (17, 'uint8', 1, 0),
+        'avg_cadence': (18, 'uint8', 1, 0),
+        'max_cadence': (19, 'uint8', 1, 0),
+        'avg_power': (20, 'uint16', 1, 0),
+        'max_power': (21, 'uint16', 1, 0),
+        'total_ascent': (22, 'uint16', 1, 0),
+        'total_descent': (23, 'uint16', 1, 0),
+        'first_lap_index': (25, 'uint16', 1, 0),
+        'num_laps': (26, 'uint16', 1, 0),
+    }),
+    'activity': (34, {
+        'timestamp': TIMESTAMP,
+        'total_timer_time': (0, ) + DURATION,
+        'num_sessions': (1, 'uint16', 1, 0),
+        'type': (2, 'enum', 1, 0),
+        'event': (3, 'enum', 1, 0),
+        'event_type': (4, 'enum', 1, 0),
+    }),
+}
+
+# Enum values
+FILE_ACTIVITY = 4
+MANUFACTURER_DEVELOPMENT = 255
+EVENT_TIMER = 0
+EVENT_LAP = 9
+EVENT_ACTIVITY = 26
+EVENT_TYPE_START = 0
+EVENT_TYPE_STOP = 1
+EVENT_TYPE_STOP_ALL = 4
+SPORTS = {
+    'generic': 0,
+    'other': 0,
+    'running': 1,
+    'run': 1,
+    'biking': 2,
+    'cycling': 2,
+    'swimming': 5,
+    'walking': 11,
+    'hiking': 17,
+}
+
+TIME_PATTERN = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'(Z|([+-])(\d\d):?(\d\d))?$'
+)
+
+
+class ConversionError(Exception):
+    """
+    An activity file can't be converted to FIT
+    """
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 date time, as a UTC timestamp
+    """
+    match = TIME_PATTERN.match((value or '').strip())
+    if match is None:
+        return None
+    parts = [int(p) for p in match.groups()[:6]]
+    timestamp = calendar.timegm(parts + [0, 0, 0])
+    if match.group(7):
+        timestamp += float(match.group(7))
+    if match.group(9):
+        offset = int(match.group(10)) * 3600 + int(match.group(11)) * 60
+        timestamp -= offset if match.group(9) == '+' else -offset
+    return timestamp
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def child_value(element):
+    """
+    Value of an element, or of its Value child (TCX heart rates)
+    """
+    for child in element:
+        if local_name(child.tag) == 'Value':
+            return parse_float(child.text)
+    return parse_float(element.text)
+
+
+# Track point values, by TCX or GPX element name
+POINT_FIELDS = {
+    'Time': 'timestamp',
+    'time': 'timestamp',
+    'LatitudeDegrees': 'lat',
+    'LongitudeDegrees': 'lon',
+    'AltitudeMeters': 'altitude',
+    'ele': 'altitude',
+    'DistanceMeters': 'distance',
+    'HeartRateBpm': 'heart_rate',
+    'hr': 'heart_rate',
+    'Cadence': 'cadence',
+    'RunCadence': 'cadence',
+    'cad': 'cadence',
+    'Speed': 'speed',
+    'Watts': 'power',
+    'power': 'power',
+    'PowerInWatts': 'power',
+}
+
+# TCX lap summary values, by element name
+LAP_FIELDS = {
+    'TotalTimeSeconds': 'total_timer_time',
+    'DistanceMeters': 'total_distance',
+    'MaximumSpeed': 'max_speed',
+    'Calories': 'total_calories',
+    'AverageHeartRateBpm': 'avg_heart_rate',
+    'MaximumHeartRateBpm': 'max_heart_rate',
+}
+
+
+def parse_point(element):
+    """
+    Values of a TCX Trackpoint or GPX trkpt element
+    """
+    point = {
+        'lat': parse_float(element.get('lat')),
+        'lon': parse_float(element.get('lon')),
+    }
+    for child in element.iter():
+        field = POINT_FIELDS.get(local_name(child.tag))
+        if field == 'timestamp':
+            point[field] = parse_time(child.text)
+        elif field is not None and point.get(field) is None:
+            point[field] = child_value(child)
+    return point
+
+
+def parse_activity(path):
+    """
+    Incrementally parse a TCX or GPX activity file
+    Yields ('sport', name), ('point', values) and ('lap', values)
+    events, each lap once all its points were yielded
+    Parsed points & laps are dropped from the tree, so only
+    the elements being parsed stay in memory
+    """
+    stack = []
+    for event, element in iterparse(path, events=('start', 'end')):
+        tag = local_name(element.tag)
+        if event == 'start':
+            stack.append(element)
+            if tag == 'Activity' and element.get('Sport'):
+                yield 'sport', element.get('Sport')
+            continue
+
+        stack.pop()
+        if tag in ('Trackpoint', 'trkpt'):
+            yield 'point', parse_point(element)
+        elif tag == 'Lap':
+            lap = {'start_time': parse_time(element.get('StartTime'))}
+            for child in element:
+                field = LAP_FIELDS.get(local_name(child.tag))
+                if field is not None:
+                    lap[field] = child_value(child)
+            yield 'lap', lap
+        elif tag == 'trkseg':
+            yield 'lap', {}
+        elif tag == 'type' and stack and local_name(stack[-1].tag) == 'trk':
+            yield 'sport', element.text
+        else:
+            continue
+
+        if stack:
+            stack[-1].remove(element)
+
+
+class Summary(object):
+    """
+    Running totals of the points of a lap or session
+    """
+    def __init__(self, distance=None):
+        self.count = 0
+        self.start = self.end = None
+        self.lat = self.lon = None
+        self.start_distance = distance
+        self.distance = distance
+        self.altitude = None
+        self.ascent = self.descent = 0.0
+        self.totals = {}
+        self.maximums = {}
+
+    def add(self, point):
+        self.count += 1
+        if self.start is None:
+            self.start = point['timestamp']
+        self.end = point['timestamp']
+        if self.lat is None and point.get('lat') is not None:
+            self.lat, self.lon = point['lat'], point.get('lon')
+        if point.get('distance') is not None:
+            if self.start_distance is None:
+                self.start_distance = point['distance']
+            self.distance = point['distance']
+        if point.get('altitude') is not None:
+            if self.altitude is not None:
+                delta = point['altitude'] - self.altitude
+                if delta > 0:
+                    self.ascent += delta
+                else:
+                    self.descent -= delta
+            self.altitude = point['altitude']
+        for field in ('heart_rate', 'cadence', 'power', 'speed'):
+            value = point.get(field)
+            if value is not None:
+                total, count = self.totals.get(field, (0.0, 0))
+                self.totals[field] = (total + value, count + 1)
+                self.maximums[field] = max(value, self.maximums.get(field, value))  # noqa
+
+    def average(self, field):
+        total, count = self.totals.get(field, (0.0, 0))
+        return total / count if count else None
+
+    def fields(self, **values):
+        """
+        Lap or session summary fields, values given by
+        the source file winning over computed ones
+        """
+        elapsed = self.end - self.start
+        distance = None
+        if self.distance is not None:
+            distance = self.distance - self.start_distance
+        fields = {
+            'timestamp': self.end,
+            'start_time': self.start,
+            'start_position_lat': self.lat,
+            'start_position_long': self.lon,
+            'total_elapsed_time': elapsed,
+            'total_timer_time': elapsed,
+            'total_distance': distance,
+            'max_speed': self.maximums.get('speed'),
+            'avg_heart_rate': self.average('heart_rate'),
+            'max_heart_rate': self.maximums.get('heart_rate'),
+            'avg_cadence': self.average('cadence'),
+            'max_cadence': self.maximums.get('cadence'),
+            'avg_power': self.average('power'),
+            'max_power': self.maximums.get('power'),
+        }
+        if self.altitude is not None:
+            fields['total_ascent'] = self.ascent
+            fields['total_descent'] = self.descent
+        fields.update((k, v) for k, v in values.items() if v is not None)
+        if fields['total_distance'] and fields['total_timer_time']:
+            fields['avg_speed'] = fields['total_distance'] / fields['total_timer_time']  # noqa
+        return fields
+
+
+class FitWriter(object):
+    """
+    Write FIT messages to a binary file object
+    A definition message is only written when the fields
+    of a message change, using up to 16 local message types
+    """
+    def __init__(self, output):
+        self.output = output
+        self.start = output.tell()
+        self.output.write(b'\0' * HEADER_SIZE)
+        self.locals = {}  # definition -> local message type
+        self.next_local = 0
+
+    def write(self, name, values):
+        number, fields = MESSAGES[name]
+        present = sorted(
+            (fields[field], value) for field, value in values.items()
+            if value is not None
+        )
+        definition = (number, tuple(field[:2] for field, _ in present))
+
+        local = self.locals.get(definition)
+        if local is None:
+            local = self.define(definition)
+
+        raw = []
+        for (_, base_type, scale, offset), value in present:
+            low, high = BASE_TYPES[base_type][3]
+            raw.append(max(low, min(high, int(round((value + offset) * scale)))))  # noqa
+        fmt = '<B' + ''.join(BASE_TYPES[f[1]][1] for f, _ in present)
+        self.output.write(struct.pack(fmt, local, *raw))
+
+    def define(self, definition):
+        """
+        Write a definition message, on the next local message type
+        """
+        local = self.next_local
+        self.next_local = (local + 1) % 16
+        for key, value in list(self.locals.items()):
+            if value == local:
+                del self.locals[key]
+        self.locals[definition] = local
+
+        number, fields = definition
+        message = struct.pack('<BBBHB', 0x40 | local, 0, 0, number,
+                              len(fields))
+        for field, base_type in fields:
+            base, fmt, _, _ = BASE_TYPES[base_type]
+            message += struct.pack('<BBB', field, struct.calcsize(fmt), base)
+        self.output.write(message)
+        return local
+
+    def close(self):
+        """
+        Write the header, once the data size is known, then the CRC
+        """
+        end = self.output.tell()
+        header = struct.pack('<BBHI4s', HEADER_SIZE, PROTOCOL_VERSION,
+                             PROFILE_VERSION,
+                             end - self.start - HEADER_SIZE, FIT_SIGNATURE)
+        header += struct.pack('<H', fit_crc(header))
+        self.output.seek(self.start)
+        self.output.write(header)
+
+        # CRC covers header and data, read back by chunks
+        self.output.seek(self.start)
+        crc, remaining = 0, end - self.start
+        while remaining:
+            chunk = self.output.read(min(CHUNK_SIZE, remaining))
+            crc = fit_crc(chunk, crc)
+            remaining -= len(chunk)
+        self.output.seek(end)
+        self.output.write(struct.pack('<H', crc))
+
+
+def convert(path, output):
+    """
+    Encode a TCX or GPX activity file as a FIT activity file,
+    written to a binary file object open for reading & writing
+    Outputs the number of records written
+    """
+    writer = FitWriter(output)
+    sport = None
+    session = Summary()
+    lap = Summary()
+    laps = []  # lap summary fields, kept for session totals
+    for kind, value in parse_activity(path):
+        if kind == 'sport':
+            sport = SPORTS.get((value or '').strip().lower(), 0)
+
+        elif kind == 'point':
+            if value.get('timestamp') is None:
+                # FIT records must be timed
+                continue
+            if not session.count:
+                writer.write('file_id', {
+                    'type': FILE_ACTIVITY,
+                    'manufacturer': MANUFACTURER_DEVELOPMENT,
+                    'product': 0,
+                    'serial_number': 1,
+                    'time_created': value['timestamp'],
+                })
+                writer.write('event', {
+                    'timestamp': value['timestamp'],
+                    'event': EVENT_TIMER,
+                    'event_type': EVENT_TYPE_START,
+                })
+            session.add(value)
+            lap.add(value)
+            writer.write('record', {
+                'timestamp': value['timestamp'],
+                'position_lat': value.get('lat'),
+                'position_long': value.get('lon'),
+                'altitude': value.get('altitude'),
+                'heart_rate': value.get('heart_rate'),
+                'cadence': value.get('cadence'),
+                'distance': value.get('distance'),
+                'speed': value.get('speed'),
+                'power': value.get('power'),
+            })
+
+        elif kind == 'lap' and lap.count:
+            fields = lap.fields(message_index=len(laps), event=EVENT_LAP,
+                                event_type=EVENT_TYPE_STOP, **value)
+            writer.write('lap', dict(fields, sport=sport))
+            laps.append(fields)
+            lap = Summary(lap.distance)
+
+    if not session.count:
+        raise ConversionError('No timed track points')
+
+    # Points after the last lap element end an implicit lap
+    if lap.count:
+        fields = lap.fields(message_index=len(laps), event=EVENT_LAP,
+                            event_type=EVENT_TYPE_STOP)
+        writer.write('lap', dict(fields, sport=sport))
+        laps.append(fields)
+
+    def total(field):
+        values = [lap[field] for lap in laps if lap.get(field) is not None]
+        return sum(values) if values else None
+
+    writer.write('event', {
+        'timestamp': session.end,
+        'event': EVENT_TIMER,
+        'event_type': EVENT_TYPE_STOP_ALL,
+    })
+    fields = session.fields(
+        message_index=0, event=EVENT_ACTIVITY, event_type=EVENT_TYPE_STOP,
+        sport=sport, total_timer_time=total('total_timer_time'),
+        total_distance=total('total_distance'),
+        total_calories=total('total_calories'),
+        first_lap_index=0, num_laps=len(laps),
+    )
+    writer.write('session', fields)
+    writer.write('activity', {
+        'timestamp': session.end,
+        'total_timer_time': fields['total_timer_time'],
+        'num_sessions': 1,
+        'type': 0,
+        'event': EVENT_ACTIVITY,
+        'event_type': EVENT_TYPE_STOP,
+    })
+    writer.close()
+    return session.count
+
+
+@contextlib.contextmanager
+def smallest_encoding(path):
+    """
+    Yields the path of the smallest encoding of a TCX or GPX file:
+    the file itself, or its FIT conversion, removed afterwards
+    """
+    fd, fit = tempfile.mkstemp(suffix='.fit')
+    try:
+        try:
+            with os.fdopen(fd, 'w+b') as output:
+                convert(path, output)
+            smaller = os.path.getsize(fit) < os.path.getsize(path)
+        except (ConversionError, ParseError) as e:
+            logger.info('Activity file {} not converted: {}'.format(path, e))  # noqa
+            smaller = False
+        if smaller:
+            logger.debug('Sending {} converted to FIT, {} bytes instead of {}'.format(path, os.path.getsize(fit), os.path.getsize(path)))  # noqa
+        yield fit if smaller else path
+    finally:
+        os.remove(fit)
@@ -0,0 +1,203 @@
+import csv
+import fnmatch
+import os.path
+try:
+    # Python 3.5+
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+from garmin_uploader import logger, VALID_GARMIN_FILE_EXTENSIONS
+
+# Discovery is a lazy pipeline of generators:
+#   expand_paths -> dedupe
+# Each stage yields (path, info) candidates, where info holds
+# the activity fields read from a csv list file, or is None
+# for a file given directly or found in a directory.
+
+
+def is_csv(filename):
+    '''
+    check to see if file exists and that the file
+    extension is .csv
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    return extension == '.csv' and os.path.isfile(filename)
+
+
+def is_activity(filename):
+    '''
+    check to see if file exists and that the extension is a
+    valid activity file accepted by GC.
+    '''
+    if not os.path.isfile(filename):
+        logger.warning("File '{}' does not exist. Skipping...".format(filename))  # noqa
+        return False
+
+    # Get file extension from name
+    extension = os.path.splitext(filename)[1].lower()
+    logger.debug("File '{}' has extension '{}'".format(filename, extension))  # noqa
+
+    # Valid file extensions are .tcx, .fit, and .gpx
+    if extension in VALID_GARMIN_FILE_EXTENSIONS:
+        logger.debug("File '{}' extension '{}' is valid track file. ".format(filename, extension))  # noqa
+        return True
+    else:
+        logger.warning("File '{}' extension '{}' is not valid track file. Skipping file...".format(filename, extension))  # noqa
+        return False
+
+
+def read_csv(path, relative=False):
+    """
+    Read activities described in a csv list file
+    Relative file names are resolved from the current directory,
+    or from the csv file directory when relative is set
+    """
+    logger.info("List file '{}' will be processed...".format(path))
+    base_dir = os.path.dirname(path)
+    with open(path, 'r') as csvfile:
+        for row in csv.DictReader(csvfile):
+            filename = row['filename']
+            if relative:
+                filename = os.path.join(base_dir, filename)
+            if is_activity(filename):
+                yield filename, {
+                    'name': row.get('name'),
+                    'type': row.get('type'),
+                    'notes': row.get('notes'),
+                    'account': row.get('account'),
+                }
+
+
+def matches(path, patterns):
+    """
+    Check if a file name or relative path matches any glob pattern
+    """
+    name = os.path.basename(path)
+    return any(
+        fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern)
+        for pattern in patterns
+    )
+
+
+def directory_key(path):
+    """
+    Identity of a directory, symlinks followed,
+    so directories reached through a symlink loop are scanned once
+    """
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def scan_directory(root, recursive=False, include=None, exclude=None,
+                   max_depth=None):
+    """
+    List activity files in a directory, optionally recursively
+    Uses the cached type of directory entries, so files are not stat'ed
+    When recursive, csv list files found in directories are read too,
+    before other files of their directory
+    """
+    directories = [(root, 0)]
+    visited = set()
+    while directories:
+        path, depth = directories.pop()
+        try:
+            key = directory_key(path)
+            entries = sorted(scandir(path), key=lambda e: e.name)
+        except OSError as e:
+            logger.warning("Directory '{}' can't be read: {}. Skipping...".format(path, e))  # noqa
+            continue
+        if key in visited:
+            logger.warning("Directory '{}' already scanned, through a symlink. Skipping...".format(path))  # noqa
+            continue
+        visited.add(key)
+
+        files, subdirs = [], []
+        for entry in entries:
+            relpath = os.path.relpath(entry.path, root)
+            if exclude and matches(relpath, exclude):
+                logger.debug("Path '{}' is excluded. Skipping...".format(entry.path))  # noqa
+                continue
+
+            try:
+                is_dir = entry.is_dir()
+                is_file = not is_dir and entry.is_file()
+            except OSError as e:
+                logger.warning("Path '{}' can't be read: {}. Skipping...".format(entry.path, e))  # noqa
+                continue
+
+            if is_dir:
+                if recursive and (max_depth is None or depth < max_depth):
+                    subdirs.append((entry.path, depth + 1))
+                continue
+
+            if not is_file:
+                continue
+
+            extension = os.path.splitext(entry.name)[1].lower()
+            if recursive and extension == '.csv':
+                for candidate in read_csv(entry.path, relative=True):
+                    yield candidate
+            elif include and not matches(relpath, include):
+                logger.debug("File '{}' is not included. Skipping...".format(entry.path))  # noqa
+            elif extension in VALID_GARMIN_FILE_EXTENSIONS:
+                files.append(entry.path)
+            else:
+                logger.warning("File '{}' extension '{}' is not valid track file. Skipping file...".format(entry.path, extension))  # noqa
+
+        for f in files:
+            yield f, None
+
+        # Walk sub directories depth first, in name order
+        directories += reversed(subdirs)
+
+
+def expand_paths(paths, **options):
+    """
+    Sort out file name args given on command line.  Figure out if they are
+    fitness file names, directory names containing fitness files, or names
+    of csv file lists.
+    Check to see if files exist and if the file extension is valid.
+    """
+    for path in paths:
+        path = os.path.realpath(path)
+        if is_csv(path):
+            for candidate in read_csv(path):
+                yield candidate
+
+        elif os.path.isdir(path):
+            # Use files in directory
+            for candidate in scan_directory(path, **options):
+                yield candidate
+
+        elif is_activity(path):
+            # Use file directly
+            yield path, None
+
+
+def dedupe(candidates):
+    """
+    Skip files already listed through another path
+    """
+    seen = set()
+    for path, info in candidates:
+        realpath = os.path.realpath(path)
+        if realpath in seen:
+            logger.info("File '{}' already listed. Skipping...".format(path))  # noqa
+            continue
+        seen.add(realpath)
+        yield path, info
+
+
+def discover(paths, recursive=False, include=None, exclude=None,
+             max_depth=None):
+    """
+    Lazily list all activity files candidates
+    """
+    return dedupe(expand_paths(
+        paths,
+        recursive=recursive,
+        include=include,
+        exclude=exclude,
+        max_depth=max_depth,
+    ))
@@ -0,0 +1,66 @@
+import collections
+import os
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+DEFAULT_CONNECT = 'https://connect.garmin.com'
+DEFAULT_SSO = 'https://sso.garmin.com'
+
+# Config section of the endpoints profile
+ENDPOINTS_SECTION = 'Endpoints'
+
+# Environment variables overriding the config base urls
+ENV_CONNECT = 'GUPLOAD_CONNECT_URL'
+ENV_SSO = 'GUPLOAD_SSO_URL'
+
+# Endpoints used by the api, as (base url, path)
+PATHS = collections.OrderedDict([
+    ('hostname', ('connect', '/modern/auth/hostname')),
+    ('login', ('sso', '/sso/login')),
+    ('post_login', ('connect', '/modern/')),
+    ('profile', ('connect', '/modern/currentuser-service/user/info')),
+    ('upload', ('connect', '/modern/proxy/upload-service/upload')),
+    ('activity', ('connect', '/modern/proxy/activity-service/activity')),
+    ('activity_types', ('connect', '/modern/proxy/activity-service/activity/activityTypes')),  # noqa
+])
+
+
+class Endpoints(object):
+    """
+    Endpoints profile: urls of the Garmin Connect & SSO services,
+    from their base urls, unless given one by one
+    Used to go through a proxy, a mirror or a local stand-in
+    """
+    def __init__(self, connect=DEFAULT_CONNECT, sso=DEFAULT_SSO, **urls):
+        unknown = set(urls) - set(PATHS)
+        if unknown:
+            raise Exception('Unknown endpoints: {}'.format(', '.join(sorted(unknown))))  # noqa
+        self.connect = connect.rstrip('/')
+        self.sso = sso.rstrip('/')
+        for name, (base, path) in PATHS.items():
+            setattr(self, name, urls.get(name) or getattr(self, base) + path)
+
+        # Host header of the post login step
+        self.connect_host = urlparse(self.connect).netloc
+
+    def __repr__(self):
+        return 'Endpoints(connect={}, sso={})'.format(self.connect, self.sso)
+
+
+def load_endpoints(config=None, connect=None, sso=None):
+    """
+    Build the endpoints profile: base urls given as options override
+    environment variables, overriding the [Endpoints] config section
+    Single endpoints can only be set in the config section
+    """
+    options = {}
+    if config is not None and config.has_section(ENDPOINTS_SECTION):
+        options = dict(config.items(ENDPOINTS_SECTION))
+    for name, env, value in (('connect', ENV_CONNECT, connect),
+                             ('sso', ENV_SSO, sso)):
+        value = value or os.environ.get(env)
+        if value:
+            options[name] = value
+    return Endpoints(**options)
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import time
+from garmin_uploader import logger
+
+# Journal entries are synced to disk by batches
+BATCH_SIZE = 20
+BATCH_INTERVAL = 2.0
+
+# Activities in these states are not uploaded again on resume
+UPLOADED_STATES = ('uploaded', 'exists', 'info-set', 'info-failed')
+
+# Activities in these states still need their info to be set
+INFO_PENDING_STATES = ('uploaded', 'info-failed')
+
+
+class Journal(object):
+    """
+    Append-only journal of activity state transitions, as JSON lines:
+    queued, then uploaded (with id), exists or failed (with reason),
+    then info-set or info-failed
+    Used to resume an interrupted run where it stopped
+    """
+    def __init__(self, path, batch_size=BATCH_SIZE,
+                 batch_interval=BATCH_INTERVAL):
+        self.path = os.path.expanduser(path)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        self.states = self.load()
+        self.resumed = bool(self.states)  # journal of a previous run
+        self.file = open(self.path, 'a')
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def load(self):
+        """
+        Load the last state of each activity, by path
+        """
+        states = {}
+        if not os.path.isfile(self.path):
+            return states
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated by a crash
+                    continue
+                states[entry['path']] = entry
+        logger.info('Resuming {} activities from journal {}'.format(len(states), self.path))  # noqa
+        return states
+
+    def get(self, path):
+        """
+        Last journaled state of an activity file
+        """
+        return self.states.get(os.path.realpath(path))
+
+    def write(self, activity, state, reason=None):
+        """
+        Append a state transition of an activity
+        """
+        entry = {
+            'path': os.path.realpath(activity.path),
+            'state': state,
+            'id': activity.id,
+            'time': time.time(),
+        }
+        if reason is not None:
+            entry['reason'] = str(reason)
+
+        with self.lock:
+            self.states[entry['path']] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.unsynced += 1
+            if self.unsynced >= self.batch_size \
+               or time.time() - self.synced_at >= self.batch_interval:
+                self.sync()
+
+    def sync(self):
+        """
+        Flush pending entries to disk
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.sync()
+                self.file.close()
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from garmin_uploader import logger
+from garmin_uploader.cache import get_cache_dir
+
+LEDGER_FILE = 'ledger.sqlite'
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Hash a file content, without loading it fully in memory
+    """
+    digest = getattr(hashlib, 'blake2b', hashlib.sha256)()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Ledger(object):
+    """
+    Local SQLite database of uploaded activity files
+    Files are identified by their content hash, the path, size
+    and modification time being used as a fast pre-check
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), LEDGER_FILE)
+        self.path = os.path.expanduser(path)
+        # Files may be listed & reported from different threads
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    hash TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    activity_id INTEGER,
+                    uploaded_at REAL NOT NULL,
+                    info_status TEXT
+                )
+            ''')
+            self.db.execute('''
+                CREATE INDEX IF NOT EXISTS uploads_path
+                ON uploads (path, size, mtime)
+            ''')
+        logger.debug('Using ledger {}'.format(self.path))
+
+    def find(self, path):
+        """
+        Find an uploaded file from its path, size and modification time
+        Does not read the file content
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM uploads WHERE path = ? AND size = ? AND mtime = ?',  # noqa
+                (path, stat.st_size, stat.st_mtime),
+            ).fetchone()
+
+    def find_hash(self, digest):
+        """
+        Find an uploaded file from its content hash
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM uploads WHERE hash = ?', (digest, ),
+            ).fetchone()
+
+    def record(self, path, digest, activity_id=None, info_status=None):
+        """
+        Store an uploaded file
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (digest, path, stat.st_size, stat.st_mtime, activity_id,
+                 time.time(), info_status),
+            )
+
+    def set_info_status(self, activity_id, info_status):
+        """
+        Store the result of an activity info update
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE uploads SET info_status = ? WHERE activity_id = ?',
+                (info_status, activity_id),
+            )
+
+    def list(self):
+        """
+        List all uploaded files, most recent first
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM uploads ORDER BY uploaded_at DESC'
+            ).fetchall()
+
+    def forget(self, key):
+        """
+        Remove uploaded files from the ledger, by path, hash or activity id
+        Outputs the number of removed files
+        """
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                'DELETE FROM uploads '
+                'WHERE path = ? OR hash = ? OR activity_id = ?',
+                (os.path.realpath(key), key, key),
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.db.close()
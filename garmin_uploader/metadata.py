@@ -0,0 +1,95 @@
+import collections
+import threading
+from garmin_uploader import logger
+from garmin_uploader.api import GarminAPIException
+
+# Activity fields sent in info updates
+INFO_FIELDS = ('name', 'type', 'notes')
+
+
+class ActivityInfo(object):
+    """
+    Pending fields update of an uploaded activity
+    """
+    def __init__(self, id):
+        self.id = id
+        self.name = None
+        self.type = None
+        self.notes = None
+        self.status = None  # set or failed, once applied
+        self.activities = []  # source activities
+
+    def __repr__(self):
+        return '{} : {}'.format(self.id, self.name or '-')
+
+    def merge(self, activity):
+        """
+        Coalesce fields of an activity, latest values winning
+        """
+        for field in INFO_FIELDS:
+            value = getattr(activity, field)
+            if value:
+                setattr(self, field, value)
+        self.activities.append(activity)
+
+
+class MetadataQueue(object):
+    """
+    Deferred activity info updates, applied once uploads are done
+    Updates of a same activity are coalesced into a single request
+    """
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, activity):
+        """
+        Queue the fields update of an uploaded activity
+        """
+        assert activity.id is not None
+        with self.lock:
+            info = self.pending.get(activity.id)
+            if info is None:
+                info = self.pending[activity.id] = ActivityInfo(activity.id)
+            info.merge(activity)
+        activity.info_status = 'queued'
+
+    def drain(self, session, retry=None, pool=None):
+        """
+        Apply all queued updates, one request per activity
+        Calls go through the retry policy when given, transient
+        errors being already retried by each request
+        Updates are sent in parallel on the pool workers when given
+        Outputs all applied updates, in queue order
+        """
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+
+        def apply(info):
+            with self.api.stats.timer('info-set') as timing:
+                try:
+                    if retry is None:
+                        result = self.api.set_activity_info(session, info)
+                    else:
+                        result = retry.call(self.api.set_activity_info, info)
+                    if result is False:
+                        info.status = 'failed'  # invalid activity type
+                    else:
+                        info.status = 'set'
+                except GarminAPIException as e:
+                    logger.warning('Activity info update failed for {}: {}'.format(info, e))  # noqa
+                    info.status = 'failed'
+                timing['status'] = info.status
+
+            for activity in info.activities:
+                activity.info_status = info.status
+            return info
+
+        if pool is None:
+            return [apply(info) for info in pending]
+        return pool.map(apply, pending)
@@ -0,0 +1,203 @@
+import collections
+import os
+import re
+import threading
+import time
+from six.moves.urllib.parse import urlparse
+from garmin_uploader import logger
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Numeric path segments are activity ids, not distinct endpoints
+ID_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Minimum delay between two writes of the textfile, in seconds
+WRITE_INTERVAL = 5.0
+
+
+def endpoint(url):
+    """
+    Path of a Garmin Connect url, without its ids
+    """
+    return ID_PATTERN.sub('/{id}', urlparse(url).path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    ) + '}'
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    Live counters, histograms & gauges of a run, fed by Stats records,
+    in the Prometheus text exposition format
+    Served on a local port and/or written to a textfile collector file,
+    at most once per interval, then when closed
+    """
+    def __init__(self, port=None, path=None, host='127.0.0.1',
+                 interval=WRITE_INTERVAL):
+        # Reentrant, as the textfile is rendered while writing it
+        self.lock = threading.RLock()
+        self.counters = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.path = path
+        self.interval = interval
+        self.written = 0
+
+        self.server = None
+        if port is not None:
+            self.serve(host, port)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a gauge, read from func on each export
+        """
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def __call__(self, entry):
+        """
+        Stats hook, updating metrics from a timed stage
+        """
+        stage = entry['stage']
+        if stage == 'http':
+            self.observe('gupload_request_duration_seconds',
+                         entry['duration'], endpoint=endpoint(entry['url']),
+                         method=entry['method'])
+        elif stage == 'rate-limit':
+            if entry.get('reason'):
+                self.inc('gupload_retries_total', reason=entry['reason'])
+            self.observe('gupload_rate_limit_wait_seconds', entry['duration'])
+        elif stage == 'upload':
+            status = entry['status']
+            self.inc('gupload_uploads_total', status=status)
+            if status != 'failed':
+                self.inc('gupload_upload_bytes_total', entry['bytes'])
+            self.observe('gupload_upload_duration_seconds', entry['duration'])
+            if self.path is not None \
+               and time.time() - self.written >= self.interval:
+                self.write()
+        elif stage == 'info-set':
+            self.inc('gupload_info_updates_total', status=entry['status'])
+
+    def render(self):
+        """
+        Text exposition of all metrics
+        """
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                declare(name, 'counter')
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))  # noqa
+
+            for (name, labels), histogram in self.histograms.items():
+                declare(name, 'histogram')
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    le = labels + (('le', bound), )
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(le), count))  # noqa
+                le = labels + (('le', '+Inf'), )
+                lines.append('{}_bucket{} {}'.format(name, format_labels(le), histogram.count))  # noqa
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))  # noqa
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))  # noqa
+
+        for (name, labels), func in self.gauges.items():
+            declare(name, 'gauge')
+            lines.append('{}{} {}'.format(name, format_labels(labels), func()))  # noqa
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Write metrics atomically, for a textfile collector
+        Writes from several threads are serialized
+        """
+        with self.lock:
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+            self.written = time.time()
+
+    def serve(self, host, port):
+        """
+        Serve metrics over HTTP from a background thread
+        """
+        from six.moves import BaseHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('Metrics scraped: {}'.format(format % args))
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving metrics on http://{}:{}/metrics'.format(host, self.port))  # noqa
+
+    @property
+    def port(self):
+        return self.server and self.server.server_address[1]
+
+    def close(self):
+        """
+        Write final metrics & stop serving them
+        """
+        if self.path is not None:
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
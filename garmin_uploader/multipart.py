@@ -0,0 +1,107 @@
+import io
+import os
+import uuid
+
+# Size of file chunks read while sending
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartFile(io.RawIOBase):
+    """
+    Stream a single file as a multipart/form-data body
+    The file is read by chunks while the body is sent, so it
+    is never fully loaded in memory, and its length is known
+    up front to send a Content-Length header
+    """
+    def __init__(self, path, filename, field='file', progress=None):
+        super(MultipartFile, self).__init__()
+        self.path = path
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.head = (
+            '--{}\r\n'
+            'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            '\r\n'
+        ).format(
+            self.boundary, field, filename.replace('"', '%22')
+        ).encode('utf-8')
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+        self.size = os.path.getsize(path)
+        self.length = len(self.head) + self.size + len(self.tail)
+        self.position = 0
+        self.file = None
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    @property
+    def headers(self):
+        """
+        HTTP headers describing this body
+        """
+        return {
+            'Content-Type': self.content_type,
+            'Content-Length': str(self.length),
+        }
+
+    def __len__(self):
+        return self.length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Only rewinding is needed, to send the body again on retries
+        """
+        if whence == io.SEEK_END:
+            offset += self.length
+        elif whence == io.SEEK_CUR:
+            offset += self.position
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def readinto(self, buffer):
+        """
+        Fill buffer with the next part of the body:
+        the multipart head, then file chunks, then the tail
+        """
+        if self.position >= self.length:
+            return 0
+
+        size = min(len(buffer), CHUNK_SIZE)
+        file_start = len(self.head)
+        file_end = file_start + self.size
+        if self.position < file_start:
+            data = self.head[self.position:self.position + size]
+        elif self.position < file_end:
+            if self.file is None:
+                self.file = open(self.path, 'rb')
+            if self.file.tell() != self.position - file_start:
+                self.file.seek(self.position - file_start)
+            data = self.file.read(min(size, file_end - self.position))
+            if not data:
+                raise IOError('{} was truncated while sending'.format(self.path))  # noqa
+        else:
+            offset = self.position - file_end
+            data = self.tail[offset:offset + size]
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+        if self.progress is not None:
+            self.progress(self.position, self.length)
+        return len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super(MultipartFile, self).close()
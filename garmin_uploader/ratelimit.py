@@ -0,0 +1,110 @@
+import email.utils
+import random
+import threading
+import time
+from garmin_uploader import logger
+
+# Default sustained rate (requests per second) and burst size
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 5
+
+# Backoff delays on throttled or failed requests, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header value, either
+    a number of seconds or an HTTP date
+    Outputs a delay in seconds, or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class RateLimiter(object):
+    """
+    Thread safe token bucket rate limiter, shared by all API calls
+    The sustained rate slows down when the server throttles requests,
+    and speeds up again (up to the configured rate) on successes
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        assert rate > 0
+        assert burst >= 1
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 32
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Reserve the next available request token
+        Outputs the time to wait before using it
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(
+                0,
+                -self.tokens / self.rate,
+                self.blocked_until - now,
+            )
+
+    def wait(self):
+        """
+        Wait for the next available request token
+        Outputs the time spent waiting
+        """
+        # Reserve a token under lock, but sleep outside of it
+        # so other workers can reserve the following tokens
+        wait_time = self.reserve()
+        if wait_time > 0:
+            logger.info("Rate limited for %f" % wait_time)
+            time.sleep(wait_time)
+        return wait_time
+
+    def success(self):
+        """
+        Speed up slowly after an accepted request
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+    def throttle(self, retry_after=None):
+        """
+        Slow down after a throttled or failed request
+        and block every worker for retry_after seconds
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.blocked_until = max(
+                    self.blocked_until,
+                    time.time() + retry_after,
+                )
+        logger.debug('Rate lowered to {:.3f} requests/s'.format(self.rate))
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff delay with full jitter
+        """
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
@@ -0,0 +1,45 @@
+import threading
+from garmin_uploader import logger
+from garmin_uploader.api import AuthExpiredError
+
+
+class RetryPolicy(object):
+    """
+    Retry failed calls according to their failure kind:
+     * an expired session is renewed once, then the call is retried
+     * transient & throttled failures are already retried with backoff
+       by each request, and are not retried again here
+     * permanent failures are never retried
+    """
+    def __init__(self, user=None):
+        self.user = user
+        self.lock = threading.Lock()
+        self.generation = 0  # number of renewed sessions
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func with the current user session & given arguments
+        """
+        renewed = False
+        while True:
+            generation = self.generation
+            try:
+                return func(self.user.session, *args, **kwargs)
+            except AuthExpiredError:
+                if renewed:
+                    raise
+                self.renew(generation)
+                renewed = True
+
+    def renew(self, generation):
+        """
+        Login again, only once for calls sharing the same expired session
+        """
+        with self.lock:
+            if generation != self.generation:
+                # Another call already renewed the session
+                return
+            logger.info('Session expired, login again...')
+            if not self.user.authenticate():
+                raise AuthExpiredError('Login failed while renewing session')  # noqa
+            self.generation += 1
@@ -0,0 +1,153 @@
+import collections
+import contextlib
+import json
+import math
+import threading
+import time
+
+# Stages of a run, in reporting order
+STAGES = (
+    'discovery', 'validation', 'auth', 'rate-limit', 'http', 'upload',
+    'info-set',
+)
+
+# Percentiles of durations reported for each stage
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Stats(object):
+    """
+    Timing records of HTTP requests and workflow stages,
+    with their duration, bytes and status
+    Every record is sent to hooks, callables receiving a dict,
+    and optionally exported as JSON lines
+    Records are only kept for the summary when keep is set
+    """
+    def __init__(self, export=None, keep=False):
+        self.lock = threading.Lock()
+        self.keep = keep
+        self.records = collections.defaultdict(list)
+        self.hooks = []
+        self.started = time.time()
+
+        self.export = None
+        if export is not None:
+            # Line buffered, so dashboards can tail the export
+            self.export = open(export, 'a', 1)
+            self.hooks.append(self.write)
+
+    def record(self, stage, duration, size=0, status=None, **fields):
+        """
+        Record a timed stage, then send it to hooks
+        """
+        entry = dict(fields)
+        entry.update({
+            'stage': stage,
+            'duration': duration,
+            'bytes': size,
+            'status': status,
+            'time': time.time(),
+        })
+        if self.keep:
+            with self.lock:
+                self.records[stage].append(entry)
+        for hook in self.hooks:
+            hook(entry)
+        return entry
+
+    @contextlib.contextmanager
+    def timer(self, stage, **fields):
+        """
+        Record the duration of a block; the yielded dict
+        can be updated with the size & status of the stage
+        """
+        fields.setdefault('size', 0)
+        start = time.time()
+        try:
+            yield fields
+        finally:
+            self.record(stage, time.time() - start, **fields)
+
+    def timed(self, stage, iterable):
+        """
+        Record the time spent producing each item of an iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, time.time() - start)
+            yield item
+
+    def write(self, entry):
+        """
+        Export a record as a JSON line
+        """
+        with self.lock:
+            self.export.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        with self.lock:
+            if self.export is not None and not self.export.closed:
+                self.export.close()
+
+    def summary(self):
+        """
+        Aggregate records of each stage: count, total time,
+        duration percentiles, max duration & bytes
+        """
+        with self.lock:
+            records = dict(self.records)
+
+        stages = [s for s in STAGES if s in records]
+        stages += sorted(s for s in records if s not in STAGES)
+        rows = []
+        for stage in stages:
+            durations = sorted(r['duration'] for r in records[stage])
+            row = collections.OrderedDict([
+                ('stage', stage),
+                ('count', len(durations)),
+                ('total', sum(durations)),
+            ])
+            for p in PERCENTILES:
+                row['p{}'.format(p)] = percentile(durations, p)
+            row['max'] = durations[-1]
+            row['bytes'] = sum(r['bytes'] or 0 for r in records[stage])
+            rows.append(row)
+        return rows
+
+    def table(self):
+        """
+        Human readable summary, with the uploads throughput
+        """
+        header = ['stage', 'count', 'total']
+        header += ['p{}'.format(p) for p in PERCENTILES]
+        header += ['max', 'MB']
+        lines = ['{:<12}'.format(header[0]) + ''.join('{:>10}'.format(h) for h in header[1:])]  # noqa
+        for row in self.summary():
+            values = [row['count']]
+            values += ['{:.3f}'.format(row[h]) for h in header[2:-1]]
+            values.append('{:.2f}'.format(row['bytes'] / 1e6))
+            lines.append('{:<12}'.format(row['stage']) + ''.join('{:>10}'.format(v) for v in values))  # noqa
+
+        elapsed = max(time.time() - self.started, 1e-6)
+        uploads = [
+            r for r in self.records.get('upload', [])
+            if r['status'] != 'failed'
+        ]
+        size = sum(r['bytes'] for r in uploads)
+        lines.append('Throughput: {:.2f} files/s, {:.2f} MB/s over {:.1f}s'.format(len(uploads) / elapsed, size / 1e6 / elapsed, elapsed))  # noqa
+        return '\n'.join(lines)
@@ -7,6 +7,60 @@ except ImportError:
     from ConfigParser import RawConfigParser as ConfigParser
 from garmin_uploader import logger, CONFIG_FILE
 from garmin_uploader.api import GarminAPI
+from garmin_uploader.cache import SessionCache, DEFAULT_SESSION_TTL
+
+# Config sections of named accounts, as [Account <name>]
+ACCOUNT_SECTION = 'Account '
+
+
+def load_config():
+    """
+    Load the first config file available:
+    1) in current working directory
+    2) in user's home directory
+    Outputs the config and its path, or (None, None)
+    """
+    configCurrentDir = os.path.abspath(
+        os.path.normpath('./' + CONFIG_FILE)
+    )
+    configHomeDir = os.path.expanduser(
+        os.path.normpath('~/' + CONFIG_FILE)
+    )
+    for path in (configCurrentDir, configHomeDir):
+        if os.path.isfile(path):
+            config = ConfigParser()
+            config.read(path)
+            return config, path
+
+    return None, None
+
+
+def load_accounts(config):
+    """
+    List named accounts of a config, from [Account <name>] sections
+    Outputs (name, username, password, directories) tuples
+    """
+    accounts = []
+    if config is None:
+        return accounts
+    for section in config.sections():
+        if not section.startswith(ACCOUNT_SECTION):
+            continue
+        name = section[len(ACCOUNT_SECTION):].strip()
+        directories = []
+        if config.has_option(section, 'directories'):
+            directories = [
+                d.strip()
+                for d in config.get(section, 'directories').split(',')
+                if d.strip()
+            ]
+        accounts.append((
+            name,
+            config.get(section, 'username'),
+            config.get(section, 'password'),
+            directories,
+        ))
+    return accounts
 
 
 class User(object):
@@ -14,7 +68,8 @@ class User(object):
     Garmin Connect user model
     Authenticates through web api as a browser
     """
-    def __init__(self, username=None, password=None):
+    def __init__(self, username=None, password=None, session_cache=True,
+                 api=None):
         """
         ---- GC login credential order of precedence ----
         1) Credentials given on command line
@@ -25,28 +80,15 @@ class User(object):
         """
         # Authenticated API session
         self.session = None
+        self.api = api or GarminAPI()
 
-        configCurrentDir = os.path.abspath(
-            os.path.normpath('./' + CONFIG_FILE)
-        )
-        configHomeDir = os.path.expanduser(
-            os.path.normpath('~/' + CONFIG_FILE)
-        )
-
+        config, config_path = load_config()
         if username and password:
             logger.debug('Using credentials from command line.')
             self.username = username
             self.password = password
-        elif os.path.isfile(configCurrentDir):
-            logger.debug('Using credentials from \'%s\'.' % configCurrentDir)
-            config = ConfigParser()
-            config.read(configCurrentDir)
-            self.username = config.get('Credentials', 'username')
-            self.password = config.get('Credentials', 'password')
-        elif os.path.isfile(configHomeDir):
-            logger.debug('Using credentials from \'%s\'.' % configHomeDir)
-            config = ConfigParser()
-            config.read(configHomeDir)
+        elif config is not None:
+            logger.debug('Using credentials from \'%s\'.' % config_path)
             self.username = config.get('Credentials', 'username')
             self.password = config.get('Credentials', 'password')
         else:
@@ -56,20 +98,59 @@ class User(object):
                             "or home directory {}.  Use login options.".format(
                                 CONFIG_FILE, cwd, homepath))
 
+        # Optional session cache, configured in [Session] section
+        self.session_cache = None
+        cache_dir, ttl = None, DEFAULT_SESSION_TTL
+        if config is not None and config.has_section('Session'):
+            if config.has_option('Session', 'enabled'):
+                session_cache &= config.getboolean('Session', 'enabled')
+            if config.has_option('Session', 'cache_dir'):
+                cache_dir = config.get('Session', 'cache_dir')
+            if config.has_option('Session', 'ttl'):
+                ttl = config.getint('Session', 'ttl')
+        if session_cache:
+            self.session_cache = SessionCache(self.username, cache_dir, ttl)
+
     def authenticate(self):
         """
         Authenticate on Garmin API
         """
+        with self.api.stats.timer('auth') as timing:
+            timing['status'] = self.login()
+        return timing['status'] != 'failed'
+
+    def login(self):
+        """
+        Reuse a cached session, or login with credentials
+        Outputs how the session was obtained: cached, login or failed
+        """
+        api = self.api
+
+        # Try to reuse a previous session first
+        if self.session_cache is not None:
+            session = api.create_session()
+            try:
+                if self.session_cache.load(session) \
+                   and api.check_session(session):
+                    logger.info('Reusing cached session from {}'.format(self.session_cache.path))  # noqa
+                    self.session = session
+                    return 'cached'
+            except Exception as e:
+                logger.warning('Cached session check failed: {}'.format(e))
+            self.session_cache.clear()
+
         logger.info('Try to login on GarminConnect...')
         logger.debug('Username: {}'.format(self.username))
         logger.debug('Password: {}'.format('*'*len(self.password)))
 
-        api = GarminAPI()
         try:
             self.session = api.authenticate(self.username, self.password)
             logger.debug('Login Successful.')
         except Exception as e:
             logger.critical('Login Failure: {}'.format(e))
-            return False
+            return 'failed'
+
+        if self.session_cache is not None:
+            self.session_cache.save(self.session)
 
-        return True
+        return 'login'
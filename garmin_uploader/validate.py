@@ -0,0 +1,134 @@
+"""
+Local pre-flight checks of activity files, so broken files
+are rejected before being sent to Garmin Connect
+Files are read by chunks, never fully loaded in memory
+"""
+import os
+import struct
+try:
+    from xml.etree.cElementTree import iterparse, ParseError
+except ImportError:
+    from xml.etree.ElementTree import iterparse, ParseError
+from garmin_uploader.multipart import CHUNK_SIZE
+
+# Expected root element of XML activity files
+XML_ROOTS = {
+    '.tcx': 'TrainingCenterDatabase',
+    '.gpx': 'gpx',
+}
+
+FIT_SIGNATURE = b'.FIT'
+
+
+class ValidationError(Exception):
+    """
+    An activity file is broken
+    """
+
+
+def build_crc_table():
+    """
+    Lookup table of the FIT CRC (CRC-16, polynomial 0xA001)
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = build_crc_table()
+
+
+def fit_crc(data, crc=0):
+    """
+    Update a FIT CRC with some bytes
+    """
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def validate_fit(path, crc=False):
+    """
+    Check FIT headers & sizes, for each chained FIT file
+    The CRC of the whole file is only checked when crc is set,
+    as it reads every byte
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while f.tell() < size:
+            start = f.tell()
+            header = f.read(14)
+            if len(header) < 12 or header[8:12] != FIT_SIGNATURE:
+                raise ValidationError('Invalid FIT header')
+            header_size = bytearray(header[:1])[0]
+            if header_size not in (12, 14) or len(header) < header_size:
+                raise ValidationError('Invalid FIT header size')
+            data_size, = struct.unpack('<I', header[4:8])
+            if header_size == 14:
+                header_crc, = struct.unpack('<H', header[12:14])
+                if header_crc and header_crc != fit_crc(header[:12]):
+                    raise ValidationError('Invalid FIT header CRC')
+
+            end = start + header_size + data_size
+            if end + 2 > size:
+                raise ValidationError('FIT file is truncated')
+
+            if not crc:
+                f.seek(end + 2)
+                continue
+
+            # CRC covers header and data, and is stored after them
+            f.seek(start)
+            value, remaining = 0, end - start
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                value = fit_crc(chunk, value)
+                remaining -= len(chunk)
+            file_crc, = struct.unpack('<H', f.read(2))
+            if file_crc != value:
+                raise ValidationError('Invalid FIT CRC')
+
+
+def validate_xml(path, root):
+    """
+    Check an XML file is well formed, with the expected root element
+    """
+    try:
+        elements = iterparse(path, events=('start', 'end'))
+        event, first = next(elements)
+        tag = first.tag.rsplit('}', 1)[-1]
+        if tag != root:
+            raise ValidationError('Invalid root element {}, expected {}'.format(tag, root))  # noqa
+
+        # Drop each element once parsed, to keep memory usage low
+        stack = [first]
+        for event, element in elements:
+            if event == 'start':
+                stack.append(element)
+                continue
+            stack.pop()
+            element.clear()
+            if stack:
+                stack[-1].remove(element)
+    except ParseError as e:
+        raise ValidationError('Invalid XML: {}'.format(e))
+
+
+def validate(path, crc=False):
+    """
+    Check an activity file can be uploaded, with the full
+    FIT CRC when crc is set
+    Raises ValidationError on broken files
+    """
+    if os.path.getsize(path) == 0:
+        raise ValidationError('Empty file')
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.fit':
+        validate_fit(path, crc)
+    elif extension in XML_ROOTS:
+        validate_xml(path, XML_ROOTS[extension])
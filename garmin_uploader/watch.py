@@ -0,0 +1,230 @@
+import os
+import time
+try:
+    # Python 3.5+
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+from garmin_uploader import logger, VALID_GARMIN_FILE_EXTENSIONS
+from garmin_uploader.discovery import directory_key, matches
+
+# A file must stay unchanged this long (in seconds)
+# before being uploaded, so partially written files are skipped
+DEFAULT_SETTLE = 2.0
+
+# Delay between two directory scans, in seconds
+DEFAULT_INTERVAL = 5.0
+
+
+class Watcher(object):
+    """
+    Watch a directory for new or modified activity files
+    Detects changes by scanning the directory periodically
+    """
+    def __init__(self, directory, recursive=False, include=None,
+                 exclude=None, settle=DEFAULT_SETTLE,
+                 interval=DEFAULT_INTERVAL):
+        self.directory = os.path.realpath(directory)
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.settle = settle
+        self.interval = interval
+        self.snapshot = {}
+
+    def is_candidate(self, path):
+        """
+        Check a file is an activity file, matching patterns
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in VALID_GARMIN_FILE_EXTENSIONS:
+            return False
+        relpath = os.path.relpath(path, self.directory)
+        if self.exclude and matches(relpath, self.exclude):
+            return False
+        if self.include and not matches(relpath, self.include):
+            return False
+        return True
+
+    def scan(self):
+        """
+        List all activity files with their size and modification time
+        """
+        files = {}
+        directories = [self.directory]
+        visited = set()
+        while directories:
+            path = directories.pop()
+            try:
+                key = directory_key(path)
+                entries = list(scandir(path))
+            except OSError:
+                continue
+            if key in visited:
+                continue  # symlink loop
+            visited.add(key)
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if self.recursive:
+                            directories.append(entry.path)
+                    elif entry.is_file() and self.is_candidate(entry.path):
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime)
+                except OSError:
+                    continue  # broken symlink, or removed meanwhile
+        return files
+
+    def start(self):
+        """
+        Start watching, outputs the files already present
+        """
+        self.snapshot = self.scan()
+        return set(self.snapshot)
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for changes
+        Outputs the paths of new or modified files
+        """
+        time.sleep(timeout)
+        snapshot = self.scan()
+        changed = set(
+            path
+            for path, signature in snapshot.items()
+            if self.snapshot.get(path) != signature
+        )
+        self.snapshot = snapshot
+        return changed
+
+    def stop(self):
+        pass
+
+    def __iter__(self):
+        """
+        Yield paths of new or modified files, once they stopped changing
+        Files present when starting are yielded too
+        """
+        # Map paths to their last signature & when it was first seen
+        pending = dict((path, (None, 0)) for path in self.start())
+        try:
+            while True:
+                now = time.time()
+                for path, (signature, since) in list(pending.items()):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        # Removed in the meantime
+                        del pending[path]
+                        continue
+                    current = (stat.st_size, stat.st_mtime)
+                    if current != signature:
+                        pending[path] = (current, now)
+                    elif now - since >= self.settle:
+                        del pending[path]
+                        logger.debug("File '{}' is ready".format(path))
+                        yield path
+
+                # Check pending files again once they may be settled
+                timeout = self.interval
+                if pending:
+                    timeout = min(timeout, self.settle)
+                for path in self.changes(timeout):
+                    if path not in pending:
+                        logger.debug("File '{}' changed".format(path))
+                        pending[path] = (None, 0)
+        finally:
+            self.stop()
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watch a directory for new or modified activity files
+    Changes are notified by the Linux kernel through inotify
+    """
+    mask = 0
+
+    def start(self):
+        self.inotify = inotify_simple.INotify()
+        self.mask = inotify_simple.flags.CLOSE_WRITE \
+            | inotify_simple.flags.MOVED_TO \
+            | inotify_simple.flags.MODIFY \
+            | inotify_simple.flags.CREATE
+        self.watches = {}
+        self.add_watch(self.directory)
+        return Watcher.start(self)
+
+    def add_watch(self, directory):
+        """
+        Watch a directory and, when recursive, its sub directories
+        """
+        directories = [directory]
+        while directories:
+            path = directories.pop()
+            try:
+                wd = self.inotify.add_watch(path, self.mask)
+            except OSError as e:
+                logger.warning("Directory '{}' can't be watched: {}".format(path, e))  # noqa
+                continue
+            if wd in self.watches and self.watches[wd] != path:
+                # Same directory reached through a symlink loop
+                continue
+            self.watches[wd] = path
+            if self.recursive:
+                directories += self.subdirectories(path)
+
+    def subdirectories(self, path):
+        """
+        List sub directories, skipping unreadable entries
+        """
+        subdirs = []
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            return subdirs
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+            except OSError:
+                continue
+        return subdirs
+
+    def changes(self, timeout):
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            directory = self.watches.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                if self.recursive and event.mask & self.mask:
+                    # Files may have been written before the watch was set
+                    self.add_watch(path)
+                    changed.update(
+                        e.path for e in scandir(path)
+                        if e.is_file() and self.is_candidate(e.path)
+                    )
+            elif self.is_candidate(path):
+                changed.add(path)
+        return changed
+
+    def stop(self):
+        self.inotify.close()
+
+
+def create_watcher(directory, **options):
+    """
+    Build the best watcher available on this platform
+    """
+    if inotify_simple is not None:
+        logger.debug('Using inotify to watch {}'.format(directory))
+        return InotifyWatcher(directory, **options)
+
+    logger.debug('Scanning {} for changes'.format(directory))
+    return Watcher(directory, **options)
@@ -1,25 +1,55 @@
-import os.path
-import glob
+import collections
 import csv
-import time
+import functools
+import itertools
+import os.path
 import six
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from garmin_uploader import (
     logger, VALID_GARMIN_FILE_EXTENSIONS, BINARY_FILE_FORMATS
 )
-from garmin_uploader.user import User
-from garmin_uploader.api import GarminAPI, GarminAPIException
+from garmin_uploader.accounts import Account
+from garmin_uploader.discovery import discover
+from garmin_uploader.user import User, load_accounts, load_config
+from garmin_uploader.endpoints import load_endpoints
+from garmin_uploader.api import (
+    GarminAPI, GarminAPIException, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+)
+from garmin_uploader.cache import TypesCache
+from garmin_uploader.journal import (
+    Journal, UPLOADED_STATES, INFO_PENDING_STATES
+)
+from garmin_uploader.ledger import Ledger, hash_file
+from garmin_uploader.metrics import Metrics
+from garmin_uploader.ratelimit import (
+    RateLimiter, DEFAULT_RATE, DEFAULT_BURST
+)
+from garmin_uploader.stats import Stats
+from garmin_uploader.validate import validate, ValidationError
 
 
 class Activity(object):
     """
     Garmin Connect Activity model
     """
-    def __init__(self, path, name=None, type=None, notes=None):
+    def __init__(self, path, name=None, type=None, notes=None,
+                 account=None):
         self.id = None  # provided on upload
+        self.status = None  # uploaded, exists or failed
+        self.failure = None  # reason of a failed upload
+        self.info_status = None  # set or failed, when info is specified
+        self.sent_size = None  # bytes sent, once compressed or converted
+        self._hash = None
+        self._checked = False
+        self._error = None  # validation error
+        self._decile = None  # upload progress
         self.path = path
         self.name = name
         self.type = type
         self.notes = notes
+        self.account = account  # named account, from csv list files
 
     def __repr__(self):
         if self.id is None:
@@ -63,6 +93,39 @@ class Activity(object):
         except UnicodeEncodeError:
             return filename.decode('ascii', 'ignore')
 
+    @property
+    def size(self):
+        """
+        Size of the activity file in bytes, 0 when unreadable
+        """
+        try:
+            return os.path.getsize(self.path)
+        except (IOError, OSError):
+            return 0
+
+    @property
+    def hash(self):
+        """
+        Content hash of the activity file, computed once
+        """
+        if self._hash is None:
+            self._hash = hash_file(self.path)
+        return self._hash
+
+    def check(self, crc=False):
+        """
+        Validate the activity file, computed once,
+        with the full FIT CRC when crc is set
+        Outputs the validation error, if any
+        """
+        if not self._checked:
+            try:
+                validate(self.path, crc)
+            except (ValidationError, IOError, OSError) as e:
+                self._error = e
+            self._checked = True
+        return self._error
+
     def open(self):
         """
         Open local activity file as a file descriptor
@@ -70,173 +133,673 @@ class Activity(object):
         mode = self.extension in BINARY_FILE_FORMATS and 'rb' or 'r'
         return open(self.path, mode)
 
-    def upload(self, user):
+    def log_progress(self, sent, total):
+        """
+        Log upload progress, every 10% of the file
+        """
+        decile = 10 * sent // total
+        if decile != self._decile:
+            self._decile = decile
+            logger.debug('Sending {} : {}% of {} bytes'.format(self, decile * 10, total))  # noqa
+
+    def upload(self, user, metadata=None, retry=None):
         """
         Upload an activity once authenticated
+        Activity info is queued in metadata when given,
+        instead of being set right after the upload
+        Failed uploads are retried according to the retry policy
         """
         assert isinstance(user, User)
         assert user.session is not None
 
-        api = GarminAPI()
-        try:
-            self.id, uploaded = api.upload_activity(user.session, self)
-        except GarminAPIException as e:
-            logger.warning('Upload failure: {}'.format(e))
-            return False
+        api = user.api
+        with api.stats.timer('upload', size=self.size) as timing:
+            try:
+                if retry is None:
+                    self.id, uploaded = api.upload_activity(
+                        user.session, self, progress=self.log_progress
+                    )
+                else:
+                    self.id, uploaded = retry.call(
+                        api.upload_activity, self, progress=self.log_progress
+                    )
+            except GarminAPIException as e:
+                logger.warning('Upload failure: {}'.format(e))
+                self.status = timing['status'] = 'failed'
+                self.failure = e
+                return False
+            timing['status'] = uploaded and 'uploaded' or 'exists'
+            if self.sent_size is not None:
+                timing['size'] = self.sent_size
 
         if uploaded:
             logger.info('Uploaded activity {}'.format(self))
+            self.status = 'uploaded'
 
             # Set activity info, if specified
-            if self.name or self.type or self.notes:
-                try:
-                    api.set_activity_info(user.session, self)
-                except GarminAPIException as e:
-                    logger.warning('Activity info update failed: {}'.format(e))
+            has_info = self.name or self.type or self.notes
+            if has_info and metadata is not None:
+                metadata.add(self)
+            elif has_info:
+                with api.stats.timer('info-set') as timing:
+                    try:
+                        api.set_activity_info(user.session, self)
+                        self.info_status = 'set'
+                    except GarminAPIException as e:
+                        logger.warning('Activity info update failed: {}'.format(e))  # noqa
+                        self.info_status = 'failed'
+                    timing['status'] = self.info_status
 
         else:
             logger.info('Activity already uploaded {}'.format(self))
+            self.status = 'exists'
 
         return True
 
 
+def find_activities(paths, activity_name=None, activity_type=None,
+                    **options):
+    """
+    Lazily list all activities files, from files, directories
+    and csv list files given on command line
+    Directory scanning options are sent to discover()
+    """
+    candidates = discover(paths, **options)
+
+    # Activity name given on command line only applies if a single filename
+    # is given.  Otherwise, ignore.
+    # Only look ahead until a second file is found
+    if activity_name:
+        buffered, direct = [], 0
+        for path, info in candidates:
+            buffered.append((path, info))
+            direct += info is None
+            if direct > 1:
+                break
+        if direct != 1:
+            logger.warning('-a option valid only when one fitness file given. Ignoring -a option.')  # noqa
+            activity_name = None
+        candidates = itertools.chain(buffered, candidates)
+
+    for path, info in candidates:
+        if info is None:
+            yield Activity(path, activity_name, activity_type)
+        else:
+            yield Activity(path, info['name'], info['type'], info['notes'],
+                           info.get('account'))
+
+
+def prepare_activity(activity, check=True):
+    """
+    Hash & validate an activity file, ahead of its upload
+    Runs in worker processes, off the uploads path, so the
+    full FIT CRC is checked too
+    Outputs the prepared activity
+    """
+    try:
+        activity.hash
+    except (IOError, OSError):
+        # Reported by validation
+        pass
+    if check:
+        activity.check(crc=True)
+    return activity
+
+
+class ContentIndex(object):
+    """
+    Detect activity files listed several times with the same content
+    Files are grouped by size, then by content hash, so only
+    files sharing their size with another one are hashed
+    """
+    def __init__(self):
+        self.sizes = collections.defaultdict(list)
+
+    def find(self, activity):
+        """
+        Output the activity already indexed with the same content,
+        or index this activity
+        """
+        try:
+            size = os.path.getsize(activity.path)
+            others = self.sizes[size]
+            for other in others:
+                if other.hash == activity.hash:
+                    return other
+        except (IOError, OSError):
+            # Unreadable files are reported by validation
+            return None
+        others.append(activity)
+        return None
+
+
+def bounded_map(pool, func, iterable, size):
+    """
+    Like pool.map, but only consumes the iterable when
+    less than size results are pending, and yields in input order
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 class Workflow():
     """
     Upload workflow:
-     * List activities according to CLI args
      * Load user credentials
-     * Authenticate user
-     * Upload activities
+     * List activities according to CLI args, lazily
+     * Authenticate user, once a first activity is found
+     * Upload activities, as they are listed
     """
 
     def __init__(self, paths, username=None, password=None,
-                 activity_type=None, activity_name=None, verbose=3):
-        self.last_request = None
+                 activity_type=None, activity_name=None, verbose=3,
+                 session_cache=True, jobs=1, rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST, ledger=None, recursive=False,
+                 include=None, exclude=None, max_depth=None,
+                 compression=None, validate=True, check_crc=False,
+                 prep_workers=1,
+                 journal=None, dead_letter=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, show_stats=False,
+                 stats_export=None, metrics_port=None, metrics_file=None,
+                 accounts=False, convert=False, connect_url=None,
+                 sso_url=None):
         logger.setLevel(level=verbose * 10)
 
+        # Every stage of the run is timed, and summarized on demand
+        self.stats = Stats(stats_export, keep=show_stats)
+        self.show_stats = show_stats
+
+        # Live metrics, only fed by stats when enabled
+        self.metrics = None
+        if metrics_port is not None or metrics_file is not None:
+            self.metrics = Metrics(metrics_port, metrics_file)
+            self.stats.hooks.append(self.metrics)
+
+        # Uploads run on a pool of workers, shared by all accounts
+        # Each account api has its own rate limiter bucket,
+        # and keep-alive connections pooled for all workers
+        self.jobs = max(1, jobs)
+        self.limits = (rate, burst)
+        self.api_options = {
+            'compression': compression,
+            'types_cache': TypesCache(),
+            'pool_size': max(DEFAULT_POOL_SIZE, self.jobs),
+            'timeout': (connect_timeout, read_timeout),
+            'stats': self.stats,
+            'convert': convert,
+        }
+
         self.activity_type = activity_type
         self.activity_name = activity_name
 
-        # Load activities
-        self.activities = self.load_activities(paths)
+        # Local ledger of uploaded files, unless disabled
+        self.ledger = Ledger(ledger) if ledger is not False else None
+
+        # Activities are listed lazily, while uploading
+        self.paths = paths
+        self.scan_options = {
+            'recursive': recursive,
+            'include': include,
+            'exclude': exclude,
+            'max_depth': max_depth,
+        }
+        self.skipped = 0
+        self.queued = 0  # listed, not reported yet
+
+        # Same files listed through several paths are uploaded once
+        self.duplicates = 0
+
+        # Broken files are rejected locally, unless disabled
+        # Whole FIT files are only read for their CRC on demand
+        self.validate = validate
+        self.check_crc = check_crc
+        self.invalid = 0
+        self.activity_types = None  # loaded on first typed activity
+
+        # Files may be hashed & validated by a pool of processes
+        self.prep_workers = max(1, prep_workers)
+
+        # Runs can be journaled, to be resumed once interrupted
+        self.journal = Journal(journal) if journal else None
+
+        # All accounts use the same endpoints profile,
+        # from options, environment or config file
+        config = load_config()[0]
+        self.api_options['endpoints'] = load_endpoints(
+            config, connect_url, sso_url
+        )
+
+        # Load users: a single one, or all named accounts of the config
+        # when activities are routed to several accounts
+        self.accounts = collections.OrderedDict()
+        self.routing = accounts
+        named = load_accounts(config) if accounts else []
+        for name, login, secret, directories in named:
+            self.add_account(name, login, secret, session_cache, directories)
+        if not accounts or (username and password) \
+           or (config is not None and config.has_section('Credentials')):
+            self.add_account(None, username, password, session_cache)
+        if not self.accounts:
+            raise Exception('No account found in config file.')
+
+        # Default account, also used for watch mode & async uploads
+        # Each account sets activity info once all files are uploaded,
+        # and retries failed calls depending on their failure
+        self.account = self.accounts.get(None) \
+            or list(self.accounts.values())[0]
+        self.user = self.account.user
+        self.api = self.user.api
+        self.metadata = self.account.metadata
+        self.retry = self.account.retry
+
+        # Files that can't be uploaded are listed in a dead letter file
+        self.dead_letter = dead_letter
+        self.failed = []
+
+        if self.metrics is not None:
+            self.metrics.gauge('gupload_queue_depth', lambda: self.queued,
+                               queue='uploads')
+            self.metrics.gauge('gupload_queue_depth', self.pending_metadata,
+                               queue='metadata')
+
+    def add_account(self, name, username, password, session_cache,
+                    directories=None):
+        """
+        Setup an account, with its own api & rate limiter bucket
+        """
+        api = GarminAPI(RateLimiter(*self.limits), **self.api_options)
+        user = User(username, password, session_cache, api)
+        self.accounts[name] = Account(name, user, directories)
+
+    def route(self, activity):
+        """
+        Find the account of an activity: named in its csv list file,
+        or owning the deepest directory containing the file,
+        or the default account
+        Without accounts routing, the csv column is ignored
+        """
+        if activity.account and self.routing:
+            return self.accounts.get(activity.account)
+        routed, depth = self.accounts.get(None), -1
+        for account in self.accounts.values():
+            match = account.match(activity.path)
+            if match > depth:
+                routed, depth = account, match
+        return routed
+
+    def pending_metadata(self):
+        """
+        Number of activity info updates queued, on all accounts
+        """
+        return sum(len(a.metadata) for a in self.accounts.values())
 
-        # Load user
-        self.user = User(username, password)
+    def login(self):
+        """
+        Login a single account before any request, failing early;
+        with several accounts, each one logins on its first activity
+        """
+        if len(self.accounts) == 1 and not self.account.login():
+            raise Exception('Invalid credentials')
+
+    @property
+    def activities(self):
+        """
+        Full list of activities to upload
+        Only used to inspect the listing, as run() streams activities
+        """
+        return list(self.load_activities(self.paths))
 
     def load_activities(self, paths):
         """
-        Load all activities files:
-        Sort out file name args given on command line.  Figure out if they are
-        fitness file names, directory names containing fitness files, or names
-        of csv file lists.
-        Also, expand file name wildcards, if necessary.  Check to see if files
-        exist and if the file extension is valid.  Build lists of fitnes
-        filenames, directories # which will be further searched for files, and
-        list files.
-        """
-
-        def is_csv(filename):
-            '''
-            check to see if file exists and that the file
-            extension is .csv
-            '''
-            extension = os.path.splitext(filename)[1].lower()
-            return extension == '.csv' and os.path.isfile(filename)
-
-        def is_activity(filename):
-            '''
-            check to see if file exists and that the extension is a
-            valid activity file accepted by GC.
-            '''
-            if not os.path.isfile(filename):
-                logger.warning("File '{}' does not exist. Skipping...".format(filename))  # noqa
-                return False
+        Lazily load all activities files, skipping the ones
+        already uploaded according to the ledger
+        """
+        contents = ContentIndex()
+        activities = self.stats.timed('discovery', find_activities(
+            paths, self.activity_name, self.activity_type, **self.scan_options
+        ))
+        if self.prep_workers > 1:
+            activities = self.prepare(activities)
+
+        for activity in activities:
+
+            if self.is_duplicate(activity, contents):
+                self.duplicates += 1
+                continue
+
+            if self.route(activity) is None:
+                logger.warning('No account found for activity file {}. Skipping...'.format(activity.path))  # noqa
+                self.invalid += 1
+                continue
+
+            if self.is_journaled(activity) or self.is_uploaded(activity):
+                self.skipped += 1
+                continue
+
+            if not self.is_valid(activity):
+                self.invalid += 1
+                continue
+
+            if self.journal is not None:
+                self.journal.write(activity, 'queued')
+            self.queued += 1
+            yield activity
+
+    def prepare(self, activities):
+        """
+        Hash & validate activity files on a pool of processes,
+        only a few ahead of the uploads, keeping input order
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        func = functools.partial(prepare_activity, check=self.validate)
+        with ProcessPoolExecutor(max_workers=self.prep_workers) as pool:
+            for activity in bounded_map(pool, func, activities,
+                                        self.prep_workers * 4):
+                yield activity
+
+    def is_duplicate(self, activity, contents):
+        """
+        Check an activity file was already listed in this run,
+        with the same content; the first one listed wins
+        """
+        original = contents.find(activity)
+        if original is None:
+            return False
+        logger.info("Activity file '{}' has the same content as '{}'. Skipping...".format(activity.path, original.path))  # noqa
 
-            # Get file extension from name
-            extension = os.path.splitext(filename)[1].lower()
-            logger.debug("File '{}' has extension '{}'".format(filename, extension))  # noqa
+        metadata = (activity.name, activity.type, activity.notes)
+        kept = (original.name, original.type, original.notes)
+        if any(metadata) and metadata != kept:
+            logger.info('Metadata name={!r} type={!r} notes={!r} dropped, keeping name={!r} type={!r} notes={!r}'.format(*(metadata + kept)))  # noqa
+        return True
 
-            # Valid file extensions are .tcx, .fit, and .gpx
-            if extension in VALID_GARMIN_FILE_EXTENSIONS:
-                logger.debug("File '{}' extension '{}' is valid track file. ".format(filename, extension))  # noqa
-                return True
-            else:
-                logger.warning("File '{}' extension '{}' is not valid track file. Skipping file...".format(filename, extension))  # noqa
-                return False
+    def is_journaled(self, activity):
+        """
+        Check the journal of a resumed run for an activity already
+        uploaded, queueing its info again when it was never set
+        """
+        if self.journal is None:
+            return False
+        entry = self.journal.get(activity.path)
+        if entry is None or entry['state'] not in UPLOADED_STATES:
+            return False
 
-        valid_paths, csv_files = [], []
-        for path in paths:
-            path = os.path.realpath(path)
-            if is_activity(path):
-                # Use file directly
-                valid_paths.append(path)
-
-            elif is_csv(path):
-                # Use file directly
-                logger.info("List file '{}' will be processed...".format(path))
-                csv_files.append(path)
-
-            elif os.path.isdir(path):
-                # Use files in directory
-                # - Does not recursively drill into directories.
-                # - Does not search for csv files in directories.
-                valid_paths += [
-                    f for f in glob.glob(os.path.join(path, '*'))
-                    if is_activity(f)
-                ]
-
-        # Activity name given on command line only applies if a single filename
-        # is given.  Otherwise, ignore.
-        if len(valid_paths) != 1 and self.activity_name:
-            logger.warning('-a option valid only when one fitness file given. Ignoring -a option.')  # noqa
-            self.activity_name = None
-
-        # Build activities from valid paths
-        activities = [
-           Activity(p, self.activity_name, self.activity_type)
-           for p in valid_paths
-        ]
-
-        # Pull in file info from csv files and apppend activities
-        for csv_file in csv_files:
-            with open(csv_file, 'r') as csvfile:
-                reader = csv.DictReader(csvfile)
-                activities += [
-                    Activity(row['filename'], row['name'], row['type'], row['notes'])
-                    for row in reader
-                    if is_activity(row['filename'])
-                ]
-
-        if len(activities) == 0:
-            raise Exception('No valid files.')
+        activity.id = entry['id']
+        has_info = activity.name or activity.type or activity.notes
+        if has_info and entry['state'] in INFO_PENDING_STATES:
+            logger.info('Activity {} uploaded without its info, setting it again'.format(activity))  # noqa
+            self.route(activity).metadata.add(activity)
         else:
-            logger.info("{} activities will be processed...".format(len(activities)))
+            logger.info('Activity {} already processed in journal. Skipping...'.format(activity))  # noqa
+        return True
 
+    def is_uploaded(self, activity):
+        """
+        Check the ledger for an activity file already uploaded
+        """
+        if self.ledger is None:
+            return False
+        entry = self.ledger.find(activity.path) \
+            or self.ledger.find_hash(activity.hash)
+        if entry is None:
+            return False
+        logger.info('Activity {} already uploaded as {}. Skipping...'.format(activity, entry['activity_id']))  # noqa
+        return True
 
-        return activities
+    def is_valid(self, activity):
+        """
+        Check an activity file is not broken, before any upload
+        """
+        if not self.validate:
+            return True
+        with self.stats.timer('validation') as timing:
+            error = activity.check(self.check_crc)
+            if error is None and activity.type:
+                error = self.check_type(activity.type)
+            timing['status'] = error is None and 'valid' or 'invalid'
+        if error is not None:
+            logger.warning('Invalid activity file {}: {}. Skipping...'.format(activity.path, error))  # noqa
+            return False
+        return True
+
+    def check_type(self, activity_type):
+        """
+        Check an activity type exists on Garmin Connect,
+        loading the types catalog on first use
+        Outputs an error for unknown types
+        """
+        if self.activity_types is None:
+            try:
+                self.activity_types = self.api.load_activity_types(
+                    self.user.session
+                )
+            except Exception as e:
+                # Types are checked again when setting activity info
+                logger.warning('Activity types could not be loaded: {}'.format(e))  # noqa
+                self.activity_types = {}
+
+        if self.activity_types and activity_type not in self.activity_types:
+            return "Activity type '{}' not valid".format(activity_type)
 
     def run(self):
         """
         Authenticated part of the workflow
         Simply login & upload every activity
         """
-        if not self.user.authenticate():
-            raise Exception('Invalid credentials')
+        # Only login once a first activity is found,
+        # or some info of a resumed run is still pending
+        activities = self.load_activities(self.paths)
+        first = next(activities, None)
+        if first is None and not self.pending_metadata():
+            if self.skipped:
+                logger.info('Nothing to upload.')
+                return
+            raise Exception('No valid files.')
+        if first is not None:
+            activities = itertools.chain([first], activities)
+
+        self.login()
+
+        def upload(activity):
+            account = self.route(activity)
+            if account.login():
+                activity.upload(account.user, account.metadata,
+                                account.retry)
+            else:
+                activity.status = 'failed'
+                activity.failure = 'Login failed on account {}'.format(account)  # noqa
+            return activity
 
-        for activity in self.activities:
-            self.rate_limit()
-            activity.upload(self.user)
+        try:
+            if self.jobs > 1:
+                # Workers share the authenticated session connections
+                # Only a few activities are listed ahead of the uploads
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    total = self.report(
+                        bounded_map(pool, upload, activities, self.jobs * 2)
+                    )
+            else:
+                total = self.report(six.moves.map(upload, activities))
+            self.apply_metadata()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            self.write_dead_letter()
+            self.report_stats()
 
-        logger.info('All done.')
+        logger.info('All done: {} activities processed, {} skipped, {} invalid, {} duplicates.'.format(total, self.skipped, self.invalid, self.duplicates))  # noqa
+
+    def set_info(self):
+        """
+        Set info of activities listed in csv files, already uploaded
+        according to the ledger, without uploading them again
+        Outputs the number of failed updates
+        """
+        if self.ledger is None:
+            raise Exception('The ledger is required to find activity ids')
+
+        for activity in find_activities(self.paths, **self.scan_options):
+            if not (activity.name or activity.type or activity.notes):
+                continue
+            entry = self.ledger.find(activity.path) \
+                or self.ledger.find_hash(activity.hash)
+            if entry is None or entry['activity_id'] is None:
+                logger.warning('Activity {} has no known id in ledger. Skipping...'.format(activity))  # noqa
+                self.skipped += 1
+                continue
+            account = self.route(activity)
+            if account is None:
+                logger.warning('No account found for activity {}. Skipping...'.format(activity))  # noqa
+                self.skipped += 1
+                continue
+            activity.id = entry['activity_id']
+            account.metadata.add(activity)
+
+        if not self.pending_metadata():
+            raise Exception('No activity to update.')
+
+        self.login()
+
+        try:
+            return self.apply_metadata()
+        finally:
+            self.report_stats()
 
-    def rate_limit(self):
-        min_period = 1
-        if not self.last_request:
-            self.last_request = 0.0
+    def apply_metadata(self):
+        """
+        Set queued activity info, then store results in ledger
+        Updates of all accounts share a pool of workers
+        Outputs the number of failed updates
+        """
+        failed = 0
+        pool = None
+        if self.jobs > 1:
+            pool = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            drained = []
+            for account in self.accounts.values():
+                if not len(account.metadata):
+                    continue
+                if not account.login():
+                    logger.warning('Login failed on account {}, {} activities info not set'.format(account, len(account.metadata)))  # noqa
+                    failed += len(account.metadata)
+                    continue
+
+                logger.info('Setting info of {} activities...'.format(len(account.metadata)))  # noqa
+                drained.append(account.metadata.drain(
+                    account.user.session, account.retry, pool
+                ))
+
+            for info in itertools.chain.from_iterable(drained):
+                logger.info('Activity info {} : {}'.format(info, info.status))  # noqa
+                failed += info.status == 'failed'
+                if self.ledger is not None:
+                    self.ledger.set_info_status(info.id, info.status)
+                if self.journal is not None:
+                    for activity in info.activities:
+                        self.journal.write(activity, 'info-' + info.status)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return failed
+
+    def watch(self, watcher):
+        """
+        Upload activities as they appear in a watched directory,
+        keeping a single authenticated session
+        """
+        if not self.user.authenticate():
+            raise Exception('Invalid credentials')
 
-        wait_time = max(0, min_period - (time.time() - self.last_request))
-        if wait_time > 0:
-            logger.info("Rate limited for %f" % wait_time)
-            time.sleep(wait_time)
+        logger.info('Watching {} for new activities...'.format(watcher.directory))  # noqa
+        try:
+            for path in watcher:
+                activity = Activity(path, None, self.activity_type)
+                if self.is_uploaded(activity) \
+                   or not self.is_valid(activity):
+                    continue
+
+                # The session may have expired while idle
+                self.queued += 1
+                if not activity.upload(self.user) \
+                   and not self.api.check_session(self.user.session):
+                    logger.info('Session expired, login again...')
+                    if not self.user.authenticate():
+                        raise Exception('Invalid credentials')
+                    activity.upload(self.user)
+
+                self.report([activity])
+        finally:
+            self.report_stats()
+
+    def report_stats(self):
+        """
+        Print the timing summary of the run, when requested
+        """
+        if self.show_stats:
+            sys.stderr.write(self.stats.table() + '\n')
+        self.stats.close()
+        if self.metrics is not None:
+            self.metrics.close()
 
-        self.last_request = time.time()
+    def write_dead_letter(self):
+        """
+        List files that failed to upload, as a CSV list file,
+        so they can be uploaded again once fixed
+        """
+        if not self.failed:
+            return
+        logger.warning('{} activities failed to upload: {}'.format(len(self.failed), ', '.join(a.path for a in self.failed)))  # noqa
+        if self.dead_letter is None:
+            return
+
+        with open(self.dead_letter, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow([
+                'filename', 'name', 'type', 'notes', 'account', 'reason',
+            ])
+            for activity in self.failed:
+                writer.writerow([
+                    os.path.realpath(activity.path), activity.name or '',
+                    activity.type or '', activity.notes or '',
+                    activity.account or '', activity.failure or '',
+                ])
+        logger.info('Failed activities listed in {}'.format(self.dead_letter))  # noqa
+
+    def report(self, activities):
+        """
+        Report uploaded activities in input order,
+        whatever the upload order was
+        """
+        total = 0
+        for activity in activities:
+            total += 1
+            self.queued -= 1
+            logger.info('{} : {}'.format(activity, activity.status))
+
+            # Store successful uploads in ledger
+            if self.ledger is not None and activity.status != 'failed':
+                self.ledger.record(activity.path, activity.hash, activity.id,
+                                   activity.info_status)
+
+            if activity.status == 'failed':
+                self.failed.append(activity)
+
+            if self.journal is not None:
+                self.journal.write(activity, activity.status,
+                                   activity.failure)
+
+                # An interrupted run may have uploaded this activity
+                # without setting its info
+                has_info = activity.name or activity.type or activity.notes
+                if activity.status == 'exists' and has_info \
+                   and self.journal.resumed:
+                    self.route(activity).metadata.add(activity)
+
+        return total
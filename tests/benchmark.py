@@ -0,0 +1,352 @@
+"""
+Offline upload benchmark, against the local Garmin Connect stand-in
+
+Generates a synthetic set of FIT, TCX & GPX activities, then uploads
+it once per upload mode, each in its own process, and reports files/s,
+MB/s, upload latency percentiles and peak memory usage:
+
+    python tests/benchmark.py --files 200 --size 100 --latency 20
+"""
+from __future__ import print_function
+import argparse
+import collections
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # noqa
+
+from garmin_uploader import logger  # noqa: E402
+from garmin_uploader.convert import convert  # noqa: E402
+from garmin_uploader.stats import percentile  # noqa: E402
+
+# Upload modes: async or not, then workflow options;
+# jobs are replaced by the --jobs value
+MODES = collections.OrderedDict([
+    ('sequential', (False, {'jobs': 1})),
+    ('threads', (False, {'jobs': None})),
+    ('gzip', (False, {'jobs': None, 'compression': 'gzip'})),
+    ('zip', (False, {'jobs': None, 'compression': 'zip'})),
+    ('convert', (False, {'jobs': None, 'convert': True})),
+    ('prep', (False, {'jobs': None,
+                      'prep_workers': multiprocessing.cpu_count()})),
+    ('async', (True, {'jobs': None})),
+])
+
+FORMATS = ('fit', 'tcx', 'gpx')
+
+START = 1577869200  # 2020-01-01T09:00:00Z
+
+TCX_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities>
+    <Activity Sport="Running">
+      <Id>{start}</Id>
+      <Lap StartTime="{start}">
+        <TotalTimeSeconds>{duration}</TotalTimeSeconds>
+        <DistanceMeters>{distance:.1f}</DistanceMeters>
+        <Calories>{calories}</Calories>
+        <Intensity>Active</Intensity>
+        <TriggerMethod>Manual</TriggerMethod>
+        <Track>
+'''  # noqa
+TCX_POINT = '''          <Trackpoint>
+            <Time>{time}</Time>
+            <Position>
+              <LatitudeDegrees>{lat:.7f}</LatitudeDegrees>
+              <LongitudeDegrees>{lon:.7f}</LongitudeDegrees>
+            </Position>
+            <AltitudeMeters>{ele:.1f}</AltitudeMeters>
+            <DistanceMeters>{distance:.1f}</DistanceMeters>
+            <HeartRateBpm><Value>{hr}</Value></HeartRateBpm>
+            <Cadence>{cad}</Cadence>
+          </Trackpoint>
+'''
+TCX_FOOTER = '''        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+GPX_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1"
+  xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
+  <metadata><time>{start}</time></metadata>
+  <trk>
+    <type>cycling</type>
+    <trkseg>
+'''  # noqa
+GPX_POINT = '''      <trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele>
+        <time>{time}</time>
+        <extensions><power>{power}</power><gpxtpx:TrackPointExtension>
+          <gpxtpx:hr>{hr}</gpxtpx:hr><gpxtpx:cad>{cad}</gpxtpx:cad>
+        </gpxtpx:TrackPointExtension></extensions>
+      </trkpt>
+'''  # noqa
+GPX_FOOTER = '''    </trkseg>
+  </trk>
+</gpx>
+'''
+
+
+def iso_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def track(seed, points):
+    """
+    Synthetic track points, one per second, different for every seed
+    """
+    start = START + seed * 86400
+    for i in range(points):
+        yield {
+            'time': iso_time(start + i),
+            'lat': 45.0 + seed * 0.01 + i * 1e-5,
+            'lon': 5.7 + i * 2e-5,
+            'ele': 200 + (i % 300) / 10.0,
+            'distance': i * 3.0,
+            'hr': 120 + i % 40,
+            'cad': 80 + i % 10,
+            'power': 150 + i % 100,
+        }
+
+
+def write_activity(path, fmt, seed, points):
+    """
+    Write a synthetic activity, FIT files being converted from TCX
+    """
+    if fmt == 'fit':
+        tcx = path[:-4] + '.tcx'
+        write_activity(tcx, 'tcx', seed, points)
+        try:
+            with open(path, 'w+b') as output:
+                convert(tcx, output)
+        finally:
+            os.remove(tcx)
+        return
+
+    start = iso_time(START + seed * 86400)
+    header, point, footer = {
+        'tcx': (TCX_HEADER, TCX_POINT, TCX_FOOTER),
+        'gpx': (GPX_HEADER, GPX_POINT, GPX_FOOTER),
+    }[fmt]
+    with open(path, 'w') as f:
+        f.write(header.format(start=start, duration=points,
+                              distance=points * 3.0, calories=points // 10))
+        for values in track(seed, points):
+            f.write(point.format(**values))
+        f.write(footer)
+
+
+def point_size(fmt):
+    """
+    Approximate size of a track point, in bytes
+    """
+    if fmt == 'fit':
+        return 30
+    template = fmt == 'tcx' and TCX_POINT or GPX_POINT
+    return len(template.format(**next(track(0, 1))))
+
+
+def generate(directory, files, size, formats=FORMATS):
+    """
+    Generate a set of activities, of about size kilobytes each,
+    cycling through formats
+    Outputs their paths
+    """
+    paths = []
+    for i in range(files):
+        fmt = formats[i % len(formats)]
+        path = os.path.join(directory, 'activity-{:05d}.{}'.format(i, fmt))
+        write_activity(path, fmt, i, max(1, size * 1024 // point_size(fmt)))
+        paths.append(path)
+    return paths
+
+
+def peak_rss():
+    """
+    Peak resident memory of the current process, in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1e6  # bytes
+    return peak / 1e3  # kilobytes
+
+
+def run_mode(mode, directory, jobs, results):
+    """
+    Upload a directory with an upload mode, in a child process
+    """
+    from garmin_uploader.workflow import Workflow
+
+    asynchronous, options = MODES[mode]
+    options = dict(options)
+    options['jobs'] = options['jobs'] or jobs
+    options.update(
+        username='standin', password='standin', session_cache=False,
+        ledger=False, rate=1e6, burst=10 ** 6, verbose=5,
+    )
+
+    # Only records of uploads & retries are needed
+    records = collections.defaultdict(list)
+
+    def collect(entry):
+        if entry['stage'] in ('upload', 'rate-limit'):
+            records[entry['stage']].append(entry)
+
+    start = time.time()
+    try:
+        if asynchronous:
+            import asyncio
+            from garmin_uploader.aio import AsyncWorkflow
+            workflow = AsyncWorkflow([directory], **options)
+            workflow.stats.hooks.append(collect)
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(workflow.run())
+            finally:
+                loop.close()
+        else:
+            workflow = Workflow([directory], **options)
+            workflow.stats.hooks.append(collect)
+            workflow.run()
+    except Exception as e:
+        results.put({'mode': mode, 'error': str(e)})
+        return
+    elapsed = time.time() - start
+
+    uploads = records['upload']
+    durations = sorted(r['duration'] for r in uploads)
+    sent = [r for r in uploads if r['status'] != 'failed']
+    results.put(collections.OrderedDict([
+        ('mode', mode),
+        ('files', len(sent)),
+        ('duplicates', len([r for r in sent if r['status'] == 'exists'])),
+        ('failed', len(uploads) - len(sent)),
+        ('retries', len([
+            r for r in records['rate-limit'] if r.get('reason')
+        ])),
+        ('files/s', len(sent) / elapsed),
+        ('MB/s', sum(r['bytes'] for r in sent) / 1e6 / elapsed),
+        ('p50', percentile(durations, 50)),
+        ('p99', percentile(durations, 99)),
+        ('rss', peak_rss()),
+    ]))
+
+
+def benchmark(standin, directory, modes=tuple(MODES), jobs=4,
+              duplicates=()):
+    """
+    Upload a directory once per mode, against a running stand-in
+    Each mode runs in a forked process, to measure its own peak memory
+    Duplicates are activities already uploaded before each mode
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing  # always forks on Python 2
+    results = []
+    for mode in modes:
+        # Every mode starts from the same account
+        with standin.lock:
+            standin.uploads.clear()
+        for path in duplicates:
+            standin.preload(path)
+        queue = context.Queue()
+        process = context.Process(target=run_mode,
+                                  args=(mode, directory, jobs, queue))
+        process.start()
+        process.join()
+        try:
+            results.append(queue.get(timeout=5))
+        except Empty:
+            results.append({
+                'mode': mode,
+                'error': 'exit code {}'.format(process.exitcode),
+            })
+    return results
+
+
+def report(results):
+    """
+    Print results as a table
+    """
+    header = ['mode', 'files', 'duplicates', 'failed', 'retries',
+              'files/s', 'MB/s', 'p50 (s)', 'p99 (s)', 'peak RSS (MB)']
+    rows = [header]
+    for result in results:
+        if 'error' in result:
+            rows.append([result['mode'], 'error: {}'.format(result['error'])])
+            continue
+        rows.append([
+            result['mode'], str(result['files']),
+            str(result['duplicates']), str(result['failed']),
+            str(result['retries']), '{:.1f}'.format(result['files/s']),
+            '{:.2f}'.format(result['MB/s']), '{:.3f}'.format(result['p50']),
+            '{:.3f}'.format(result['p99']), '{:.1f}'.format(result['rss']),
+        ])
+    widths = [max(len(r[i]) for r in rows if len(r) > i)
+              for i in range(len(header))]
+    for row in rows:
+        print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=100,
+                        help='Number of activities (default: 100)')
+    parser.add_argument('--size', type=int, default=50,
+                        help='Approximate size of TCX & GPX activities, in'
+                             ' kilobytes (default: 50)')
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='Activity formats (default: fit,tcx,gpx)')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='Ratio of activities already uploaded')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Upload modes (default: all)')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Concurrent uploads (default: 4)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Stand-in response latency, in milliseconds')
+    parser.add_argument('--throttle', type=int, default=None,
+                        help='Answer every n-th upload with a 429')
+    args = parser.parse_args()
+
+    from standin import GarminStandIn
+    import pytest
+
+    modes = args.modes.split(',')
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error('Unknown modes: {}'.format(', '.join(sorted(unknown))))
+
+    logger.setLevel(50)
+    directory = tempfile.mkdtemp(prefix='gupload-benchmark-')
+    standin = GarminStandIn()
+    standin.latency = args.latency / 1000.0
+    standin.throttle_every = args.throttle
+    try:
+        paths = generate(directory, args.files, args.size,
+                         tuple(args.formats.split(',')))
+        duplicates = paths[:int(len(paths) * args.duplicates)]
+        standin.start()
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            standin.patch(monkeypatch)
+            report(benchmark(standin, directory, modes, args.jobs,
+                             duplicates))
+    finally:
+        standin.stop()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
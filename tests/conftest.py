@@ -1,5 +1,16 @@
 import pytest
 import os
+import sys
+import tempfile
+
+# Async uploads need Python 3.5+ syntax
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_aio.py')
+
+# Never use the real user cache (session, ledger) in tests
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
+os.environ['LOCALAPPDATA'] = os.environ['XDG_CACHE_HOME']
 
 
 @pytest.fixture(scope='session')
@@ -25,9 +36,33 @@ def user():
 
 
 @pytest.fixture(scope='session')
-def activities_dir(tmpdir_factory):
+def fit_content():
+    """
+    Minimal valid FIT file: header and CRCs, without records
+    """
+    import struct
+    from garmin_uploader.validate import fit_crc
+    header = struct.pack('<BBHI4s', 14, 0x20, 2093, 0, b'.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    return header + struct.pack('<H', fit_crc(header))
+
+
+@pytest.fixture(scope='session')
+def tcx_content():
     """
-    Build empty activities file
+    Minimal valid TCX file, without activities
+    """
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">'  # noqa
+        '<Activities/></TrainingCenterDatabase>\n'
+    )
+
+
+@pytest.fixture(scope='session')
+def activities_dir(tmpdir_factory, fit_content, tcx_content):
+    """
+    Build minimal activities file
     Used to test cli listing functions
     """
     workdir = tmpdir_factory.mktemp('activities')
@@ -42,11 +77,11 @@ def activities_dir(tmpdir_factory):
 
     # Build a fit file
     fit = workdir.join('a.fit')
-    fit.write('')
+    fit.write_binary(fit_content)
 
     # Build a tcx file
     tcx = workdir.join('a.tcx')
-    tcx.write('')
+    tcx.write(tcx_content)
 
     # Build an invalid file
     invalid = workdir.join('invalid.txt')
@@ -67,3 +102,39 @@ def sample_activity():
     from garmin_uploader.workflow import Activity
     tcx = os.path.join(os.path.dirname(__file__), 'sample_file.tcx')
     return Activity(str(tcx), 'Test upload', 'running')
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """
+    Local Garmin Connect stand-in server,
+    used instead of the real service by the api module
+    """
+    from standin import GarminStandIn
+    from garmin_uploader.api import GarminAPI
+
+    server = GarminStandIn()
+    server.start()
+    server.patch(monkeypatch)
+    monkeypatch.setattr(GarminAPI, 'activity_types', None)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def logged_in(standin, monkeypatch):
+    """
+    Skip the Garmin Connect login: users get a stand-in session,
+    tagged with their username, outputs the list of logged users
+    """
+    from garmin_uploader.user import User
+
+    users = []
+
+    def login(user):
+        users.append(user)
+        user.session = standin.session()
+        user.session.headers['X-Account'] = user.username
+        return 'login'
+    monkeypatch.setattr(User, 'login', login)
+    return users
@@ -0,0 +1,83 @@
+"""
+FIT decoder, only used to check files written by garmin_uploader.convert
+"""
+import struct
+from garmin_uploader.convert import (
+    BASE_TYPES, HEADER_SIZE, MESSAGES, ConversionError,
+)
+
+# Struct formats of all base type numbers, to read any FIT file
+BASE_FORMATS = {
+    0x00: 'B', 0x01: 'b', 0x02: 'B', 0x83: 'h', 0x84: 'H', 0x85: 'i',
+    0x86: 'I', 0x88: 'f', 0x89: 'd', 0x0A: 'B', 0x8B: 'H', 0x8C: 'I',
+    0x8E: 'q', 0x8F: 'Q', 0x90: 'Q',
+}
+
+
+def read_fit(path):
+    """
+    Decode messages of a FIT file, with normal record headers
+    Yields (global message number, {field number: raw value})
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        header_size = bytearray(header[:1])[0]
+        data_size, = struct.unpack('<I', header[4:8])
+        f.seek(header_size)
+        end = header_size + data_size
+
+        definitions = {}
+        while f.tell() < end:
+            record, = bytearray(f.read(1))
+            if record & 0x80:
+                raise ConversionError('Compressed timestamp headers are not supported')  # noqa
+            local = record & 0x0F
+            if record & 0x40:
+                reserved, architecture, number, count = struct.unpack('<BBHB', f.read(5))  # noqa
+                endian = architecture and '>' or '<'
+                if architecture:
+                    number, = struct.unpack('>H', struct.pack('<H', number))
+                fields = [
+                    struct.unpack('BBB', f.read(3)) for i in range(count)
+                ]
+                if record & 0x20:
+                    # Developer fields are skipped
+                    developer, = bytearray(f.read(1))
+                    for i in range(developer):
+                        size = bytearray(f.read(3))[1]
+                        fields.append((None, size, None))
+                definitions[local] = (number, endian, fields)
+                continue
+
+            number, endian, fields = definitions[local]
+            values = {}
+            for field, size, base in fields:
+                data = f.read(size)
+                fmt = BASE_FORMATS.get(base)
+                if field is None:
+                    continue
+                if fmt is not None and struct.calcsize(fmt) == size:
+                    values[field], = struct.unpack(endian + fmt, data)
+                else:
+                    values[field] = data
+            yield number, values
+
+
+def read_messages(path):
+    """
+    Decode the messages of a FIT file written by garmin_uploader.convert
+    Yields (message name, {field name: value}), without invalid values
+    """
+    names = dict((number, name) for name, (number, _) in MESSAGES.items())
+    for number, raw in read_fit(path):
+        name = names.get(number)
+        if name is None:
+            continue
+        fields = MESSAGES[name][1]
+        values = {}
+        for field, (field_number, base_type, scale, offset) in fields.items():  # noqa
+            value = raw.get(field_number)
+            if value is None or value == BASE_TYPES[base_type][2]:
+                continue
+            values[field] = float(value) / scale - offset
+        yield name, values
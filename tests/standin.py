@@ -0,0 +1,295 @@
+"""
+Local stand-in for the Garmin Connect endpoints used by garmin_uploader.api
+Runs an HTTP server in a background thread
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import zipfile
+try:
+    from email.parser import BytesParser
+except ImportError:
+    # Python 2 parser reads bytes strings
+    from email.parser import Parser
+
+    class BytesParser(Parser):
+        parsebytes = Parser.parsestr
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote_plus
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote_plus
+
+ACTIVITY_TYPES = [
+    {'typeId': 1, 'typeKey': 'running', 'parentTypeId': 17},
+    {'typeId': 2, 'typeKey': 'cycling', 'parentTypeId': 17},
+    {'typeId': 17, 'typeKey': 'all', 'parentTypeId': None},
+]
+
+SESSION_COOKIE = 'SESSIONID'
+SSO_COOKIE = 'GARMIN-SSO-GUID'
+TYPES_ETAG = '"types-v1"'
+CSRF_TOKEN = 'standincsrf'
+LOGIN_FORM = '<form><input type="hidden" name="_csrf" value="{}" /></form>'.format(CSRF_TOKEN)  # noqa
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Route requests to the stand-in endpoints
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_body(body, 'application/json', status, headers)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        if self.server.standin.latency:
+            time.sleep(self.server.standin.latency)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def is_logged(self):
+        return SESSION_COOKIE in (self.headers.get('Cookie') or '')
+
+    def do_GET(self):
+        standin = self.server.standin
+        standin.requests.append(('GET', self.path, self.headers))
+        path = self.path.split('?')[0]
+
+        # SSO login flow
+        if path == '/modern/auth/hostname':
+            return self.send_json({'host': standin.url})
+        if path == '/sso/login':
+            return self.send_body(LOGIN_FORM.encode('utf-8'), 'text/html')
+        if path == '/modern/':
+            if SSO_COOKIE not in (self.headers.get('Cookie') or ''):
+                return self.send_json({}, 401)
+            cookie = '{}=standin; Path=/'.format(SESSION_COOKIE)
+            return self.send_body(b'', 'text/html',
+                                  headers={'Set-Cookie': cookie})
+
+        if self.path == '/modern/currentuser-service/user/info':
+            if not self.is_logged():
+                return self.send_json({}, 401)
+            return self.send_json({'username': 'standin'})
+
+        if self.path == '/modern/proxy/activity-service/activity/activityTypes':  # noqa
+            if self.headers.get('If-None-Match') == TYPES_ETAG:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_json(ACTIVITY_TYPES, headers={'ETag': TYPES_ETAG})  # noqa
+
+        self.send_json({}, 404)
+
+    def do_POST(self):
+        standin = self.server.standin
+        standin.requests.append(('POST', self.path, self.headers))
+        body = self.read_body()
+        standin.bodies.append(body)
+
+        # Injected errors
+        if standin.errors:
+            return self.send_json({}, standin.errors.pop(0))
+
+        if self.path.split('?')[0] == '/sso/login':
+            return self.login(body)
+
+        if not self.is_logged():
+            return self.send_json({}, 403)
+
+        if self.path.startswith('/modern/proxy/upload-service/upload/'):
+            # Throttle every few uploads
+            with standin.lock:
+                standin.upload_requests += 1
+                throttled = standin.throttle_every \
+                    and standin.upload_requests % standin.throttle_every == 0  # noqa
+            if throttled:
+                return self.send_json({}, 429, headers={'Retry-After': '0'})
+
+            if self.headers.get('Content-Encoding') == 'gzip':
+                if not standin.accept_gzip:
+                    return self.send_json({}, 415)
+                body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+            return self.upload(body)
+
+        match = re.match(r'^/modern/proxy/activity-service/activity/(\d+)$', self.path)  # noqa
+        if match:
+            payload = json.loads(body.decode('utf-8'))
+            standin.infos.setdefault(int(match.group(1)), {}).update(payload)
+            return self.send_json({})
+
+        self.send_json({}, 404)
+
+    def login(self, body):
+        """
+        Check credentials posted on the SSO login form
+        """
+        standin = self.server.standin
+        form = dict(
+            pair.split('=', 1)
+            for pair in body.decode('utf-8').split('&') if '=' in pair
+        )
+        password = standin.credentials.get(unquote_plus(form.get('username', '')))  # noqa
+        if form.get('_csrf') != CSRF_TOKEN or password is None \
+           or password != unquote_plus(form.get('password', '')):
+            return self.send_body(b'Invalid credentials', 'text/html', 401)
+        standin.logins += 1
+        cookie = '{}=standin; Path=/'.format(SSO_COOKIE)
+        return self.send_body(b'', 'text/html',
+                              headers={'Set-Cookie': cookie})
+
+    def upload(self, body):
+        """
+        Store an uploaded file, detecting duplicates by content
+        """
+        standin = self.server.standin
+        message = BytesParser().parsebytes(
+            'Content-Type: {}\r\n\r\n'.format(self.headers['Content-Type']).encode('utf-8') + body  # noqa
+        )
+        part = message.get_payload()[0]
+        content = part.get_payload(decode=True)
+        filename = part.get_filename()
+        if self.path.endswith('/.zip'):
+            if not standin.accept_zip:
+                return self.send_json({}, 415)
+            archive = zipfile.ZipFile(io.BytesIO(content))
+            filename = archive.namelist()[0]
+            content = archive.read(filename)
+        digest = hashlib.sha1(content).hexdigest()
+
+        with standin.lock:
+            duplicate = digest in standin.uploads
+            if not duplicate:
+                standin.store(filename, content)
+            activity_id = standin.uploads[digest]['id']
+            lost = not duplicate and standin.lost > 0
+            if lost:
+                standin.lost -= 1
+        if lost:
+            return self.send_json({}, 502)
+
+        if duplicate:
+            return self.send_json({'detailedImportResult': {
+                'successes': [],
+                'failures': [{
+                    'internalId': activity_id,
+                    'messages': [{'code': 202, 'content': 'Duplicate'}],
+                }],
+            }}, 409)
+        return self.send_json({'detailedImportResult': {
+            'successes': [{'internalId': activity_id}],
+            'failures': [],
+        }}, 201)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class GarminStandIn(object):
+    """
+    Garmin Connect stand-in server
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.bodies = []
+        self.errors = []
+        self.uploads = {}
+        self.infos = {}
+        self.next_id = 1000
+        self.accept_gzip = True
+        self.accept_zip = True
+
+        # Accounts accepted by the SSO login
+        self.credentials = {'standin': 'standin'}
+        self.logins = 0
+
+        # Delay of every response, in seconds
+        self.latency = 0.0
+
+        # Answer every n-th upload request with a 429
+        self.throttle_every = None
+        self.upload_requests = 0
+
+        # Store the next n new uploads, but answer them with a 502,
+        # as when a response is lost after Garmin accepted a file
+        self.lost = 0
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.standin = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def store(self, filename, content):
+        """
+        Store an uploaded activity, outputs its id
+        """
+        self.next_id += 1
+        self.uploads[hashlib.sha1(content).hexdigest()] = {
+            'id': self.next_id,
+            'filename': filename,
+            'content': content,
+        }
+        return self.next_id
+
+    def preload(self, path):
+        """
+        Store an activity file as already uploaded,
+        so its uploads are answered as duplicates
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+        with self.lock:
+            return self.store(os.path.basename(path), content)
+
+    def patch(self, monkeypatch):
+        """
+        Point the api endpoints profile to this server
+        """
+        from garmin_uploader.endpoints import ENV_CONNECT, ENV_SSO
+        monkeypatch.setenv(ENV_CONNECT, self.url)
+        monkeypatch.setenv(ENV_SSO, self.url)
+
+    def session(self):
+        """
+        Build a requests session, logged in on this server
+        """
+        import requests
+        session = requests.Session()
+        session.cookies.set(SESSION_COOKIE, 'standin', domain='127.0.0.1')
+        return session
@@ -0,0 +1,116 @@
+def write_config(tmpdir, monkeypatch, credentials=True):
+    """
+    Write a config file with two named accounts,
+    in a working directory
+    """
+    from garmin_uploader import CONFIG_FILE
+
+    lines = [
+        '[Account alice]',
+        'username=alice@example.com',
+        'password=secret',
+        'directories={}'.format(tmpdir.join('alice')),
+        '[Account bob]',
+        'username=bob@example.com',
+        'password=secret',
+    ]
+    if credentials:
+        lines += ['[Credentials]', 'username=coach', 'password=secret']
+    tmpdir.join(CONFIG_FILE).write('\n'.join(lines))
+    monkeypatch.chdir(str(tmpdir))
+
+
+def test_load_accounts(tmpdir, monkeypatch):
+    """
+    Test named accounts are read from the config file
+    """
+    from garmin_uploader.user import load_accounts, load_config
+
+    write_config(tmpdir, monkeypatch)
+    config, _ = load_config()
+    assert load_accounts(config) == [
+        ('alice', 'alice@example.com', 'secret', [str(tmpdir.join('alice'))]),  # noqa
+        ('bob', 'bob@example.com', 'secret', []),
+    ]
+    assert load_accounts(None) == []
+
+
+def test_route(tmpdir, monkeypatch):
+    """
+    Test activities are routed by csv column, then directory,
+    then to the default account
+    """
+    from garmin_uploader.workflow import Activity, Workflow
+
+    write_config(tmpdir, monkeypatch)
+    w = Workflow([], accounts=True, session_cache=False, ledger=False)
+    assert list(w.accounts) == ['alice', 'bob', None]
+    assert w.user.username == 'coach'
+
+    # Each account has its own rate limiter bucket
+    limiters = set(id(a.user.api.limiter) for a in w.accounts.values())
+    assert len(limiters) == 3
+
+    def route(path, account=None):
+        activity = Activity(str(path), account=account)
+        return w.route(activity).name
+
+    assert route(tmpdir.join('alice', 'run.fit')) == 'alice'
+    assert route(tmpdir.join('alice', 'sub', 'run.fit')) == 'alice'
+    assert route(tmpdir.join('alicia', 'run.fit')) is None  # default
+    assert route(tmpdir.join('alice', 'run.fit'), 'bob') == 'bob'
+    assert w.route(Activity('run.fit', account='carol')) is None
+
+    # Without accounts routing, every file uses the default account
+    w = Workflow([], session_cache=False, ledger=False)
+    assert w.route(Activity('run.fit', account='carol')) is w.account
+    csv = tmpdir.join('list.csv')
+    csv.write('filename,account\n{},carol\n'.format(tmpdir.join('run.fit')))
+    tmpdir.join('run.fit').write('')
+    w = Workflow([str(csv)], session_cache=False, ledger=False,
+                 validate=False)
+    assert [a.filename for a in w.activities] == ['run.fit']
+    assert w.invalid == 0
+
+    # Without default credentials, unrouted files have no account
+    write_config(tmpdir, monkeypatch, credentials=False)
+    w = Workflow([], accounts=True, session_cache=False, ledger=False)
+    assert list(w.accounts) == ['alice', 'bob']
+    assert w.route(Activity(str(tmpdir.join('run.fit')))) is None
+
+
+def test_multi_account_run(standin, logged_in, tmpdir, monkeypatch,
+                           fit_content):
+    """
+    Test a run uploads activities with the session of their account,
+    logging in each account once
+    """
+    from garmin_uploader.workflow import Workflow
+
+    write_config(tmpdir, monkeypatch, credentials=False)
+    tmpdir.mkdir('alice')
+    tmpdir.join('alice', 'a.fit').write_binary(fit_content)
+    tmpdir.join('alice', 'b.fit').write_binary(fit_content * 2)
+    tmpdir.join('c.fit').write_binary(fit_content * 3)
+    tmpdir.join('d.fit').write_binary(fit_content * 4)
+    tmpdir.join('list.csv').write('\n'.join([
+        'filename,name,type,notes,account',
+        '{},Bob run,,,bob'.format(tmpdir.join('c.fit')),
+        '{},,,,'.format(tmpdir.join('d.fit')),
+    ]))
+
+    w = Workflow([str(tmpdir.join('alice')), str(tmpdir.join('list.csv'))],
+                 accounts=True, session_cache=False, ledger=False, jobs=2)
+    w.run()
+    logins = sorted(user.username for user in logged_in)
+    assert logins == ['alice@example.com', 'bob@example.com']
+    assert w.invalid == 1  # d.fit has no account
+
+    uploads = [
+        headers['X-Account'] for method, path, headers in standin.requests
+        if method == 'POST' and '/upload-service/' in path
+    ]
+    assert sorted(uploads) == [
+        'alice@example.com', 'alice@example.com', 'bob@example.com',
+    ]
+    assert len(standin.infos) == 1
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import pytest
+import threading
+
+pytest.importorskip('aiohttp')
+
+
+def run(coroutine):
+    """
+    Run a coroutine on a new event loop,
+    as asyncio.run does on Python 3.7+
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_api(standin, sample_activity):
+    """
+    Test async upload and info update on local stand-in
+    """
+    from garmin_uploader.aio import AsyncGarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    async def upload():
+        api = AsyncGarminAPI(RateLimiter(rate=100, burst=10))
+        async with api.create_session(standin.session()) as session:
+            activity = Activity(sample_activity.path, 'Async', 'cycling')
+            activity.id, uploaded = await api.upload_activity(session, activity)  # noqa
+            assert uploaded
+            await api.set_activity_info(session, activity)
+
+            # Second upload is a duplicate
+            duplicate = Activity(sample_activity.path)
+            assert await api.upload_activity(session, duplicate) == (activity.id, False)  # noqa
+            return activity
+
+    activity = run(upload())
+    assert standin.infos[activity.id]['activityName'] == 'Async'
+    assert standin.infos[activity.id]['activityTypeDTO']['typeKey'] == 'cycling'  # noqa
+    upload = list(standin.uploads.values())[0]
+    assert upload['filename'] == 'sample_file.tcx'
+    with open(sample_activity.path, 'rb') as f:
+        assert upload['content'] == f.read()
+
+
+def test_async_workflow(standin, logged_in, tmpdir, monkeypatch):
+    """
+    Test async workflow uploads all activities, in input order
+    """
+    from garmin_uploader.aio import AsyncWorkflow
+
+    for i in range(6):
+        tmpdir.join('{}.gpx'.format(i)).write('<gpx>{}</gpx>'.format(i))
+    tmpdir.join('copy.gpx').write('<gpx>0</gpx>')
+
+    reported = []
+    workflow = AsyncWorkflow([str(tmpdir)], jobs=3, rate=100, burst=10,
+                             username='test', password='test',
+                             ledger=str(tmpdir.join('ledger.db')))
+    monkeypatch.setattr(
+        workflow, 'report',
+        lambda activities: reported.extend(activities) or len(activities),
+    )
+    records = []
+    workflow.stats.hooks.append(records.append)
+
+    # Files are listed off the event loop thread
+    listing = set()
+    load_activities = workflow.load_activities
+
+    def load(paths):
+        for activity in load_activities(paths):
+            listing.add(threading.current_thread())
+            yield activity
+    monkeypatch.setattr(workflow, 'load_activities', load)
+
+    run(workflow.run())
+    assert listing and threading.current_thread() not in listing
+
+    # Copy is detected locally, before upload
+    assert [a.filename for a in reported] == [
+        '0.gpx', '1.gpx', '2.gpx', '3.gpx', '4.gpx', '5.gpx'
+    ]
+    assert [a.status for a in reported] == ['uploaded'] * 6
+    assert len(standin.uploads) == 6
+    assert workflow.duplicates == 1
+
+    # Requests are timed in the workflow stats
+    assert len([r for r in records if r['stage'] == 'http']) >= 6
+
+
+def test_async_upload_stream(standin, tmpdir):
+    """
+    Test async uploads are streamed, and sent again on retry
+    """
+    from garmin_uploader.aio import AsyncGarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    content = os.urandom(200 * 1024)
+    path = tmpdir.join('activity.fit')
+    path.write_binary(content)
+
+    async def upload():
+        api = AsyncGarminAPI(RateLimiter(rate=100, burst=10))
+        async with api.create_session(standin.session()) as session:
+            return await api.upload_activity(session, Activity(str(path)))
+
+    standin.errors = [503]
+    activity_id, uploaded = run(upload())
+    assert uploaded
+
+    failed, sent = standin.bodies
+    assert failed == sent
+    headers = standin.requests[-1][2]
+    assert int(headers['Content-Length']) == len(sent)
+    assert list(standin.uploads.values())[0]['content'] == content
+
+
+def test_async_resume(standin, logged_in, tmpdir, fit_content):
+    """
+    Test an async run is journaled & resumed like a threaded one
+    """
+    import json
+    from garmin_uploader.aio import AsyncWorkflow
+
+    rows = ['filename,name,type']
+    for i, name in enumerate(['a.fit', 'b.fit']):
+        tmpdir.join(name).write_binary(fit_content * (i + 1))
+        rows.append('{},{},running'.format(tmpdir.join(name), name.upper()))
+    csv = tmpdir.join('list.csv')
+    csv.write('\n'.join(rows))
+
+    # Interrupted run: a uploaded without info
+    journal = tmpdir.join('run.journal')
+    journal.write(json.dumps({
+        'path': str(tmpdir.join('a.fit')), 'state': 'uploaded', 'id': 1,
+    }) + '\n')
+
+    w = AsyncWorkflow([str(csv)], username='test', password='test',
+                      ledger=False, journal=str(journal))
+    run(w.run())
+    assert w.journal.file.closed
+    assert sorted(standin.infos) == [1, 1001]
+    assert standin.infos[1]['activityName'] == 'A.FIT'
+    assert standin.infos[1001]['activityName'] == 'B.FIT'
+
+    with open(str(journal)) as f:
+        states = dict(
+            (e['path'].rsplit('/', 1)[1], e['state'])
+            for e in map(json.loads, f)
+        )
+    assert states == {'a.fit': 'info-set', 'b.fit': 'info-set'}
+
+
+def test_async_dead_letter(standin, logged_in, tmpdir, fit_content):
+    """
+    Test failed async uploads are listed in a dead letter file,
+    and unsupported options are rejected
+    """
+    import csv
+    from garmin_uploader.aio import AsyncWorkflow
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    tmpdir.join('b.fit').write_binary(fit_content * 2)
+    dead_letter = str(tmpdir.join('failed.csv'))
+    standin.errors = [400, 400]
+
+    w = AsyncWorkflow([str(tmpdir)], jobs=1, username='test',
+                      password='test', ledger=False, dead_letter=dead_letter)
+    run(w.run())
+    assert [a.filename for a in w.failed] == ['a.fit', 'b.fit']
+    with open(dead_letter) as f:
+        rows = list(csv.DictReader(f))
+    assert [r['filename'] for r in rows] == \
+        [str(tmpdir.join('a.fit')), str(tmpdir.join('b.fit'))]
+    assert all('status 400' in r['reason'] for r in rows)
+
+    for option in ('compression', 'convert'):
+        with pytest.raises(Exception, match='do not support ' + option):
+            AsyncWorkflow([str(tmpdir)], ledger=False,
+                          **{option: option == 'convert' or 'gzip'})
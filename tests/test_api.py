@@ -29,3 +29,50 @@ def test_rename(api, user, sample_activity):
 
     # Cleanup
     sample_activity.id = None
+
+
+def test_transport(standin):
+    """
+    Test sessions pool connections for parallel uploads,
+    and requests time out on stalled connections
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+
+    api = GarminAPI(RateLimiter(rate=100, burst=10), pool_size=16,
+                    timeout=(1, 2))
+    session = api.create_session()
+    for adapter in session.adapters.values():
+        assert adapter.poolmanager.connection_pool_kw['maxsize'] == 16
+
+    timeouts = []
+
+    class Session(object):
+        def request(self, method, url, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            return type('Response', (), {'status_code': 200})()
+
+    api.request(Session(), 'GET', 'http://test')
+    api.request(Session(), 'GET', 'http://test', timeout=5)
+    assert timeouts == [(1, 2), 5]
+
+    # Anonymous calls share a single session
+    api.create_session = standin.session
+    assert api.shared_session() is api.shared_session()
+    assert 'running' in api.load_activity_types()
+
+
+def test_login(standin):
+    """
+    Test the whole SSO login flow, against the stand-in
+    """
+    from garmin_uploader.user import User
+
+    user = User('standin', 'standin', session_cache=False)
+    assert user.authenticate()
+    assert standin.logins == 1
+    assert user.api.check_session(user.session)
+
+    user = User('standin', 'wrong', session_cache=False)
+    assert not user.authenticate()
+    assert standin.logins == 1
@@ -0,0 +1,27 @@
+def test_benchmark(standin, tmpdir):
+    """
+    Test the benchmark uploads a synthetic set of activities
+    with each mode, reporting duplicates & retries
+    """
+    import sys
+    from benchmark import benchmark, generate
+
+    paths = generate(str(tmpdir), 6, 4)
+    assert sorted(p[-3:] for p in paths) == ['fit', 'fit', 'gpx', 'gpx', 'tcx', 'tcx']  # noqa
+    standin.throttle_every = 4
+
+    # Async uploads need Python 3.5+
+    modes = ('sequential', 'prep')
+    if sys.version_info >= (3, 5):
+        modes += ('async', )
+    results = benchmark(standin, str(tmpdir), modes, jobs=2,
+                        duplicates=paths[:2])
+    assert tuple(r['mode'] for r in results) == modes
+    for result in results:
+        assert result['files'] == 6
+        assert result['duplicates'] == 2
+        assert result['failed'] == 0
+        assert result['retries'] >= 1
+        assert result['files/s'] > 0
+        assert result['p50'] <= result['p99']
+        assert result['rss'] > 0
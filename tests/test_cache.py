@@ -0,0 +1,101 @@
+import requests
+
+
+def test_session_cache(tmpdir):
+    """
+    Test session cookies are stored and restored from disk
+    """
+    from garmin_uploader.cache import SessionCache
+
+    session = requests.Session()
+    session.headers['User-Agent'] = 'gupload-test'
+    session.cookies.set('GARMIN-SSO-GUID', 'abcd', domain='.garmin.com')
+    session.cookies.set('SESSIONID', '1234', domain='connect.garmin.com')
+
+    cache = SessionCache('test@example.com', str(tmpdir.join('cache')))
+    assert not cache.load(requests.Session())
+    cache.save(session)
+
+    restored = requests.Session()
+    assert cache.load(restored)
+    assert restored.headers['User-Agent'] == 'gupload-test'
+    assert restored.cookies.get('GARMIN-SSO-GUID', domain='.garmin.com') == 'abcd'  # noqa
+    assert restored.cookies.get('SESSIONID') == '1234'
+
+    # Another user can't use that cache
+    other = SessionCache('other@example.com', str(tmpdir.join('cache')))
+    assert other.path != cache.path
+    assert not other.load(requests.Session())
+
+    # Rejected session is removed
+    cache.clear()
+    assert not cache.load(requests.Session())
+
+
+def test_session_cache_expiry(tmpdir):
+    """
+    Test an expired session is not loaded
+    """
+    from garmin_uploader.cache import SessionCache
+
+    session = requests.Session()
+    session.cookies.set('SESSIONID', '1234')
+
+    cache = SessionCache('test@example.com', str(tmpdir), ttl=-1)
+    cache.save(session)
+    assert not cache.load(requests.Session())
+
+
+def test_types_cache(standin, tmpdir, monkeypatch):
+    """
+    Test activity types are cached on disk, then revalidated
+    once outdated, using the authenticated session
+    """
+    from garmin_uploader.api import GarminAPI, GarminAPIException
+    from garmin_uploader.cache import TypesCache
+    from garmin_uploader.ratelimit import RateLimiter
+    import pytest
+
+    def reset():
+        monkeypatch.setattr(GarminAPI, 'activity_types', None)
+        del standin.requests[:]
+
+    monkeypatch.setattr(GarminAPI, 'create_session', lambda api: None)
+    cache = TypesCache(str(tmpdir.join('cache')))
+    api = GarminAPI(RateLimiter(rate=100, burst=10), types_cache=cache)
+
+    # Nothing cached while offline
+    api.offline = True
+    with pytest.raises(GarminAPIException):
+        api.load_activity_types(standin.session())
+    api.offline = False
+
+    # First load fetches & stores the catalog
+    assert 'running' in api.load_activity_types(standin.session())
+    assert len(standin.requests) == 1
+    assert cache.load()['fresh']
+    assert cache.load()['etag'] == '"types-v1"'
+
+    # Fresh cache is used without any request
+    reset()
+    assert 'cycling' in api.load_activity_types(standin.session())
+    assert standin.requests == []
+
+    # Outdated cache is revalidated
+    reset()
+    cache.ttl = -1
+    assert 'cycling' in api.load_activity_types(standin.session())
+    method, path, headers = standin.requests[0]
+    assert headers['If-None-Match'] == '"types-v1"'
+
+    # Outdated cache is used when offline or when Garmin fails
+    reset()
+    api.offline = True
+    assert 'running' in api.load_activity_types()
+    api.offline = False
+    reset()
+    assert api.update_activity_types(503, {}, None, cache.load())['running']
+    reset()
+    standin.stop()
+    api.max_retries = 0
+    assert 'running' in api.load_activity_types(standin.session())
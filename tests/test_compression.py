@@ -0,0 +1,104 @@
+import gzip
+import io
+import os
+import zipfile
+import pytest
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'sample_file.tcx')
+
+
+def test_gzip_body():
+    """
+    Test a body is compressed entirely in a temporary file
+    """
+    from garmin_uploader.compression import gzip_body
+    from garmin_uploader.multipart import MultipartFile
+
+    with MultipartFile(SAMPLE, 'sample_file.tcx') as body:
+        raw = body.read()
+        body.seek(0)
+        with gzip_body(body) as compressed:
+            data = compressed.read()
+    assert len(data) < len(raw)
+    assert gzip.GzipFile(fileobj=io.BytesIO(data)).read() == raw
+
+
+def test_zip_file():
+    """
+    Test zip archives hold the file under its name, and are removed
+    """
+    from garmin_uploader.compression import zip_file
+
+    with zip_file(SAMPLE, 'renamed.tcx') as archive:
+        with zipfile.ZipFile(archive) as reader:
+            assert reader.namelist() == ['renamed.tcx']
+            with open(SAMPLE, 'rb') as source:
+                assert reader.read('renamed.tcx') == source.read()
+    assert not os.path.exists(archive)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zip'])
+def test_compressed_upload(standin, compression):
+    """
+    Test compressed uploads are accepted, and are smaller
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    api = GarminAPI(RateLimiter(rate=100, burst=10), compression)
+    activity = Activity(SAMPLE)
+    activity_id, uploaded = api.upload_activity(standin.session(), activity)
+    assert uploaded
+    assert api.compression == compression
+
+    upload = list(standin.uploads.values())[0]
+    assert upload['id'] == activity_id
+    assert upload['filename'] == 'sample_file.tcx'
+    with open(SAMPLE, 'rb') as source:
+        assert upload['content'] == source.read()
+    assert len(standin.bodies[0]) < os.path.getsize(SAMPLE)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zip'])
+def test_compression_fallback(standin, tmpdir, compression):
+    """
+    Test rejected compressed uploads are sent again raw,
+    and compression is disabled afterwards
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    standin.accept_gzip = standin.accept_zip = False
+    api = GarminAPI(RateLimiter(rate=100, burst=10), compression)
+    activity_id, uploaded = api.upload_activity(
+        standin.session(), Activity(SAMPLE)
+    )
+    assert uploaded
+    assert api.compression is None
+    assert len(standin.bodies) == 2
+    assert list(standin.uploads.values())[0]['id'] == activity_id
+
+    # Next uploads are sent raw directly
+    other = tmpdir.join('other.gpx')
+    other.write('<gpx></gpx>')
+    api.upload_activity(standin.session(), Activity(str(other)))
+    assert len(standin.bodies) == 3
+    assert standin.requests[-1][2].get('Content-Encoding') is None
+    assert standin.requests[-1][1].endswith('/.gpx')
+
+
+def test_binary_not_compressed(standin, tmpdir):
+    """
+    Test FIT files are always sent raw
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    path = tmpdir.join('activity.fit')
+    path.write_binary(os.urandom(1024))
+    api = GarminAPI(RateLimiter(rate=100, burst=10), 'zip')
+    api.upload_activity(standin.session(), Activity(str(path)))
+    assert standin.requests[-1][1].endswith('/.fit')
@@ -0,0 +1,187 @@
+import os
+import pytest
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'sample_file.tcx')
+
+GPX = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1"
+  xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
+  <metadata><time>2020-05-01T08:00:00Z</time></metadata>
+  <trk>
+    <name>Ride</name>
+    <type>cycling</type>
+    <trkseg>
+      <trkpt lat="45.1" lon="5.7"><ele>210.5</ele>
+        <time>2020-05-01T10:00:00+02:00</time>
+        <extensions><power>180</power><gpxtpx:TrackPointExtension>
+          <gpxtpx:hr>120</gpxtpx:hr><gpxtpx:cad>85</gpxtpx:cad>
+        </gpxtpx:TrackPointExtension></extensions>
+      </trkpt>
+      <trkpt lat="45.1001" lon="5.7002"><ele>212.0</ele>
+        <time>2020-05-01T10:00:01+02:00</time>
+        <extensions><power>220</power><gpxtpx:TrackPointExtension>
+          <gpxtpx:hr>124</gpxtpx:hr><gpxtpx:cad>88</gpxtpx:cad>
+        </gpxtpx:TrackPointExtension></extensions>
+      </trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="45.1002" lon="5.7004"><ele>211.0</ele>
+        <time>2020-05-01T10:05:00+02:00</time>
+      </trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+'''
+
+
+def convert_file(path, tmpdir):
+    """
+    Convert an activity file, then decode the FIT file
+    """
+    from garmin_uploader.convert import convert
+    from fitreader import read_messages
+    from garmin_uploader.validate import validate_fit
+
+    fit = str(tmpdir.join('converted.fit'))
+    with open(fit, 'w+b') as output:
+        convert(path, output)
+    validate_fit(fit, crc=True)
+    messages = {}
+    for name, values in read_messages(fit):
+        messages.setdefault(name, []).append(values)
+    return fit, messages
+
+
+def test_parse_time():
+    """
+    Test ISO 8601 date times parsing
+    """
+    from garmin_uploader.convert import parse_time
+
+    assert parse_time('2015-01-20T13:26:30.000Z') == 1421760390
+    assert parse_time('2015-01-20T13:26:30.5Z') == 1421760390.5
+    assert parse_time('2015-01-20T15:26:30+02:00') == 1421760390
+    assert parse_time('2015-01-20T10:26:30-0300') == 1421760390
+    assert parse_time('2015-01-20T13:26:30') == 1421760390
+    assert parse_time('yesterday') is None
+    assert parse_time(None) is None
+
+
+def test_tcx_round_trip(tmpdir):
+    """
+    Test a TCX file converted to FIT keeps its points & laps
+    """
+    from garmin_uploader.convert import parse_activity, SPORTS
+
+    fit, messages = convert_file(SAMPLE, tmpdir)
+    assert os.path.getsize(fit) < os.path.getsize(SAMPLE) / 10
+
+    points = [v for kind, v in parse_activity(SAMPLE) if kind == 'point']
+    records = messages['record']
+    assert len(records) == len(points) == 260
+    for point, record in zip(points, records):
+        assert record['timestamp'] == point['timestamp']
+        assert record['position_lat'] == pytest.approx(point['lat'], abs=1e-6)  # noqa
+        assert record['position_long'] == pytest.approx(point['lon'], abs=1e-6)  # noqa
+        assert record['altitude'] == pytest.approx(point['altitude'], abs=0.2)  # noqa
+        assert record['distance'] == pytest.approx(point['distance'], abs=0.01)  # noqa
+        assert record['speed'] == pytest.approx(point['speed'], abs=0.001)
+        assert record['cadence'] == point['cadence']
+
+    laps = messages['lap']
+    assert len(laps) == 6
+    assert laps[0]['total_distance'] == 1000.0
+    assert laps[0]['total_timer_time'] == pytest.approx(419.855)
+    assert laps[0]['total_calories'] == 64
+    assert laps[0]['start_time'] == points[0]['timestamp']
+    assert all(lap['sport'] == SPORTS['running'] for lap in laps)
+
+    session, = messages['session']
+    assert session['num_laps'] == 6
+    assert session['total_distance'] == pytest.approx(
+        sum(lap['total_distance'] for lap in laps)
+    )
+    assert session['total_calories'] == sum(
+        lap['total_calories'] for lap in laps
+    )
+    assert session['timestamp'] == points[-1]['timestamp']
+    activity, = messages['activity']
+    assert activity['num_sessions'] == 1
+    assert messages['file_id'][0]['type'] == 4
+
+
+def test_gpx_round_trip(tmpdir):
+    """
+    Test a GPX file converted to FIT, with heart rate, cadence & power
+    Track segments become laps
+    """
+    from garmin_uploader.convert import SPORTS, parse_time
+
+    gpx = tmpdir.join('ride.gpx')
+    gpx.write(GPX)
+    fit, messages = convert_file(str(gpx), tmpdir)
+
+    start = parse_time('2020-05-01T08:00:00Z')
+    records = messages['record']
+    assert [r['timestamp'] - start for r in records] == [0, 1, 300]
+    assert records[0]['position_lat'] == pytest.approx(45.1, abs=1e-6)
+    assert records[2]['position_long'] == pytest.approx(5.7004, abs=1e-6)
+    assert [r.get('heart_rate') for r in records] == [120, 124, None]
+    assert [r.get('cadence') for r in records] == [85, 88, None]
+    assert [r.get('power') for r in records] == [180, 220, None]
+    assert records[1]['altitude'] == pytest.approx(212.0)
+
+    laps = messages['lap']
+    assert len(laps) == 2
+    assert laps[0]['avg_heart_rate'] == 122
+    assert laps[0]['max_power'] == 220
+    assert laps[0]['total_elapsed_time'] == 1
+
+    session, = messages['session']
+    assert session['sport'] == SPORTS['cycling']
+    assert session['total_elapsed_time'] == 300
+    assert session['max_heart_rate'] == 124
+    assert session['total_ascent'] == 2  # rounded meters
+    assert session['total_descent'] == 1
+
+
+def test_smallest_encoding(tmpdir, tcx_content):
+    """
+    Test the FIT conversion is only used when smaller
+    """
+    from garmin_uploader.convert import smallest_encoding
+
+    with smallest_encoding(SAMPLE) as path:
+        assert path.endswith('.fit')
+        assert os.path.getsize(path) < os.path.getsize(SAMPLE)
+    assert not os.path.exists(path)
+
+    # Nothing to convert without track points
+    empty = tmpdir.join('empty.tcx')
+    empty.write(tcx_content)
+    with smallest_encoding(str(empty)) as path:
+        assert path == str(empty)
+
+    broken = tmpdir.join('broken.gpx')
+    broken.write('<gpx><trk>')
+    with smallest_encoding(str(broken)) as path:
+        assert path == str(broken)
+
+
+def test_converted_upload(standin, tmpdir):
+    """
+    Test TCX files are uploaded as FIT files when converting
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.validate import FIT_SIGNATURE
+    from garmin_uploader.workflow import Activity
+
+    api = GarminAPI(RateLimiter(rate=100, burst=10), convert=True)
+    activity = Activity(SAMPLE)
+    activity.id, uploaded = api.upload_activity(standin.session(), activity)
+    assert uploaded
+    assert standin.requests[-1][1].endswith('/.fit')
+    upload, = standin.uploads.values()
+    assert upload['filename'] == 'sample_file.fit'
+    assert upload['content'][8:12] == FIT_SIGNATURE
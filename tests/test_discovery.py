@@ -0,0 +1,78 @@
+def build_tree(root):
+    """
+    Build a nested activities directory
+    """
+    root.join('a.fit').write('a')
+    root.join('notes.txt').write('')
+    root.join('2021', '01', 'b.gpx').write('b', ensure=True)
+    root.join('2021', '02', 'c.tcx').write('c', ensure=True)
+    root.join('2021', '02', 'list.csv').write('\n'.join([
+        'filename,name,type',
+        'c.tcx,CCCC,cycling',
+    ]))
+    root.join('2021', 'indoor', 'd.fit').write('d', ensure=True)
+
+
+def test_scan_directory(tmpdir):
+    """
+    Test flat and recursive directory listing
+    """
+    from garmin_uploader.discovery import discover
+    build_tree(tmpdir)
+
+    def names(**options):
+        return [
+            (p[len(str(tmpdir)) + 1:], info and info['name'])
+            for p, info in discover([str(tmpdir)], **options)
+        ]
+
+    assert names() == [('a.fit', None)]
+
+    # CSV list files are read before files of their directory
+    assert names(recursive=True) == [
+        ('a.fit', None),
+        ('2021/01/b.gpx', None),
+        ('2021/02/c.tcx', 'CCCC'),
+        ('2021/indoor/d.fit', None),
+    ]
+
+    assert names(recursive=True, max_depth=1) == [('a.fit', None)]
+    assert names(recursive=True, exclude=['indoor', '2021/01']) == [
+        ('a.fit', None),
+        ('2021/02/c.tcx', 'CCCC'),
+    ]
+    assert names(recursive=True, include=['*.fit']) == [
+        ('a.fit', None),
+        ('2021/02/c.tcx', 'CCCC'),
+        ('2021/indoor/d.fit', None),
+    ]
+
+
+def test_discover_lazy(tmpdir):
+    """
+    Test discovery is lazy and dedupes files
+    """
+    import types
+    from garmin_uploader.discovery import discover
+    build_tree(tmpdir)
+
+    fit = str(tmpdir.join('a.fit'))
+    candidates = discover([fit, str(tmpdir), fit])
+    assert isinstance(candidates, types.GeneratorType)
+    assert list(candidates) == [(fit, None)]
+
+
+def test_symlink_loop(tmpdir):
+    """
+    Test symlinked directories are scanned once,
+    and broken symlinks skipped, without failing the listing
+    """
+    from garmin_uploader.discovery import discover
+
+    tmpdir.join('a', 'run.fit').write('a', ensure=True)
+    tmpdir.join('a', 'loop').mksymlinkto(tmpdir)
+    tmpdir.join('a', 'broken.fit').mksymlinkto(tmpdir.join('missing.fit'))
+    tmpdir.join('linked').mksymlinkto(tmpdir.join('a'))
+
+    paths = [p for p, _ in discover([str(tmpdir)], recursive=True)]
+    assert paths == [str(tmpdir.join('a', 'run.fit'))]
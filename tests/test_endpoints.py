@@ -0,0 +1,73 @@
+import pytest
+
+
+def test_endpoints():
+    """
+    Test endpoints are built from base urls, unless given
+    """
+    from garmin_uploader.endpoints import Endpoints
+
+    endpoints = Endpoints()
+    assert endpoints.login == 'https://sso.garmin.com/sso/login'
+    assert endpoints.upload == 'https://connect.garmin.com/modern/proxy/upload-service/upload'  # noqa
+    assert endpoints.connect_host == 'connect.garmin.com'
+
+    endpoints = Endpoints('http://proxy:8080/', 'http://sso.proxy',
+                          upload='http://uploads/upload')
+    assert endpoints.profile == 'http://proxy:8080/modern/currentuser-service/user/info'  # noqa
+    assert endpoints.login == 'http://sso.proxy/sso/login'
+    assert endpoints.upload == 'http://uploads/upload'
+    assert endpoints.connect_host == 'proxy:8080'
+
+    with pytest.raises(Exception, match='Unknown endpoints: uploads'):
+        Endpoints(uploads='http://uploads/upload')
+
+
+def test_load_endpoints(tmpdir, monkeypatch):
+    """
+    Test options override environment variables,
+    overriding the config section
+    """
+    try:
+        from configparser import ConfigParser
+    except ImportError:
+        from ConfigParser import RawConfigParser as ConfigParser
+    from garmin_uploader.endpoints import load_endpoints, ENV_CONNECT
+
+    monkeypatch.delenv(ENV_CONNECT, raising=False)
+    assert load_endpoints().connect == 'https://connect.garmin.com'
+
+    path = tmpdir.join('gupload.ini')
+    path.write('\n'.join([
+        '[Endpoints]',
+        'connect = http://config',
+        'activity_types = http://types/activityTypes',
+    ]))
+    config = ConfigParser()
+    config.read(str(path))
+    endpoints = load_endpoints(config)
+    assert endpoints.connect == 'http://config'
+    assert endpoints.activity_types == 'http://types/activityTypes'
+    assert endpoints.sso == 'https://sso.garmin.com'
+
+    monkeypatch.setenv(ENV_CONNECT, 'http://env')
+    assert load_endpoints(config).connect == 'http://env'
+    assert load_endpoints(config, connect='http://cli').connect == 'http://cli'  # noqa
+
+
+def test_workflow_endpoints(standin, tmpdir, monkeypatch, fit_content):
+    """
+    Test a run logs in & uploads through the endpoints profile
+    """
+    from garmin_uploader.endpoints import ENV_CONNECT
+    from garmin_uploader.workflow import Workflow
+
+    monkeypatch.delenv(ENV_CONNECT)
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    w = Workflow([str(tmpdir)], username='standin', password='standin',
+                 session_cache=False, ledger=False, connect_url=standin.url)
+    assert w.api.endpoints.connect == standin.url
+    w.run()
+    assert standin.logins == 1
+    assert len(standin.uploads) == 1
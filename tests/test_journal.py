@@ -0,0 +1,90 @@
+import hashlib
+import json
+
+
+def test_journal(tmpdir):
+    """
+    Test state transitions are appended, synced by batches, and reloaded
+    """
+    from garmin_uploader.journal import Journal
+    from garmin_uploader.workflow import Activity
+
+    path = str(tmpdir.join('run.journal'))
+    journal = Journal(path, batch_size=2, batch_interval=3600)
+    assert not journal.resumed
+
+    activity = Activity(str(tmpdir.join('a.fit')))
+    journal.write(activity, 'queued')
+    assert journal.unsynced == 1
+    activity.id = 1234
+    journal.write(activity, 'uploaded')
+    assert journal.unsynced == 0
+    journal.write(Activity(str(tmpdir.join('b.fit'))), 'failed', 'Boom')
+    journal.close()
+
+    # A crash may leave a truncated line
+    with open(path, 'a') as f:
+        f.write('{"path": "c.fit", "sta')
+
+    journal = Journal(path)
+    assert journal.resumed
+    assert journal.get(str(tmpdir.join('a.fit')))['state'] == 'uploaded'
+    assert journal.get(str(tmpdir.join('a.fit')))['id'] == 1234
+    assert journal.get(str(tmpdir.join('b.fit')))['reason'] == 'Boom'
+    assert len(journal.states) == 2
+    journal.close()
+
+
+def test_resume(standin, logged_in, tmpdir, fit_content):
+    """
+    Test a resumed run only uploads files left behind,
+    and sets info of activities uploaded without it
+    """
+    from garmin_uploader.workflow import Workflow
+
+    rows = ['filename,name,type']
+    for i, name in enumerate(['a.fit', 'b.fit', 'c.fit', 'd.fit']):
+        tmpdir.join(name).write_binary(fit_content * (i + 1))
+        rows.append('{},{},running'.format(tmpdir.join(name), name.upper()))
+    csv = tmpdir.join('list.csv')
+    csv.write('\n'.join(rows))
+
+    # Interrupted run: a uploaded without info, b done,
+    # c sent to Garmin but never journaled as uploaded
+    digest = hashlib.sha1(fit_content * 3).hexdigest()
+    standin.uploads[digest] = {'id': 3, 'filename': 'c.fit', 'content': ''}
+    journal = tmpdir.join('run.journal')
+    journal.write(''.join(json.dumps(entry) + '\n' for entry in [
+        {'path': str(tmpdir.join('a.fit')), 'state': 'uploaded', 'id': 1},
+        {'path': str(tmpdir.join('b.fit')), 'state': 'info-set', 'id': 2},
+        {'path': str(tmpdir.join('c.fit')), 'state': 'queued', 'id': None},
+    ]))
+
+    w = Workflow([str(csv)], username='test', password='test', ledger=False,
+                 journal=str(journal))
+    w.run()
+
+    uploads = [p for m, p, _ in standin.requests if '/upload/' in p]
+    assert len(uploads) == 2  # c & d
+    assert sorted(standin.infos) == [1, 3, 1001]
+    assert standin.infos[1]['activityName'] == 'A.FIT'
+    assert standin.infos[3]['activityName'] == 'C.FIT'
+    assert standin.infos[1001]['activityName'] == 'D.FIT'
+
+    with open(str(journal)) as f:
+        states = dict(
+            (e['path'].rsplit('/', 1)[1], e['state'])
+            for e in map(json.loads, f)
+        )
+    assert states == {
+        'a.fit': 'info-set',
+        'b.fit': 'info-set',
+        'c.fit': 'info-set',
+        'd.fit': 'info-set',
+    }
+
+    # Nothing left to do
+    del standin.requests[:]
+    Workflow([str(csv)], username='test', password='test', ledger=False,
+             journal=str(journal)).run()
+    assert standin.requests == []
@@ -0,0 +1,57 @@
+def test_ledger(tmpdir):
+    """
+    Test uploaded files are found by path or content
+    """
+    from garmin_uploader.ledger import Ledger, hash_file
+
+    fit = tmpdir.join('a.fit')
+    fit.write('content')
+    digest = hash_file(str(fit))
+
+    ledger = Ledger(str(tmpdir.join('ledger.sqlite')))
+    assert ledger.find(str(fit)) is None
+    assert ledger.find_hash(digest) is None
+
+    ledger.record(str(fit), digest, 1234, 'set')
+    entry = ledger.find(str(fit))
+    assert entry['activity_id'] == 1234
+    assert entry['info_status'] == 'set'
+
+    # A copy is found by content only
+    copy = tmpdir.join('copy.fit')
+    copy.write('content')
+    assert ledger.find(str(copy)) is None
+    assert ledger.find_hash(hash_file(str(copy)))['activity_id'] == 1234
+
+    # A modified file is not found
+    fit.write('modified')
+    assert ledger.find(str(fit)) is None
+
+    assert len(ledger.list()) == 1
+    assert ledger.forget('1234') == 1
+    assert ledger.list() == []
+
+
+def test_ledger_cli(tmpdir, capsys):
+    """
+    Test ledger management commands
+    """
+    from garmin_uploader.cli import main
+
+    tmpdir.join('a.fit').write('a')
+    tmpdir.join('b.gpx').write('b')
+    path = str(tmpdir.join('ledger.sqlite'))
+
+    assert main(['ledger', '--ledger', path, 'import', str(tmpdir)]) == 0
+    assert 'Imported 2 files' in capsys.readouterr().out
+
+    assert main(['ledger', '--ledger', path, 'list']) == 0
+    out = capsys.readouterr().out
+    assert 'a.fit' in out
+    assert 'b.gpx' in out
+
+    assert main(['ledger', '--ledger', path, 'forget', str(tmpdir.join('a.fit'))]) == 0  # noqa
+    assert 'Removed 1 files' in capsys.readouterr().out
+
+    assert main(['ledger', '--ledger', path, 'import', str(tmpdir)]) == 0
+    assert 'Imported 1 files' in capsys.readouterr().out
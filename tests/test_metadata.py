@@ -0,0 +1,111 @@
+def test_metadata_queue(standin):
+    """
+    Test queued updates are coalesced, and sent once each
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.metadata import MetadataQueue
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    first = Activity('a.fit', name='First')
+    first.id = 1
+    second = Activity('b.fit', type='running')
+    second.id = 2
+    again = Activity('a.fit', type='cycling', notes='Notes')
+    again.id = 1
+    invalid = Activity('c.fit', type='nope')
+    invalid.id = 3
+
+    limiter = RateLimiter(rate=100, burst=10)
+    limiter.backoff = lambda attempt: 0
+    api = GarminAPI(limiter)
+    api.max_retries = 1
+    queue = MetadataQueue(api)
+    for activity in (first, second, again, invalid):
+        queue.add(activity)
+        assert activity.info_status == 'queued'
+    assert len(queue) == 3
+
+    # First update fails once on a server error, and is sent again
+    # by its request; invalid type is never sent
+    standin.errors = [503]
+    applied = queue.drain(standin.session())
+    assert len(queue) == 0
+    assert [(i.id, i.status) for i in applied] == [
+        (1, 'set'), (2, 'set'), (3, 'failed'),
+    ]
+    assert [a.info_status for a in (first, second, again, invalid)] == \
+        ['set', 'set', 'set', 'failed']
+
+    posts = [path for method, path, _ in standin.requests if method == 'POST']
+    assert [p.rsplit('/', 1)[1] for p in posts] == ['1', '1', '2']
+
+    # Permanent failures are sent once
+    rejected = Activity('d.fit', name='Rejected')
+    rejected.id = 4
+    queue.add(rejected)
+    standin.errors = [400]
+    assert [i.status for i in queue.drain(standin.session())] == ['failed']
+    assert rejected.info_status == 'failed'
+    assert 4 not in standin.infos
+
+    assert standin.infos[1]['activityName'] == 'First'
+    assert standin.infos[1]['activityTypeDTO']['typeKey'] == 'cycling'
+    assert standin.infos[1]['description'] == 'Notes'
+    assert standin.infos[2]['activityTypeDTO']['typeKey'] == 'running'
+
+
+def test_metadata_pool(standin):
+    """
+    Test queued updates are sent in parallel on a pool of workers
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.metadata import MetadataQueue
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    queue = MetadataQueue(GarminAPI(RateLimiter(rate=100, burst=10)))
+    for i in range(8):
+        activity = Activity('{}.fit'.format(i), name='Run {}'.format(i))
+        activity.id = i
+        queue.add(activity)
+
+    standin.latency = 0.2
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        applied = list(queue.drain(standin.session(), pool=pool))
+    assert time.time() - start < 8 * 0.2
+    assert [(i.id, i.status) for i in applied] == \
+        [(i, 'set') for i in range(8)]
+    assert sorted(standin.infos) == list(range(8))
+
+
+def test_set_info(standin, logged_in, tmpdir, fit_content):
+    """
+    Test set-info command updates activities found in ledger
+    """
+    from garmin_uploader.cli import main
+    from garmin_uploader.ledger import Ledger, hash_file
+
+    fit = tmpdir.join('a.fit')
+    fit.write_binary(fit_content)
+    tmpdir.join('b.fit').write_binary(fit_content + fit_content)
+    path = str(tmpdir.join('ledger.sqlite'))
+    db = Ledger(path)
+    db.record(str(fit), hash_file(str(fit)), 42)
+
+    csv = tmpdir.join('list.csv')
+    csv.write('\n'.join([
+        'filename,name,type,notes',
+        '{},Morning run,running,Easy'.format(fit),
+        '{},Not uploaded,running,'.format(tmpdir.join('b.fit')),
+    ]))
+    assert main(['set-info', '--ledger', path, '-u', 'test', '-p', 'test', str(csv)]) == 0  # noqa
+
+    assert standin.infos[42]['activityName'] == 'Morning run'
+    assert standin.infos[42]['description'] == 'Easy'
+    assert len(standin.infos) == 1
+    assert db.find_hash(hash_file(str(fit)))['info_status'] == 'set'
+    assert standin.uploads == {}
@@ -0,0 +1,127 @@
+import requests
+
+
+def test_endpoint():
+    """
+    Test activity ids are removed from endpoint labels
+    """
+    from garmin_uploader.metrics import endpoint
+
+    assert endpoint('https://connect.garmin.com/proxy/activity-service/activity/1234') == '/proxy/activity-service/activity/{id}'  # noqa
+    assert endpoint('https://connect.garmin.com/proxy/upload-service/upload/.fit?x=1') == '/proxy/upload-service/upload/.fit'  # noqa
+
+
+def test_scrape():
+    """
+    Test metrics are served in the text exposition format
+    """
+    from garmin_uploader.metrics import Metrics, CONTENT_TYPE
+    from garmin_uploader.stats import Stats
+
+    metrics = Metrics(port=0)
+    stats = Stats()
+    stats.hooks.append(metrics)
+    depth = [3]
+    metrics.gauge('gupload_queue_depth', lambda: depth[0], queue='uploads')
+
+    stats.record('http', 0.2, status=200, method='GET',
+                 url='http://test/activity/42')
+    stats.record('http', 3.0, status=500, method='GET',
+                 url='http://test/activity/43')
+    stats.record('rate-limit', 1.5, reason='backoff')
+    stats.record('upload', 1.0, size=2000, status='uploaded')
+    stats.record('upload', 1.0, size=1000, status='exists')
+    stats.record('upload', 1.0, size=500, status='failed')
+
+    try:
+        res = requests.get('http://127.0.0.1:{}/metrics'.format(metrics.port))
+    finally:
+        metrics.close()
+    assert res.status_code == 200
+    assert res.headers['Content-Type'] == CONTENT_TYPE
+
+    lines = res.text.splitlines()
+    assert '# TYPE gupload_uploads_total counter' in lines
+    assert 'gupload_uploads_total{status="uploaded"} 1' in lines
+    assert 'gupload_uploads_total{status="exists"} 1' in lines
+    assert 'gupload_uploads_total{status="failed"} 1' in lines
+    assert 'gupload_upload_bytes_total 3000' in lines
+    assert 'gupload_retries_total{reason="backoff"} 1' in lines
+
+    assert '# TYPE gupload_request_duration_seconds histogram' in lines
+    labels = 'endpoint="/activity/{id}",method="GET"'
+    assert 'gupload_request_duration_seconds_bucket{' + labels + ',le="0.25"} 1' in lines  # noqa
+    assert 'gupload_request_duration_seconds_bucket{' + labels + ',le="5.0"} 2' in lines  # noqa
+    assert 'gupload_request_duration_seconds_bucket{' + labels + ',le="+Inf"} 2' in lines  # noqa
+    assert 'gupload_request_duration_seconds_count{' + labels + '} 2' in lines  # noqa
+    assert 'gupload_rate_limit_wait_seconds_sum 1.5' in lines
+    assert 'gupload_queue_depth{queue="uploads"} 3' in lines
+
+
+def test_workflow_metrics(standin, logged_in, tmpdir, fit_content):
+    """
+    Test a run writes its metrics to a textfile,
+    and nothing is collected when metrics are disabled
+    """
+    from garmin_uploader.multipart import MultipartFile
+    from garmin_uploader.workflow import Workflow
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    tmpdir.join('b.fit').write_binary(fit_content * 2)
+    path = str(tmpdir.join('gupload.prom'))
+
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=False)
+    assert w.metrics is None
+    assert w.stats.hooks == []
+
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=False, metrics_file=path)
+    w.run()
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'gupload_uploads_total{status="uploaded"} 2' in lines
+    sent = sum(
+        len(MultipartFile(str(tmpdir.join(name)), name))
+        for name in ('a.fit', 'b.fit')
+    )
+    assert 'gupload_upload_bytes_total {}'.format(sent) in lines
+    assert 'gupload_queue_depth{queue="uploads"} 0' in lines
+    assert 'gupload_queue_depth{queue="metadata"} 0' in lines
+
+
+def test_textfile_threads(tmpdir):
+    """
+    Test the textfile is written safely from concurrent uploads
+    """
+    import threading
+    from garmin_uploader.metrics import Metrics
+    from garmin_uploader.stats import Stats
+
+    path = tmpdir.join('gupload.prom')
+    metrics = Metrics(path=str(path), interval=0)
+    stats = Stats()
+    stats.hooks.append(metrics)
+    errors = []
+
+    def upload():
+        try:
+            for _ in range(50):
+                stats.record('upload', 0.1, size=10, status='uploaded')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    # Writes are throttled, the last one happens on close
+    metrics.interval = 60
+    stats.record('upload', 0.1, size=10, status='uploaded')
+    assert 'gupload_uploads_total{status="uploaded"} 400' in path.read()
+    metrics.close()
+    assert 'gupload_uploads_total{status="uploaded"} 401' in path.read()
+    assert [p.basename for p in tmpdir.listdir()] == ['gupload.prom']
@@ -0,0 +1,78 @@
+import os
+try:
+    from email.parser import BytesParser
+except ImportError:
+    # Python 2 parser reads bytes strings
+    from email.parser import Parser
+
+    class BytesParser(Parser):
+        parsebytes = Parser.parsestr
+
+
+def parse(body, content_type):
+    """
+    Parse a multipart body, outputs its single part
+    """
+    message = BytesParser().parsebytes(
+        'Content-Type: {}\r\n\r\n'.format(content_type).encode('utf-8') + body
+    )
+    return message.get_payload()[0]
+
+
+def test_multipart_file(tmpdir):
+    """
+    Test a file is streamed by chunks as a multipart body
+    """
+    from garmin_uploader.multipart import MultipartFile, CHUNK_SIZE
+
+    content = os.urandom(3 * CHUNK_SIZE + 17)
+    path = tmpdir.join('big.fit')
+    path.write_binary(content)
+
+    progress = []
+    with MultipartFile(str(path), 'big "1".fit',
+                       progress=lambda *p: progress.append(p)) as body:
+        assert body.file is None
+        chunks = list(iter(lambda: body.read(1024 * 1024), b''))
+        assert max(len(c) for c in chunks) <= CHUNK_SIZE
+        data = b''.join(chunks)
+        assert len(data) == len(body)
+        assert progress[-1] == (len(body), len(body))
+
+        part = parse(data, body.content_type)
+        assert part.get_filename() == 'big %221%22.fit'
+        assert part.get_payload(decode=True) == content
+
+        # Rewind to send again
+        body.seek(0)
+        assert body.read() == data
+        source = body.file
+    assert source.closed
+
+
+def test_upload_stream(standin, tmpdir):
+    """
+    Test uploads send a Content-Length, and are sent again on retry
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Activity
+
+    content = os.urandom(200 * 1024)
+    path = tmpdir.join('activity.fit')
+    path.write_binary(content)
+
+    standin.errors = [503]
+    api = GarminAPI(RateLimiter(rate=100, burst=10))
+    activity = Activity(str(path))
+    activity_id, uploaded = api.upload_activity(standin.session(), activity)
+    assert uploaded
+
+    failed, sent = standin.bodies
+    assert failed == sent
+    headers = standin.requests[-1][2]
+    assert int(headers['Content-Length']) == len(sent)
+    assert 'Transfer-Encoding' not in headers
+    upload = list(standin.uploads.values())[0]
+    assert upload['id'] == activity_id
+    assert upload['content'] == content
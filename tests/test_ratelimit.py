@@ -0,0 +1,121 @@
+import threading
+import time
+
+
+def test_rate_limiter():
+    """
+    Test the limiter spaces out requests from several threads
+    """
+    from garmin_uploader.ratelimit import RateLimiter
+
+    limiter = RateLimiter(rate=20, burst=1)
+    slots = []
+
+    def worker():
+        limiter.wait()
+        slots.append(time.time())
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    slots.sort()
+    assert len(slots) == 5
+    for previous, current in zip(slots, slots[1:]):
+        assert current - previous >= 0.04
+
+
+def test_rate_limiter_burst():
+    """
+    Test burst requests are not delayed
+    """
+    from garmin_uploader.ratelimit import RateLimiter
+
+    limiter = RateLimiter(rate=1, burst=3)
+    assert [limiter.wait() for _ in range(3)] == [0, 0, 0]
+
+
+def test_rate_limiter_adaptive():
+    """
+    Test the rate slows down on throttling and recovers on success
+    """
+    from garmin_uploader.ratelimit import RateLimiter
+
+    limiter = RateLimiter(rate=10, burst=1)
+    limiter.throttle()
+    limiter.throttle()
+    assert limiter.rate == 2.5
+    for _ in range(100):
+        limiter.success()
+    assert limiter.rate == 10
+
+    # Retry-After blocks every request
+    limiter.throttle(retry_after=0.1)
+    start = time.time()
+    limiter.wait()
+    assert time.time() - start >= 0.09
+
+
+def test_parse_retry_after():
+    """
+    Test Retry-After header parsing
+    """
+    from email.utils import formatdate
+    from garmin_uploader.ratelimit import parse_retry_after
+
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('nope') is None
+    assert parse_retry_after('12') == 12
+    delay = parse_retry_after(formatdate(time.time() + 30, usegmt=True))
+    assert 25 < delay <= 30
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession(object):
+    """
+    Replay a list of status codes
+    """
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        status, headers = self.statuses.pop(0)
+        return FakeResponse(status, headers)
+
+
+def test_api_retries():
+    """
+    Test api requests are retried on 429 & 5xx
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.ratelimit import RateLimiter
+
+    api = GarminAPI(RateLimiter(rate=100, burst=10))
+    session = FakeSession(
+        (429, {'Retry-After': '0'}),
+        (503, {'Retry-After': '0.01'}),
+        (200, {}),
+    )
+    res = api.request(session, 'GET', 'http://localhost/')
+    assert res.status_code == 200
+    assert session.calls == 3
+
+    # Client errors are not retried
+    session = FakeSession((404, {}))
+    assert api.request(session, 'GET', 'http://localhost/').status_code == 404
+    assert session.calls == 1
+
+    # Give up after max retries
+    api.max_retries = 1
+    session = FakeSession((500, {'Retry-After': '0'}), (500, {}))
+    assert api.request(session, 'GET', 'http://localhost/').status_code == 500
+    assert session.calls == 2
@@ -0,0 +1,169 @@
+import pytest
+import requests
+
+
+def test_classify_status():
+    """
+    Test failed responses are classified by status
+    """
+    from garmin_uploader.api import (
+        classify_status, AuthExpiredError, ThrottledError, TransientError,
+        PermanentError,
+    )
+    assert isinstance(classify_status(401, ''), AuthExpiredError)
+    assert isinstance(classify_status(403, ''), AuthExpiredError)
+    assert isinstance(classify_status(429, ''), ThrottledError)
+    assert isinstance(classify_status(502, ''), TransientError)
+    assert isinstance(classify_status(400, ''), PermanentError)
+    assert isinstance(classify_status(412, ''), PermanentError)
+
+
+def test_network_retries():
+    """
+    Test network failures are retried, then reported as transient
+    """
+    from garmin_uploader.api import GarminAPI, TransientError
+    from garmin_uploader.ratelimit import RateLimiter
+
+    class Session(object):
+        calls = 0
+
+        def request(self, method, url, **kwargs):
+            self.calls += 1
+            if self.calls < 3:
+                raise requests.ConnectionError('Connection reset')
+            return type('Response', (), {'status_code': 200})()
+
+    limiter = RateLimiter(rate=100, burst=10)
+    limiter.backoff = lambda attempt: 0
+    api = GarminAPI(limiter)
+    session = Session()
+    res = api.request(session, 'GET', 'http://test')
+    assert res.status_code == 200
+    assert res.resent
+    assert session.calls == 3
+
+    api.max_retries = 1
+    session = Session()
+    with pytest.raises(TransientError):
+        api.request(session, 'GET', 'http://test')
+    assert session.calls == 2
+
+
+def test_retry_policy():
+    """
+    Test calls are retried depending on their failure
+    """
+    from garmin_uploader.api import (
+        AuthExpiredError, TransientError, PermanentError,
+    )
+    from garmin_uploader.retry import RetryPolicy
+
+    class User(object):
+        session = 'expired'
+        logins = 0
+
+        def authenticate(self):
+            self.logins += 1
+            self.session = 'renewed'
+            return True
+
+    def failing(*errors):
+        calls = []
+
+        def func(session, value):
+            calls.append(session)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return value
+        return func, calls
+
+    user = User()
+    policy = RetryPolicy(user)
+
+    # Transient errors were already retried by the request
+    func, calls = failing(TransientError('a'))
+    with pytest.raises(TransientError):
+        policy.call(func, 42)
+    assert len(calls) == 1
+
+    func, calls = failing(PermanentError('bad file'))
+    with pytest.raises(PermanentError):
+        policy.call(func, 42)
+    assert len(calls) == 1
+
+    # Session is renewed once, then the call is sent again
+    func, calls = failing(AuthExpiredError('expired'))
+    assert policy.call(func, 42) == 42
+    assert calls == ['expired', 'renewed']
+    assert user.logins == 1
+
+    func, calls = failing(*[AuthExpiredError('expired')] * 2)
+    with pytest.raises(AuthExpiredError):
+        policy.call(func, 42)
+    assert user.logins == 2
+
+    # A call sharing an already renewed session does not login again
+    policy.renew(policy.generation - 1)
+    assert user.logins == 2
+
+
+def test_dead_letter(standin, logged_in, tmpdir, fit_content):
+    """
+    Test uploads are retried after a session expiry, and files
+    failing for good are listed in a dead letter file
+    """
+    import csv
+    from garmin_uploader.workflow import Workflow
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    tmpdir.join('b.fit').write_binary(fit_content * 2)
+    dead_letter = str(tmpdir.join('failed.csv'))
+    # First file is sent again after a login, then rejected
+    standin.errors = [401, 400]
+
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 activity_type='running', ledger=False,
+                 dead_letter=dead_letter)
+    w.run()
+    assert len(logged_in) == 2
+    assert len(standin.uploads) == 1
+    assert [a.filename for a in w.failed] == ['a.fit']
+
+    with open(dead_letter) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1
+    assert rows[0]['filename'] == str(tmpdir.join('a.fit'))
+    assert rows[0]['type'] == 'running'
+    assert 'status 400' in rows[0]['reason']
+
+
+def test_resent_upload(standin, logged_in, tmpdir, monkeypatch, fit_content):
+    """
+    Test an upload resent after a lost response, found as a duplicate,
+    still gets its info set
+    """
+    from garmin_uploader.ledger import Ledger, hash_file
+    from garmin_uploader.ratelimit import RateLimiter
+    from garmin_uploader.workflow import Workflow
+
+    monkeypatch.setattr(RateLimiter, 'backoff', lambda self, attempt: 0)
+
+    fit = tmpdir.join('a.fit')
+    fit.write_binary(fit_content)
+    csv = tmpdir.join('list.csv')
+    csv.write('filename,name,type\n{},Morning run,running\n'.format(fit))
+    ledger = str(tmpdir.join('ledger.db'))
+
+    # First attempt is stored, but its response is lost
+    standin.lost = 1
+    w = Workflow([str(csv)], username='test', password='test', ledger=ledger)
+    w.run()
+
+    uploads = [p for m, p, _ in standin.requests if '/upload/' in p]
+    assert len(uploads) == 2
+    activity_id, = [u['id'] for u in standin.uploads.values()]
+    assert standin.infos[activity_id]['activityName'] == 'Morning run'
+    entry = Ledger(ledger).find_hash(hash_file(str(fit)))
+    assert entry['activity_id'] == activity_id
+    assert entry['info_status'] == 'set'
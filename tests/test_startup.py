@@ -0,0 +1,74 @@
+import os
+import pytest
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# HTTP stack, only imported once a session is needed
+HTTP_MODULES = ('requests', 'cloudscraper', 'urllib3', 'aiohttp')
+
+
+def run_python(*args):
+    """
+    Run python from the repository root, outputs its stderr
+    """
+    process = subprocess.Popen([sys.executable] + list(args), cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    return stderr
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='python -X importtime needs Python 3.7+')
+def test_import_time(record_property):
+    """
+    Test the cli starts without the HTTP stack,
+    with python -X importtime; the import time is recorded
+    in the test report, with a generous budget
+    """
+    times = {}
+    stderr = run_python('-X', 'importtime', '-c', 'import garmin_uploader.cli')  # noqa
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        times[module.strip()] = int(cumulative) / 1e6
+
+    assert [m for m in HTTP_MODULES if m in times] == []
+    record_property('import_time', times['garmin_uploader.cli'])
+    assert times['garmin_uploader.cli'] < 1
+
+
+def test_nothing_to_upload(tmpdir, fit_content):
+    """
+    Test a run with every file in the ledger exits
+    before importing the HTTP stack
+    """
+    from garmin_uploader.ledger import Ledger, hash_file
+
+    fit = tmpdir.join('done.fit')
+    fit.write_binary(fit_content)
+    ledger = Ledger(str(tmpdir.join('ledger.db')))
+    ledger.record(str(fit), hash_file(str(fit)), 1234, 'set')
+    ledger.close()
+
+    run_python('-c', '\n'.join([
+        'import sys',
+        'from garmin_uploader.cli import main',
+        'args = ["-u", "test", "-p", "test", "--ledger", {!r}, {!r}]',
+        'assert main(args) == 0',
+        'loaded = [m for m in {!r} if m in sys.modules]',
+        'assert loaded == [], loaded',
+    ]).format(str(tmpdir.join('ledger.db')), str(tmpdir), HTTP_MODULES))
+
+
+def test_help(capsys):
+    """
+    Test the help text is read when printing the help
+    """
+    from garmin_uploader.cli import main
+
+    with pytest.raises(SystemExit):
+        main(['-h'])
+    assert 'Priority of credentials:' in capsys.readouterr().out
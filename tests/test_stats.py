@@ -0,0 +1,104 @@
+import json
+
+
+def test_percentile():
+    """
+    Test nearest rank percentiles
+    """
+    from garmin_uploader.stats import percentile
+
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 90) == 90
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3.0
+    assert percentile([], 50) == 0.0
+
+
+def test_summary(tmpdir):
+    """
+    Test records are sent to hooks, exported and summarized by stage
+    """
+    from garmin_uploader.stats import Stats
+
+    export = str(tmpdir.join('stats.jsonl'))
+    stats = Stats(export, keep=True)
+    received = []
+    stats.hooks.append(received.append)
+
+    stats.record('upload', 2.0, size=3000000, status='uploaded')
+    stats.record('upload', 1.0, size=1000000, status='uploaded')
+    with stats.timer('http', method='GET') as timing:
+        timing['status'] = 200
+    assert list(stats.timed('discovery', 'ab')) == ['a', 'b']
+    stats.close()
+
+    assert [r['stage'] for r in received] == [
+        'upload', 'upload', 'http', 'discovery', 'discovery',
+    ]
+    with open(export) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == received
+    assert lines[2]['status'] == 200
+    assert lines[2]['method'] == 'GET'
+
+    rows = stats.summary()
+    assert [r['stage'] for r in rows] == ['discovery', 'http', 'upload']
+    upload = rows[-1]
+    assert upload['count'] == 2
+    assert upload['total'] == 3.0
+    assert upload['p50'] == 1.0
+    assert upload['max'] == 2.0
+    assert upload['bytes'] == 4000000
+
+    table = stats.table()
+    assert 'p90' in table
+    assert 'Throughput:' in table
+
+    # Records are only sent to hooks, unless kept for the summary
+    stats = Stats()
+    stats.hooks.append(received.append)
+    stats.record('upload', 1.0, status='uploaded')
+    assert received[-1]['stage'] == 'upload'
+    assert stats.summary() == []
+
+
+def test_workflow_stats(logged_in, tmpdir, capsys, fit_content, tcx_content):
+    """
+    Test a run records every stage, then prints its summary
+    """
+    from garmin_uploader.multipart import MultipartFile
+    from garmin_uploader.workflow import Workflow
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    export = str(tmpdir.join('stats.jsonl'))
+    w = Workflow([str(tmpdir.join('a.fit'))], username='test',
+                 password='test', activity_name='Run', ledger=False,
+                 show_stats=True, stats_export=export)
+    w.run()
+
+    stages = [r['stage'] for r in w.stats.summary()]
+    assert stages == [
+        'discovery', 'validation', 'auth', 'rate-limit', 'http', 'upload',
+        'info-set',
+    ]
+    upload, = w.stats.records['upload']
+    assert upload['status'] == 'uploaded'
+    assert upload['bytes'] == len(MultipartFile(str(tmpdir.join('a.fit')), 'a.fit'))  # noqa
+    assert w.stats.records['auth'][0]['status'] == 'login'
+    assert all(r['status'] < 300 for r in w.stats.records['http'])
+    assert 'Throughput: ' in capsys.readouterr().err
+
+    with open(export) as f:
+        assert len(f.readlines()) == sum(
+            len(records) for records in w.stats.records.values()
+        )
+
+    # Compressed uploads record the bytes sent
+    tcx = tmpdir.join('b.tcx')
+    tcx.write(tcx_content.replace('<Activities/>', '<Activities>{}</Activities>'.format('<Activity Sport="Running"/>' * 1000)))  # noqa
+    w = Workflow([str(tcx)], username='test', password='test', ledger=False,
+                 show_stats=True, compression='gzip')
+    w.run()
+    upload, = w.stats.records['upload']
+    assert 0 < upload['bytes'] < tcx.size() / 10
@@ -0,0 +1,108 @@
+import os
+import struct
+import pytest
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'sample_file.tcx')
+
+
+def test_fit_crc():
+    """
+    Test the FIT CRC, which is a CRC-16/ARC
+    """
+    from garmin_uploader.validate import fit_crc
+    assert fit_crc(b'123456789') == 0xBB3D
+    assert fit_crc(b'56789', fit_crc(b'1234')) == 0xBB3D
+
+
+def test_validate_fit(tmpdir, fit_content):
+    """
+    Test FIT headers, sizes & CRC are checked, on chained files too
+    """
+    from garmin_uploader.validate import validate, ValidationError
+
+    path = tmpdir.join('a.fit')
+    path.write_binary(fit_content)
+    validate(str(path))
+
+    path.write_binary(fit_content + fit_content)
+    validate(str(path), crc=True)
+
+    broken = [
+        (b'', 'Empty file'),
+        (b'not a fit file at all', 'Invalid FIT header'),
+        (fit_content[:-1], 'truncated'),
+        (fit_content[:12] + b'\1\0' + fit_content[14:], 'header CRC'),
+        (fit_content[:4] + struct.pack('<I', 10) + b'.FIT\0\0' + fit_content[14:], 'truncated'),  # noqa
+    ]
+    for content, error in broken:
+        path.write_binary(content)
+        with pytest.raises(ValidationError, match=error):
+            validate(str(path))
+
+    # The whole file CRC is only checked on demand
+    corrupted = fit_content[:-2] + b'\1\2'
+    path.write_binary(fit_content + corrupted)
+    validate(str(path))
+    with pytest.raises(ValidationError, match='Invalid FIT CRC'):
+        validate(str(path), crc=True)
+
+
+def test_validate_xml(tmpdir, tcx_content):
+    """
+    Test XML files are well formed, with the right root element
+    """
+    from garmin_uploader.validate import validate, ValidationError
+
+    validate(SAMPLE)
+
+    path = tmpdir.join('a.tcx')
+    path.write(tcx_content)
+    validate(str(path))
+
+    gpx = tmpdir.join('a.gpx')
+    gpx.write('<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk/></gpx>')
+    validate(str(gpx))
+
+    broken = [
+        (path, '', 'Empty file'),
+        (path, tcx_content[:-30], 'Invalid XML'),
+        (gpx, '<gpx><trk></gpx>', 'Invalid XML'),
+        (gpx, tcx_content, 'Invalid root element TrainingCenterDatabase'),
+    ]
+    for target, content, error in broken:
+        target.write(content)
+        with pytest.raises(ValidationError, match=error):
+            validate(str(target))
+
+
+def test_validate_xml_memory(tmpdir):
+    """
+    Test large XML files are validated without keeping their elements
+    """
+    tracemalloc = pytest.importorskip('tracemalloc')
+    from garmin_uploader.validate import validate
+
+    point = (
+        '<Trackpoint><Time>2020-01-01T09:00:00Z</Time>'
+        '<Position><LatitudeDegrees>45.0</LatitudeDegrees>'
+        '<LongitudeDegrees>5.7</LongitudeDegrees></Position>'
+        '<HeartRateBpm><Value>120</Value></HeartRateBpm></Trackpoint>\n'
+    )
+    path = tmpdir.join('large.tcx')
+    with path.open('w') as f:
+        f.write(
+            '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">'  # noqa
+            '<Activities><Activity Sport="Running"><Lap><Track>\n'
+        )
+        for _ in range(50000):
+            f.write(point)
+        f.write('</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n')  # noqa
+    assert path.size() > 10 * 1000 * 1000
+
+    tracemalloc.start()
+    try:
+        validate(str(path))
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 2 * 1024 * 1024
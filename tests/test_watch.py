@@ -0,0 +1,89 @@
+import pytest
+import threading
+import time
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+def watch(watcher):
+    """
+    Collect ready files from a watcher in a background thread
+    """
+    ready = Queue()
+
+    def run():
+        for path in watcher:
+            ready.put(path)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return ready
+
+
+def check_watcher(tmpdir, watcher_class):
+    """
+    Test new files are only reported once fully written
+    """
+    tmpdir.join('existing.fit').write('a')
+    tmpdir.join('notes.txt').write('')
+    watcher = watcher_class(
+        str(tmpdir),
+        recursive=True,
+        settle=0.3,
+        interval=0.05,
+    )
+    ready = watch(watcher)
+    assert ready.get(timeout=2) == str(tmpdir.join('existing.fit'))
+
+    # Write a file slowly, in several parts
+    new = tmpdir.join('sub', 'new.gpx')
+    new.write('<gpx>', ensure=True)
+    start = time.time()
+    for _ in range(3):
+        time.sleep(0.1)
+        new.write('<trk/>', mode='a')
+    tmpdir.join('sub', 'ignored.csv').write('')
+
+    assert ready.get(timeout=2) == str(new)
+    assert time.time() - start >= 0.3 + 0.3
+    with pytest.raises(Empty):
+        ready.get(timeout=0.5)
+
+
+def test_polling_watcher(tmpdir):
+    """
+    Test polling watcher
+    """
+    from garmin_uploader.watch import Watcher
+    check_watcher(tmpdir, Watcher)
+
+
+def test_inotify_watcher(tmpdir):
+    """
+    Test inotify watcher
+    """
+    pytest.importorskip('inotify_simple')
+    from garmin_uploader.watch import InotifyWatcher
+    check_watcher(tmpdir, InotifyWatcher)
+
+
+@pytest.mark.parametrize('name', ['Watcher', 'InotifyWatcher'])
+def test_symlink_loop(tmpdir, name):
+    """
+    Test watchers scan a symlink loop once
+    """
+    from garmin_uploader import watch
+    if name == 'InotifyWatcher':
+        pytest.importorskip('inotify_simple')
+
+    tmpdir.join('a', 'run.fit').write('a', ensure=True)
+    tmpdir.join('a', 'loop').mksymlinkto(tmpdir)
+    tmpdir.join('a', 'broken.fit').mksymlinkto(tmpdir.join('missing.fit'))
+
+    watcher = getattr(watch, name)(str(tmpdir), recursive=True)
+    try:
+        assert watcher.start() == set([str(tmpdir.join('a', 'run.fit'))])
+    finally:
+        watcher.stop()
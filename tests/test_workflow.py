@@ -42,3 +42,207 @@ def test_listing(activities_dir):
     assert activities['a.tcx'].name is None
     assert activities['a.fit'].type == 'cycling'
     assert activities['a.tcx'].type == 'cycling'
+
+
+def test_parallel_run(activities_dir, logged_in, monkeypatch, tmpdir):
+    """
+    Test activities are uploaded by a pool of workers
+    """
+    import time
+    from garmin_uploader.workflow import Activity, Workflow
+
+    running, peak, uploaded = set(), [], []
+
+    def upload(activity, user, metadata=None, retry=None):
+        running.add(activity.path)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.discard(activity.path)
+        activity.status = 'uploaded'
+        uploaded.append(activity)
+        return True
+
+    monkeypatch.setattr(Activity, 'upload', upload)
+
+    ledger = str(tmpdir.join('ledger.sqlite'))
+    w = Workflow([activities_dir], username='test', password='test', jobs=2,
+                 ledger=ledger)
+    w.run()
+    assert max(peak) == 2
+    assert len(uploaded) == 2
+
+    # Uploaded files are skipped on next run
+    w = Workflow([activities_dir], username='test', password='test',
+                 ledger=ledger)
+    assert w.activities == []
+
+
+def test_bounded_map():
+    """
+    Test activities are consumed lazily by the upload pool
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from garmin_uploader.workflow import bounded_map
+
+    consumed = []
+
+    def items():
+        for i in range(10):
+            consumed.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = bounded_map(pool, lambda x: x * 2, items(), 3)
+        assert next(results) == 0
+        assert len(consumed) == 3
+        assert list(results) == [2 * i for i in range(1, 10)]
+
+
+def test_empty_listing(tmpdir):
+    """
+    Test a run without any valid file fails before login
+    """
+    import pytest
+    from garmin_uploader.workflow import Workflow
+
+    tmpdir.join('invalid.txt').write('')
+    w = Workflow([str(tmpdir)], username='test', password='test')
+    with pytest.raises(Exception, match='No valid files'):
+        w.run()
+
+    # Broken activity files are rejected locally
+    tmpdir.join('empty.fit').write('')
+    tmpdir.join('broken.gpx').write('<gpx><trk>')
+    w = Workflow([str(tmpdir)], username='test', password='test')
+    with pytest.raises(Exception, match='No valid files'):
+        w.run()
+    assert w.invalid == 2
+
+
+def test_watch(tmpdir, logged_in, monkeypatch, fit_content):
+    """
+    Test watched files are uploaded once, login again on expired session
+    """
+    from garmin_uploader.api import GarminAPI
+    from garmin_uploader.workflow import Activity, Workflow
+
+    uploads = []
+
+    def upload(activity, user, metadata=None, retry=None):
+        # First upload fails on expired session
+        uploads.append(activity.path)
+        activity.status = len(uploads) == 1 and 'failed' or 'uploaded'
+        return activity.status == 'uploaded'
+
+    monkeypatch.setattr(Activity, 'upload', upload)
+    monkeypatch.setattr(GarminAPI, 'check_session', lambda api, s: None)
+
+    fit = tmpdir.join('a.fit')
+    fit.write_binary(fit_content)
+
+    class FakeWatcher(list):
+        directory = str(tmpdir)
+
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=str(tmpdir.join('ledger.sqlite')))
+    w.watch(FakeWatcher([str(fit), str(fit)]))
+    assert len(logged_in) == 2
+    assert uploads == [str(fit), str(fit)]
+
+
+def test_content_dedupe(tmpdir, monkeypatch, fit_content, tcx_content):
+    """
+    Test same files listed through several paths are only listed once,
+    hashing only files sharing their size with another one
+    """
+    import os
+    from garmin_uploader import workflow
+    from garmin_uploader.workflow import Workflow
+
+    hashed = []
+
+    def hash_file(path):
+        hashed.append(os.path.basename(path))
+        with open(path, 'rb') as f:
+            return f.read()
+    monkeypatch.setattr(workflow, 'hash_file', hash_file)
+
+    first, second = tmpdir.mkdir('first'), tmpdir.mkdir('second')
+    first.join('a.tcx').write(tcx_content)
+    first.join('b.fit').write_binary(fit_content)
+    second.join('copy.tcx').write(tcx_content)
+    second.join('other.tcx').write(tcx_content.replace('Activities', 'Activitiez'))  # noqa
+    csv = tmpdir.join('list.csv')
+    csv.write('\n'.join([
+        'filename,name,type',
+        'second/copy.tcx,From CSV,running',
+    ]))
+
+    w = Workflow([str(first), str(csv), str(second)], username='test',
+                 password='test', ledger=False)
+    activities = w.activities
+    assert [a.filename for a in activities] == ['a.tcx', 'b.fit', 'other.tcx']
+    assert activities[0].name is None
+    assert w.duplicates == 1  # second listing of copy.tcx is a same path
+    assert 'b.fit' not in hashed
+    assert sorted(set(hashed)) == ['a.tcx', 'copy.tcx', 'other.tcx']
+
+
+def test_prepare_workers(tmpdir, fit_content, tcx_content):
+    """
+    Test files are hashed & validated by worker processes, in input order
+    """
+    from garmin_uploader.ledger import hash_file
+    from garmin_uploader.workflow import Workflow
+
+    for i in range(10):
+        tmpdir.join('{:02d}.tcx'.format(i)).write(tcx_content + ' ' * i)
+    tmpdir.join('10.fit').write_binary(fit_content)
+    tmpdir.join('11.fit').write('broken')
+    tmpdir.join('12.tcx').write(tcx_content)  # copy of 00.tcx
+    tmpdir.join('13.fit').write_binary(fit_content[:-2] + b'\1\2')
+
+    # Full FIT CRC is only checked on demand by the listing thread
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=False)
+    assert [a.filename for a in w.activities][-2:] == ['10.fit', '13.fit']
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=False, check_crc=True)
+    assert [a.filename for a in w.activities][-1] == '10.fit'
+
+    # Worker processes always check it
+    w = Workflow([str(tmpdir)], username='test', password='test',
+                 ledger=False, prep_workers=3)
+    activities = w.activities
+    assert [a.filename for a in activities] == \
+        ['{:02d}.tcx'.format(i) for i in range(10)] + ['10.fit']
+    assert w.invalid == 2
+    assert w.duplicates == 1
+    for activity in activities:
+        assert activity._hash == hash_file(activity.path)
+        assert activity._checked
+
+
+def test_check_types(standin, tmpdir, monkeypatch, capsys, fit_content):
+    """
+    Test activity types are checked before uploads, from a cached catalog
+    """
+    from garmin_uploader.cli import main
+    from garmin_uploader.workflow import Workflow
+
+    tmpdir.join('a.fit').write_binary(fit_content)
+    tmpdir.join('b.fit').write_binary(fit_content * 2)
+    csv = tmpdir.join('list.csv')
+    csv.write('\n'.join([
+        'filename,name,type',
+        '{},A,running'.format(tmpdir.join('a.fit')),
+        '{},B,nope'.format(tmpdir.join('b.fit')),
+    ]))
+
+    w = Workflow([str(csv)], username='test', password='test', ledger=False)
+    assert [a.name for a in w.activities] == ['A']
+    assert w.invalid == 1
+
+    # Catalog is now available offline
+    assert main(['types', '--offline']) == 0
+    assert capsys.readouterr().out.split() == ['all', 'cycling', 'running']